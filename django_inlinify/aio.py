@@ -0,0 +1,300 @@
+"""Asyncio support, for Python 3.6+.
+
+`Inlinify.atransform` loads the CSS files without blocking the event loop, and runs the
+in-lining in a bounded thread pool (see DJANGO_INLINIFY_ASYNC_MAX_WORKERS), so one event loop can
+keep many documents in flight.
+
+Remote CSS files are fetched concurrently with a shared httpx.AsyncClient, one per event loop, so
+connections are reused. httpx is optional: without it, the CSS files are loaded in a thread. The
+cache backends are used through Django's async cache methods when they have them (Django 4.0+),
+and in a thread otherwise.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django_inlinify import defaults
+from django_inlinify.css_tools import _is_url
+from django_inlinify.inlinify import _fingerprint
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+try:
+    _get_running_loop = asyncio.get_running_loop
+except AttributeError:  # Python 3.6
+    _get_running_loop = asyncio.get_event_loop
+
+__all__ = ['aclose', 'aload_with_fingerprints', 'atransform', 'get_executor']
+
+log = logging.getLogger(__name__)
+
+DJANGO_INLINIFY_ASYNC_MAX_WORKERS = getattr(
+    settings,
+    'DJANGO_INLINIFY_ASYNC_MAX_WORKERS',
+    defaults.DJANGO_INLINIFY_ASYNC_MAX_WORKERS
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# HTTP clients, by event loop
+_clients = weakref.WeakKeyDictionary()
+
+# Background revalidations of stale remote files, kept so they aren't garbage collected
+_tasks = set()
+
+
+def get_executor():
+    """Returns the thread pool the in-lining runs in, creating it if needed
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DJANGO_INLINIFY_ASYNC_MAX_WORKERS)
+        return _executor
+
+
+def _get_client(loader):
+    """Returns the HTTP client of the current event loop, creating it if needed. Its pool size,
+    timeouts and number of retries are the ones of the CSS loader. Only failed connections are
+    retried
+    """
+    loop = _get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        pool_size = loader.DJANGO_INLINIFY_CSSLOADER_POOL_SIZE
+        transport = httpx.AsyncHTTPTransport(
+            retries=loader.DJANGO_INLINIFY_CSSLOADER_RETRIES,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        client = _clients[loop] = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(loader.DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT,
+                                  connect=loader.DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT),
+        )
+    return client
+
+
+async def aclose():
+    """Closes the HTTP client of the current event loop, if any
+    """
+    client = _clients.pop(_get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def _run_in_thread(func, *args, executor=None):
+    return await _get_running_loop().run_in_executor(executor, functools.partial(func, *args))
+
+
+async def _call_backend(backend, name, *args):
+    """Calls a method of a Django cache backend, using its async version if there is one
+    """
+    method = getattr(backend, 'a' + name, None)
+    if method is not None:
+        return await method(*args)
+    return await _run_in_thread(getattr(backend, name), *args)
+
+
+async def cache_get(cache, key):
+    """Async version of TieredCache.get
+    """
+    if cache.local is not None:
+        value = cache.local.get(key)
+        if value is not None:
+            cache.counters.increment('l1_hits')
+            return value
+        cache.counters.increment('l1_misses')
+    if cache.backend is not None:
+        value = await _call_backend(cache.backend, 'get', key)
+        if value is not None:
+            cache.counters.increment('l2_hits')
+            if cache.local is not None:
+                cache.local.set(key, value)
+            return value
+        cache.counters.increment('l2_misses')
+    return None
+
+
+async def cache_set(cache, key, value, timeout=None):
+    """Async version of TieredCache.set
+    """
+    timeout = timeout if timeout is not None else cache.ttl
+    if cache.local is not None:
+        cache.local.set(key, value, cache._local_ttl(timeout))
+    if cache.backend is not None:
+        await _call_backend(cache.backend, 'set', key, value, timeout)
+
+
+async def cache_add(cache, key, value, timeout=None):
+    """Async version of TieredCache.add
+    """
+    timeout = timeout if timeout is not None else cache.ttl
+    if cache.local is not None and not cache.local.add(key, value, timeout):
+        return False
+    if cache.backend is not None and not await _call_backend(cache.backend, 'add', key, value,
+                                                             timeout):
+        if cache.local is not None:
+            cache.local.delete(key)
+        return False
+    return True
+
+
+async def cache_delete(cache, key):
+    """Async version of TieredCache.delete
+    """
+    if cache.local is not None:
+        cache.local.delete(key)
+    if cache.backend is not None:
+        await _call_backend(cache.backend, 'delete', key)
+
+
+async def _get_cached(loader, filename):
+    """Async version of CSSLoader._get_cached. Stale remote files are revalidated in a task
+    """
+    if loader._stats_local_files(filename):
+        # only stats the file and reads the in-process cache
+        return loader._get_cached(filename)
+    cached = await cache_get(loader.cache, loader._get_cache_key(filename))
+    if isinstance(cached, dict):
+        if cached['expires'] < time.time():
+            task = asyncio.ensure_future(_revalidate(loader, filename, cached))
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+        return cached['contents'], loader._url_fingerprint(filename, cached)
+    return cached, None
+
+
+async def _request(loader, filepath, headers=None):
+    return await _get_client(loader).get(filepath, headers=headers)
+
+
+async def _fetch_url_entry(loader, filepath):
+    """Async version of CSSLoader._fetch_url_entry
+    """
+    response = await _request(loader, filepath)
+    if response.status_code != 200:
+        raise ValueError('The CSS file you specified (%s) does not exist. Response (%s - %s)' %
+                         (filepath, response.status_code, response.reason_phrase))
+    return loader._make_url_entry(response)
+
+
+async def _set_cached_url_entry(loader, filepath, entry):
+    # stale entries are kept around so they can be served while they are revalidated
+    await cache_set(loader.cache, loader._get_cache_key(filepath), entry,
+                    loader.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL +
+                    loader.DJANGO_INLINIFY_CSSLOADER_STALE_TTL)
+
+
+async def _revalidate(loader, filepath, entry):
+    """Async version of CSSLoader._revalidate and CSSLoader._refresh
+    """
+    lock_key = loader._get_lock_key(filepath)
+    if not await cache_add(loader.cache, lock_key, 1, loader.DJANGO_INLINIFY_CSSLOADER_LOCK_TTL):
+        return
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = await _request(loader, filepath, headers)
+        if response.status_code == 304:
+            entry = dict(entry)
+            entry['expires'] = time.time() + loader.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL
+        elif response.status_code == 200:
+            entry = loader._make_url_entry(response)
+        else:
+            log.warning('Could not revalidate the CSS file %s. Response (%s - %s)',
+                        filepath, response.status_code, response.reason_phrase)
+            return
+        await _set_cached_url_entry(loader, filepath, entry)
+    except Exception:
+        log.exception('Could not revalidate the CSS file %s', filepath)
+    finally:
+        await cache_delete(loader.cache, lock_key)
+
+
+async def _read(loader, filepath, semaphore):
+    """Reads a file that isn't cached. Remote files are fetched with the HTTP client, at most
+    DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS at the same time, and local ones in a thread
+    """
+    if not _is_url(filepath):
+        return await _run_in_thread(loader._read, filepath)
+    async with semaphore:
+        entry = await _fetch_url_entry(loader, filepath)
+    await _set_cached_url_entry(loader, filepath, entry)
+    return entry['contents'], loader._url_fingerprint(filepath, entry)
+
+
+async def aload_with_fingerprints(loader):
+    """Async version of CSSLoader.load_with_fingerprints
+
+    Arguments:
+        - CSSLoader loader: the loader
+
+    Returns:
+        a list with the (contents, fingerprint) tuples of the files, in the same order as the
+        files
+    """
+    if httpx is None:
+        return await _run_in_thread(loader.load_with_fingerprints)
+
+    sources = list(await asyncio.gather(*[_get_cached(loader, f) for f in loader.files]))
+    missing = [index for index, (contents, __) in enumerate(sources) if not contents]
+    if missing:
+        semaphore = asyncio.Semaphore(max(1, loader.DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS))
+        results = await asyncio.gather(*[
+            _read(loader, loader.files[index], semaphore) for index in missing
+        ])
+        for index, result in zip(missing, results):
+            sources[index] = result
+    return sources
+
+
+def _transform(inlinify, css_sources, fingerprint, html, pretty_print, kwargs, recorder):
+    plan = inlinify._get_plan(css_sources, recorder, fingerprint)
+    return inlinify._transform(html, plan, pretty_print, kwargs, recorder)
+
+
+async def atransform(inlinify, html, pretty_print=True, **kwargs):
+    """Async version of Inlinify.transform
+
+    Arguments:
+        - Inlinify inlinify: the instance transforming the html
+        - str html: the HTML document
+
+    Returns:
+        the transformed html
+    """
+    recorder = inlinify._get_recorder()
+    started = recorder.start()
+    css_sources = await aload_with_fingerprints(inlinify.css_source)
+    recorder.stop('load', started)
+    fingerprint = _fingerprint(css_sources)
+
+    cache_key = None
+    if inlinify.output_cache is not None:
+        cache_key = inlinify._get_output_cache_key(html, fingerprint, pretty_print, kwargs)
+        cached = await cache_get(inlinify.output_cache, cache_key)
+        if cached is not None:
+            recorder.count('output_cache_hits')
+            inlinify._emit(recorder)
+            return cached
+        recorder.count('output_cache_misses')
+
+    # parsing the CSS and the HTML, matching the selectors and serializing are CPU bound
+    html = await _run_in_thread(_transform, inlinify, css_sources, fingerprint, html,
+                                pretty_print, kwargs, recorder, executor=get_executor())
+    if cache_key:
+        await cache_set(inlinify.output_cache, cache_key, html)
+    inlinify._emit(recorder)
+    return html
@@ -0,0 +1,443 @@
+"""Benchmarks for Inlinify.
+
+Runs the in-lining of a few corpora of documents, and reports how long every phase takes, the
+throughput and the peak memory, as JSON. Results of two versions can be compared to find
+regressions:
+
+    python -m django_inlinify.bench --output before.json
+    python -m django_inlinify.bench --compare before.json
+
+If DJANGO_SETTINGS_MODULE isn't set, the benchmark configures Django with an in-memory cache.
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+from django.conf import settings
+
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+        SECRET_KEY='django-inlinify-bench',
+    )
+
+from lxml import etree
+from django_inlinify.inlinify import Inlinify
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+# Version of the format of the JSON report
+REPORT_VERSION = 1
+
+# Phases of a transformation, in order, as recorded by the instrumentation (see
+# django_inlinify.instrumentation). Parsing the CSS is part of the plan phase of the first,
+# cold, transformation
+PHASES = ('load', 'plan', 'parse_html', 'match', 'merge', 'urls', 'serialize')
+
+BASE_URL = 'http://www.example.com/'
+
+COLORS = ('red', 'blue', 'green', 'gray', 'black', 'white', 'orange', 'purple')
+
+SIZES = (0, 1, 2, 4, 8, 12, 16, 24, 32)
+
+
+class Corpus(object):
+    """A set of documents transformed with the same CSS
+
+    Arguments:
+        - str name: the name of the corpus
+        - list documents: the HTML documents
+        - dict css_files: maps the names of the CSS files to their contents
+        - bool remote: whether the CSS files are served over HTTP
+    """
+
+    def __init__(self, name, documents, css_files, remote=False):
+        self.name = name
+        self.documents = documents
+        self.css_files = css_files
+        self.remote = remote
+
+
+def _document(body, head=''):
+    return ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Email</title>%s</head>'
+            '<body>%s</body></html>' % (head, body))
+
+
+def _email_css(rng, count):
+    """Returns typical email CSS: element, class and descendant selectors
+    """
+    rules = [
+        'body { margin: 0; padding: 0; font-family: Arial, sans-serif; color: #333333 }',
+        'table { border-collapse: collapse }',
+        'td { vertical-align: top }',
+        'a { color: #0066cc; text-decoration: none }',
+        'img { border: 0; display: block }',
+        'h1, h2, h3 { margin: 0 0 10px; font-weight: bold }',
+        '.wrapper { width: 600px; background-color: #ffffff }',
+        '.header td { padding: 20px; background-color: #222222 }',
+        '.footer p { font-size: 11px; color: #999999 }',
+        '.button a { display: inline-block; padding: 10px 20px; background: #ff6600 }',
+        '@media only screen and (max-width: 600px) { .wrapper { width: 100% !important } }',
+    ]
+    for index in range(count):
+        color = rng.choice(COLORS)
+        size = rng.choice(SIZES)
+        kind = index % 5
+        if kind == 0:
+            rules.append('.block-%d { color: %s; padding: %dpx }' % (index, color, size))
+        elif kind == 1:
+            rules.append('.block-%d td.cell { font-size: %dpx }' % (index - 1, size + 10))
+        elif kind == 2:
+            rules.append('#section-%d p { margin: %dpx 0 }' % (index, size))
+        elif kind == 3:
+            rules.append('table.grid-%d tr:nth-child(2n+1) td { background: %s }' % (index, color))
+        else:
+            rules.append('.block-%d > .title a:first-child { color: %s }' % (index - 4, color))
+    return '\n'.join(rules)
+
+
+def _email_body(rng, blocks):
+    """Returns the body of an email with the provided number of content blocks
+    """
+    parts = ['<table class="wrapper"><tr class="header"><td><a href="/"><img src="/logo.png">'
+             '</a></td></tr>']
+    for index in range(blocks):
+        parts.append(
+            '<tr><td id="section-%(i)d" class="block-%(i)d" style="line-height: 1.5">'
+            '<h2 class="title"><a href="/products/%(i)d">Product %(i)d</a></h2>'
+            '<table class="grid-%(i)d"><tr><td class="cell">%(word)s</td><td class="cell">'
+            '<img src="/images/%(i)d.jpg"></td></tr><tr><td class="cell">%(word)s</td>'
+            '<td class="cell button"><a href="#top">Buy</a></td></tr></table>'
+            '<p>%(text)s</p></td></tr>' % {
+                'i': index,
+                'word': rng.choice(COLORS),
+                'text': ' '.join(rng.choice(COLORS) for __ in range(30)),
+            }
+        )
+    parts.append('<tr class="footer"><td><p>Unsubscribe <a href="/unsubscribe">here</a></p>'
+                 '</td></tr></table>')
+    return ''.join(parts)
+
+
+def transactional_corpus(scale=1.0):
+    """Short emails, with a small stylesheet
+    """
+    rng = random.Random(1)
+    documents = [_document(_email_body(rng, 5)) for __ in range(max(1, int(20 * scale)))]
+    return Corpus('transactional', documents, {'transactional.css': _email_css(rng, 60)})
+
+
+def catalogue_corpus(scale=1.0):
+    """Long emails listing many products, with a medium stylesheet
+    """
+    rng = random.Random(2)
+    blocks = max(1, int(500 * scale))
+    documents = [_document(_email_body(rng, blocks)) for __ in range(2)]
+    return Corpus('catalogue', documents, {'catalogue.css': _email_css(rng, blocks)})
+
+
+def utility_corpus(scale=1.0):
+    """Emails using a few classes of a huge utility-class stylesheet
+    """
+    rng = random.Random(3)
+    rules = []
+    for index in range(max(1, int(4000 * scale))):
+        rules.append('.m-%d { margin: %dpx }' % (index, index % 64))
+        rules.append('.text-%s-%d { color: %s }' % (COLORS[index % 8], index, COLORS[index % 8]))
+        rules.append('.hover\\:text-%d:hover { color: %s }' % (index, COLORS[index % 8]))
+        rules.append('.sm-p-%d { padding: %dpx }' % (index, index % 32))
+        rules.append('ul.list-%d > li + li { border-top: 1px solid #eeeeee }' % index)
+    css = '\n'.join(rules)
+
+    documents = []
+    for __ in range(5):
+        used = rng.sample(range(max(1, int(4000 * scale))), min(100, max(1, int(4000 * scale))))
+        body = ''.join(
+            '<div class="m-%d text-%s-%d sm-p-%d"><ul class="list-%d"><li>a</li><li>b</li></ul>'
+            '</div>' % (i, COLORS[i % 8], i, i, i) for i in used
+        )
+        documents.append(_document(body))
+    return Corpus('utility', documents, {'utility.css': css})
+
+
+def style_blocks_corpus(scale=1.0):
+    """Emails with many <style> blocks, and no external stylesheet
+    """
+    rng = random.Random(4)
+    blocks = max(1, int(60 * scale))
+    documents = []
+    for __ in range(5):
+        head = ''.join('<style type="text/css">%s</style>' % _email_css(rng, 10)
+                       for __ in range(blocks))
+        documents.append(_document(_email_body(rng, 20), head))
+    return Corpus('style_blocks', documents, {})
+
+
+def remote_corpus(scale=1.0):
+    """Short emails, with stylesheets served over HTTP
+    """
+    rng = random.Random(5)
+    documents = [_document(_email_body(rng, 5)) for __ in range(max(1, int(20 * scale)))]
+    css_files = dict(('remote-%d.css' % index, _email_css(rng, 60)) for index in range(3))
+    return Corpus('remote', documents, css_files, remote=True)
+
+
+CORPORA = {
+    'transactional': transactional_corpus,
+    'catalogue': catalogue_corpus,
+    'utility': utility_corpus,
+    'style_blocks': style_blocks_corpus,
+    'remote': remote_corpus,
+}
+
+# Corpora whose CSS files are served over HTTP, which need `run(serve=...)`
+REMOTE = frozenset(['remote'])
+
+
+def _summarize(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        median = values[middle]
+    else:
+        median = (values[middle - 1] + values[middle]) / 2.0
+    return {
+        'min': values[0],
+        'median': median,
+        'mean': sum(values) / float(len(values)),
+    }
+
+
+def _peak_memory(inlinify, documents):
+    """Returns the peak memory allocated by Python while transforming the documents, in bytes,
+    or None if it can't be traced
+    """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        for html in documents:
+            inlinify.transform(html)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_corpus(corpus, iterations, css_paths):
+    """Benchmarks a corpus
+
+    Arguments:
+        - Corpus corpus: the corpus
+        - int iterations: the number of times the corpus is transformed
+        - list css_paths: the paths or URLs of the CSS files of the corpus
+
+    Returns:
+        a dictionary with the results
+    """
+    # the durations of the phases of every transformation are added to the ones of the
+    # current iteration
+    timings = dict.fromkeys(PHASES, 0.0)
+
+    def instrument(durations, counts):
+        for phase, duration in durations.items():
+            timings[phase] = timings.get(phase, 0.0) + duration
+
+    inlinify = Inlinify(css_files=css_paths, base_url=BASE_URL, instrument=instrument)
+    html_bytes = sum(len(html.encode('utf-8')) for html in corpus.documents)
+
+    # the first transformation loads and parses the CSS, and compiles the selectors
+    start = default_timer()
+    inlinify.transform(corpus.documents[0])
+    cold = default_timer() - start
+
+    phases = dict((phase, []) for phase in PHASES)
+    totals = []
+    for __ in range(iterations):
+        gc.collect()
+        timings.update(dict.fromkeys(PHASES, 0.0))
+        start = default_timer()
+        for html in corpus.documents:
+            inlinify.transform(html)
+        totals.append(default_timer() - start)
+        for phase in PHASES:
+            phases[phase].append(timings[phase])
+
+    transform = _summarize(totals)
+    return {
+        'documents': len(corpus.documents),
+        'html_bytes': html_bytes,
+        'css_bytes': sum(len(css.encode('utf-8')) for css in corpus.css_files.values()),
+        'cold': cold,
+        'phases': dict((phase, _summarize(values)) for phase, values in phases.items()),
+        'transform': transform,
+        'throughput': {
+            'documents_per_second': len(corpus.documents) / transform['median'],
+            'bytes_per_second': html_bytes / transform['median'],
+        },
+        'memory': {
+            'peak_bytes': _peak_memory(inlinify, corpus.documents),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        },
+    }
+
+
+def run(corpora=None, iterations=5, scale=1.0, serve=None):
+    """Runs the benchmark
+
+    Arguments:
+        - list corpora: the names of the corpora to run. Defaults to all of them, except the
+          remote ones without `serve`
+        - int iterations: the number of times every corpus is transformed
+        - float scale: multiplies the size of the corpora
+        - callable serve: serves the CSS files of the remote corpora over HTTP. Called with a
+          dictionary mapping the names of the files to their contents, it returns a context
+          manager giving a function that returns the URL of a file from its name
+
+    Returns:
+        the report, as a dictionary
+
+    Raises:
+        ValueError if a remote corpus is requested without `serve`
+    """
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('django-inlinify').version
+    except Exception:
+        version = None
+
+    report = {
+        'version': REPORT_VERSION,
+        'django_inlinify': version,
+        'python': platform.python_version(),
+        'lxml': '.'.join(str(part) for part in etree.LXML_VERSION),
+        'created': time.time(),
+        'iterations': iterations,
+        'scale': scale,
+        'corpora': {},
+    }
+
+    if corpora is None:
+        corpora = sorted(name for name in CORPORA if serve is not None or name not in REMOTE)
+    directory = tempfile.mkdtemp(prefix='django-inlinify-bench-')
+    try:
+        for name in corpora:
+            corpus = CORPORA[name](scale)
+            if corpus.remote:
+                if serve is None:
+                    raise ValueError('The %s corpus needs a server for its CSS files' % name)
+                with serve(corpus.css_files) as url:
+                    css_paths = [url(f) for f in sorted(corpus.css_files)]
+                    report['corpora'][name] = run_corpus(corpus, iterations, css_paths)
+            else:
+                css_paths = []
+                for f in sorted(corpus.css_files):
+                    path = os.path.join(directory, f)
+                    with open(path, 'wb') as css_file:
+                        css_file.write(corpus.css_files[f].encode('utf-8'))
+                    css_paths.append(path)
+                report['corpora'][name] = run_corpus(corpus, iterations, css_paths)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return report
+
+
+def compare(report, baseline, threshold=0.1):
+    """Compares the median timings of two reports
+
+    Arguments:
+        - dict report: the new report
+        - dict baseline: the report to compare with
+        - float threshold: relative slowdown above which a timing is a regression
+
+    Returns:
+        a list of (corpus, measure, old, new) tuples, one per regression
+    """
+    regressions = []
+    for name, results in sorted(report['corpora'].items()):
+        old_results = baseline.get('corpora', {}).get(name)
+        if not old_results:
+            continue
+        measures = [('transform', results['transform'], old_results.get('transform'))]
+        measures.extend(
+            (phase, timing, old_results.get('phases', {}).get(phase))
+            for phase, timing in sorted(results['phases'].items())
+        )
+        for measure, new, old in measures:
+            if old and new['median'] > old['median'] * (1 + threshold):
+                regressions.append((name, measure, old['median'], new['median']))
+    return regressions
+
+
+def format_report(report):
+    """Returns a human readable summary of a report
+    """
+    lines = ['%-14s %10s %10s %12s  %s' % ('corpus', 'cold (ms)', 'docs/s', 'peak (KiB)',
+                                          'phases (median ms)')]
+    for name, results in sorted(report['corpora'].items()):
+        peak = results['memory']['peak_bytes']
+        lines.append('%-14s %10.1f %10.1f %12s  %s' % (
+            name,
+            results['cold'] * 1000,
+            results['throughput']['documents_per_second'],
+            '%d' % (peak // 1024) if peak is not None else '-',
+            ' '.join('%s=%.1f' % (phase, results['phases'][phase]['median'] * 1000)
+                     for phase in PHASES),
+        ))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m django_inlinify.bench',
+                                     description='Benchmarks django-inlinify.')
+    parser.add_argument('--corpus', action='append', choices=sorted(set(CORPORA) - REMOTE),
+                        help='corpus to run, can be repeated. Defaults to all of them')
+    parser.add_argument('--iterations', type=int, default=5,
+                        help='number of times every corpus is transformed')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiplies the size of the corpora')
+    parser.add_argument('--output', help='file to write the JSON report to, instead of stdout')
+    parser.add_argument('--compare', metavar='REPORT',
+                        help='JSON report to compare with. Exits with status 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown considered a regression when comparing')
+    args = parser.parse_args(argv)
+
+    report = run(args.corpus, max(1, args.iterations), args.scale)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    print(format_report(report), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for name, measure, old, new in regressions:
+            print('Regression in %s/%s: %.1fms -> %.1fms' % (name, measure, old * 1000, new * 1000),
+                  file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded, thread-safe in-process cache. Once `maxsize` entries are stored, the least
+    recently used one is evicted. A `maxsize` of 0 disables the cache. If `ttl` is provided,
+    entries expire after that many seconds
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                __, expires = self._data[key]
+            except KeyError:
+                return False
+            return expires is None or expires >= time.time()
+
+    def get(self, key, default=None):
+        """Returns the value stored for `key`, or `default` if there isn't one
+        """
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # re-insert it so it becomes the most recently used entry
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Stores `value` for `key`, evicting the least recently used entries if needed. `ttl`
+        overrides the TTL of the cache for this entry
+        """
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Stores `value` for `key` only if there isn't a value stored for it already
+
+        Returns:
+            True if the value was stored, False otherwise
+        """
+        if self.maxsize <= 0:
+            return True
+        with self._lock:
+            if key in self._data:
+                __, expires = self._data[key]
+                if expires is None or expires >= time.time():
+                    return False
+            self._set(key, value, ttl)
+            return True
+
+    def _set(self, key, value, ttl):
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        self._data.pop(key, None)
+        self._data[key] = (value, expires)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def get_or_set(self, key, factory):
+        """Returns the value stored for `key`. If there isn't one, calls `factory` to build it
+        and stores the result
+        """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        """Removes the entry stored for `key`, if any
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Removes all the entries and resets the counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns a dictionary with the hit/miss counters and the current size of the cache
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class CacheCounters(object):
+    """Thread-safe hit and miss counters for the two tiers of a TieredCache
+    """
+
+    FIELDS = ('l1_hits', 'l1_misses', 'l2_hits', 'l2_misses')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def increment(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def reset(self):
+        with self._lock:
+            for field in self.FIELDS:
+                setattr(self, field, 0)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+class TieredCache(object):
+    """Cache made of an in-process LRUCache (L1) in front of a Django cache backend (L2). Values
+    found in the backend are copied to the in-process cache. Any of the two can be None.
+
+    It implements the subset of the Django cache API used by this app, so it can be used in
+    place of a Django cache backend
+    """
+
+    def __init__(self, local=None, backend=None, ttl=None, counters=None):
+        self.local = local
+        self.backend = backend
+        self.ttl = ttl
+        self.counters = counters if counters is not None else CacheCounters()
+
+    def get(self, key, default=None):
+        """Returns the value stored for `key`, or `default` if there isn't one
+        """
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                self.counters.increment('l1_hits')
+                return value
+            self.counters.increment('l1_misses')
+        if self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.counters.increment('l2_hits')
+                if self.local is not None:
+                    self.local.set(key, value, self._local_ttl(None))
+                return value
+            self.counters.increment('l2_misses')
+        return default
+
+    def set(self, key, value, timeout=None):
+        """Stores `value` for `key` in both caches. The in-process cache keeps it for the
+        timeout at most, so it doesn't outlive the value of the backend
+        """
+        timeout = timeout if timeout is not None else self.ttl
+        if self.local is not None:
+            self.local.set(key, value, self._local_ttl(timeout))
+        if self.backend is not None:
+            self.backend.set(key, value, timeout)
+
+    def _local_ttl(self, timeout):
+        """Returns the TTL of a value in the in-process cache: the shortest of the timeout, the
+        TTL of the tiered cache and the one of the in-process cache
+        """
+        ttls = [ttl for ttl in (timeout, self.ttl, self.local.ttl) if ttl]
+        return min(ttls) if ttls else None
+
+    def add(self, key, value, timeout=None):
+        """Stores `value` for `key` only if there isn't a value stored for it already in any of
+        the caches. Useful as a lock
+
+        Returns:
+            True if the value was stored, False otherwise
+        """
+        timeout = timeout if timeout is not None else self.ttl
+        if self.local is not None and not self.local.add(key, value, timeout):
+            return False
+        if self.backend is not None and not self.backend.add(key, value, timeout):
+            if self.local is not None:
+                self.local.delete(key)
+            return False
+        return True
+
+    def delete(self, key):
+        """Removes the value stored for `key` from both caches
+        """
+        if self.local is not None:
+            self.local.delete(key)
+        if self.backend is not None:
+            self.backend.delete(key)
@@ -1,12 +1,21 @@
+import os
 import re
 import logging
+import threading
+import time
+import zlib
+import cssselect
 import requests
-import cssutils
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from django.core.cache import get_cache, InvalidCacheBackendError
 from django.conf import settings
 from django_inlinify import defaults
-from StringIO import StringIO
-from contextlib import closing
+from django_inlinify.caching import CacheCounters, LRUCache, TieredCache
+from django_inlinify.tokenizer import StyleRule, TokenizerError, parse_stylesheet
+from django_inlinify.matching import build_token_index, get_selector_tokens
+from collections import namedtuple
 from hashlib import md5
 
 log = logging.getLogger('django_inlinify.css_loader')
@@ -17,6 +26,42 @@ DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME = getattr(
     defaults.DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME
 )
 
+DJANGO_INLINIFY_L1_CACHE_ENABLED = getattr(
+    settings,
+    'DJANGO_INLINIFY_L1_CACHE_ENABLED',
+    defaults.DJANGO_INLINIFY_L1_CACHE_ENABLED
+)
+
+DJANGO_INLINIFY_L1_CACHE_SIZE = getattr(
+    settings,
+    'DJANGO_INLINIFY_L1_CACHE_SIZE',
+    defaults.DJANGO_INLINIFY_L1_CACHE_SIZE
+)
+
+DJANGO_INLINIFY_L1_CACHE_TTL = getattr(
+    settings,
+    'DJANGO_INLINIFY_L1_CACHE_TTL',
+    defaults.DJANGO_INLINIFY_L1_CACHE_TTL
+)
+
+DJANGO_INLINIFY_L2_CACHE_ENABLED = getattr(
+    settings,
+    'DJANGO_INLINIFY_L2_CACHE_ENABLED',
+    defaults.DJANGO_INLINIFY_L2_CACHE_ENABLED
+)
+
+DJANGO_INLINIFY_CSSPARSER_BACKEND = getattr(
+    settings,
+    'DJANGO_INLINIFY_CSSPARSER_BACKEND',
+    defaults.DJANGO_INLINIFY_CSSPARSER_BACKEND
+)
+
+DJANGO_INLINIFY_CSSPARSER_FINGERPRINT = getattr(
+    settings,
+    'DJANGO_INLINIFY_CSSPARSER_FINGERPRINT',
+    defaults.DJANGO_INLINIFY_CSSPARSER_FINGERPRINT
+)
+
 # These pseudo selectors are ok to inline as they just filter the elements matched,
 # as apposed to things like :hover or :focus which can't be inlined.
 FILTER_PSEUDO_SELECTORS = [':last-child', ':first-child', ':nth-child']
@@ -27,30 +72,171 @@ ELEMENT_SELECTOR_REGEX = re.compile(r'(^|\s)\w')
 # Regular expression to find all pseudo selectors in a selector
 PSEUDO_SELECTOR_REGEX = re.compile(r':[a-z\-]+')
 
+# Bits of the packed specificity used by each of its components, from the most significant to the
+# least: ids, classes, elements, ruleset index and rule index. Larger values are clamped
+SPECIFICITY_BITS = (10, 10, 10, 16, 24)
 
-def load_cache(cache_name):
+# A parsed CSS rule:
+#   - specificity: the specificity of the selector, the index of the ruleset and the index of the
+#     rule, packed into an integer. Rules that should be applied later sort larger
+#   - selector: the CSS selector
+#   - bulk: the CSS declarations, as a string
+Rule = namedtuple('Rule', ['specificity', 'selector', 'bulk'])
+
+# The result of parsing a CSS string:
+#   - rules: the Rule records of the style rules that can be in-lined
+#   - leftover: the CSS that can't be in-lined, as a string
+#   - tokens: the ids, class names and tag names the selector of every rule requires, in the same
+#     order as the rules (see django_inlinify.matching.get_selector_tokens)
+#   - index: inverted index from the tokens to the positions of the rules that require them (see
+#     django_inlinify.matching.build_token_index)
+ParsedCSS = namedtuple('ParsedCSS', ['rules', 'leftover', 'tokens', 'index'])
+
+# Part of the keys of the cached rules, change it when the Rule or ParsedCSS records change
+RULE_FORMAT_VERSION = 3
+
+
+def selector_specificity(selector):
+    """Returns the specificity of a selector, as defined by the CSS specification
+
+    Returns:
+        a tuple with the number of ids, the number of classes, attributes and pseudo classes, and
+        the number of elements and pseudo elements
     """
-    Tries to load the specified cache. If there is any problem, falls back to the default one
+    try:
+        return cssselect.parse(selector)[0].specificity()
+    except cssselect.SelectorError:
+        # the selector won't match anything, crudely calculate the specificity
+        return (selector.count('#'), selector.count('.'),
+                len(ELEMENT_SELECTOR_REGEX.findall(selector)))
+
+
+def pack_specificity(*components):
+    """Packs the specificity of a selector, the index of its ruleset and the index of its rule
+    into a single integer, cheaper to sort than the tuple
+
+    Arguments:
+        - int components: the numbers of ids, classes and elements, the ruleset index and the
+          rule index
+
+    Returns:
+        an integer. Comparing two of them is the same as comparing the tuples
+    """
+    packed = 0
+    for bits, component in zip(SPECIFICITY_BITS, components):
+        packed = (packed << bits) | min(component, (1 << bits) - 1)
+    return packed
+
+
+# In-process (L1) caches and their counters, shared by all the caches loaded with the same
+# backend name
+_l1_caches = {}
+_l1_caches_lock = threading.Lock()
+
+
+def load_cache_backend(cache_name):
+    """
+    Tries to load the specified Django cache backend. If there is any problem, falls back to the
+    default one
 
     Arguments:
         - str cache_name: the name of the cache backend to use
 
     Returns:
-        cache object
+        a tuple with the name of the backend loaded and the backend
     """
     if not cache_name:
-        return get_cache(DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME)
+        cache_name = DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME
     try:
         cache = get_cache(cache_name)
     except InvalidCacheBackendError:
         log.error('The cache you specified (%s) is not defined in settings. Falling back to '
                   'the default one (%s)', cache_name, DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME)
-        cache = get_cache(DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME)
-    return cache
+        cache_name = DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME
+        cache = get_cache(cache_name)
+    return cache_name, cache
+
+
+def load_cache(cache_name):
+    """
+    Tries to load the specified cache. If there is any problem, falls back to the default one.
+
+    The cache has two tiers: an in-process cache (L1), shared by all the caches with the same
+    name, in front of the Django cache backend (L2). Any of them can be disabled in the settings
+
+    Arguments:
+        - str cache_name: the name of the cache backend to use
+
+    Returns:
+        a TieredCache instance
+    """
+    cache_name, backend = load_cache_backend(cache_name)
+    with _l1_caches_lock:
+        if cache_name not in _l1_caches:
+            _l1_caches[cache_name] = (
+                LRUCache(DJANGO_INLINIFY_L1_CACHE_SIZE, DJANGO_INLINIFY_L1_CACHE_TTL),
+                CacheCounters()
+            )
+        local, counters = _l1_caches[cache_name]
+    return TieredCache(local if DJANGO_INLINIFY_L1_CACHE_ENABLED else None,
+                       backend if DJANGO_INLINIFY_L2_CACHE_ENABLED else None,
+                       counters=counters)
+
+
+def cache_stats():
+    """Returns the hit and miss counters of the L1 and L2 tiers of the caches, by backend name
+    """
+    with _l1_caches_lock:
+        return dict((name, counters.as_dict()) for name, (__, counters) in _l1_caches.items())
+
+
+# Contents of local CSS files, keyed by path and stat signature (see `CSSLoader._stat`), and the
+# last signature seen for every path
+_local_files = LRUCache(DJANGO_INLINIFY_L1_CACHE_SIZE)
+_local_file_signatures = LRUCache(DJANGO_INLINIFY_L1_CACHE_SIZE)
+
+
+def _md5_fingerprint(data):
+    return md5(data).hexdigest()
+
+
+def _fast_fingerprint(data):
+    return '%08x%08x%x' % (zlib.crc32(data) & 0xffffffff, zlib.adler32(data) & 0xffffffff,
+                           len(data))
+
+
+FINGERPRINT_METHODS = {
+    'md5': _md5_fingerprint,
+    'fast': _fast_fingerprint,
+}
+
+
+def css_fingerprint(css_body, method=None):
+    """Returns a fingerprint of a CSS body, suitable for cache keys. Stylesheets loaded from
+    files get a cheaper fingerprint from the loader (see `CSSLoader.load_with_fingerprints`)
+
+    Arguments:
+        - str css_body: the CSS
+        - str method: `md5` or `fast`. Defaults to DJANGO_INLINIFY_CSSPARSER_FINGERPRINT
+
+    Returns:
+        the fingerprint, as an hexadecimal string
+    """
+    method = method or DJANGO_INLINIFY_CSSPARSER_FINGERPRINT
+    css_body = css_body or ''
+    data = css_body.encode('utf-8') if isinstance(css_body, type(u'')) else css_body
+    return FINGERPRINT_METHODS[method](data)
+
+
+def _is_url(filepath):
+    return filepath.startswith('http://') or filepath.startswith('https://')
 
 
 class CSSLoader(object):
-    """Class responsible for loading CSS files. Supports local and remote files
+    """Class responsible for loading CSS files. Supports local and remote files.
+
+    Remote files are fetched with a `requests.Session` shared by all the loaders, so connections
+    are reused. When several remote files are not cached, they are fetched concurrently
     """
 
     DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_PREFIX = getattr(settings,
@@ -60,28 +246,158 @@ class CSSLoader(object):
                                       'DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL',
                                       defaults.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL)
 
+    DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT',
+        defaults.DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT',
+        defaults.DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_RETRIES = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_RETRIES',
+        defaults.DJANGO_INLINIFY_CSSLOADER_RETRIES
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_POOL_SIZE = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_POOL_SIZE',
+        defaults.DJANGO_INLINIFY_CSSLOADER_POOL_SIZE
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS',
+        defaults.DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_STALE_TTL = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_STALE_TTL',
+        defaults.DJANGO_INLINIFY_CSSLOADER_STALE_TTL
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_LOCK_TTL = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_LOCK_TTL',
+        defaults.DJANGO_INLINIFY_CSSLOADER_LOCK_TTL
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_STAT_LOCAL_FILES = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_STAT_LOCAL_FILES',
+        defaults.DJANGO_INLINIFY_CSSLOADER_STAT_LOCAL_FILES
+    )
+
+    DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = getattr(
+        settings,
+        'DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL',
+        defaults.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL
+    )
+
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self, files, cache_backend=None):
         self.files = files if files else []
         self.cache = load_cache(cache_backend)
 
+    @classmethod
+    def get_session(cls):
+        """Returns the requests session shared by all the loaders, creating it if needed
+        """
+        with cls._session_lock:
+            if cls._session is None:
+                retries = Retry(total=cls.DJANGO_INLINIFY_CSSLOADER_RETRIES,
+                                backoff_factor=0.1,
+                                status_forcelist=(500, 502, 503, 504),
+                                raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=cls.DJANGO_INLINIFY_CSSLOADER_POOL_SIZE,
+                                      pool_maxsize=cls.DJANGO_INLINIFY_CSSLOADER_POOL_SIZE,
+                                      max_retries=retries)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                cls._session = session
+            return cls._session
+
     def _get_cache_key(self, filepath):
         return '%s_filecontents_%s_' % (self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_PREFIX, filepath)
 
-    def _get_cached_contents(self, filename):
-        return self.cache.get(self._get_cache_key(filename))
+    def _get_lock_key(self, filepath):
+        return '%s_filelock_%s_' % (self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_PREFIX, filepath)
 
-    def _get_file_contents_from_url(self, filepath):
-        """Reads a remote file and returns its contents
+    def _get_cached(self, filename):
+        """Returns the cached contents of a file, if any, and its fingerprint (see
+        `load_with_fingerprints`). Remote files are cached along with their validators (see
+        `_make_url_entry`). If a remote file is stale, its contents are still returned while it
+        is revalidated in the background
+
+        Returns:
+            a (contents, fingerprint) tuple. Any of them can be None
         """
-        response = requests.get(filepath, stream=True)
+        if self._stats_local_files(filename):
+            signature = self._stat(filename)
+            return (_local_files.get((filename, signature)),
+                    self._local_fingerprint(filename, signature))
+        cached = self.cache.get(self._get_cache_key(filename))
+        if isinstance(cached, dict):
+            if cached['expires'] < time.time():
+                self._revalidate(filename, cached)
+            return cached['contents'], self._url_fingerprint(filename, cached)
+        return cached, None
+
+    def _get_cached_contents(self, filename):
+        return self._get_cached(filename)[0]
+
+    def _url_fingerprint(self, filepath, entry):
+        validator = entry.get('etag') or entry.get('last_modified')
+        if not validator:
+            return None
+        return 'url:%s:%s' % (filepath, validator)
+
+    def _local_fingerprint(self, filepath, signature):
+        if signature is None:
+            return None
+        return 'file:%s:%r' % (filepath, signature)
+
+    def _request(self, filepath, headers=None):
+        return self.get_session().get(
+            filepath,
+            headers=headers,
+            timeout=(self.DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT,
+                     self.DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT)
+        )
+
+    def _make_url_entry(self, response):
+        """Returns the cache entry for a remote file: its contents, its validators and the time
+        it has to be revalidated at
+        """
+        return {
+            'contents': response.content,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'expires': time.time() + self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL,
+        }
+
+    def _fetch_url_entry(self, filepath):
+        """Reads a remote file and returns its cache entry
+        """
+        response = self._request(filepath)
         if response.status_code != 200:
             raise ValueError('The CSS file you specified (%s) does not exist. Response (%s - %s)' %
                              (filepath, response.status_code, response.reason))
+        return self._make_url_entry(response)
 
-        with closing(StringIO()) as contents:
-            for chunk in response.iter_content(512):
-                contents.write(chunk)
-        return contents.getvalue()
+    def _get_file_contents_from_url(self, filepath):
+        """Reads a remote file and returns its contents
+        """
+        return self._fetch_url_entry(filepath)['contents']
 
     def _get_file_contents_from_local_file(self, filepath):
         """Reads a file stored locally and returns its contents
@@ -99,23 +415,168 @@ class CSSLoader(object):
         Returns:
             the contents of the file
         """
-        cached = self._get_cached_contents(filepath)
-        if cached:
-            return cached
-        if filepath.startswith('http://') or filepath.startswith('https://'):
-            contents = self._get_file_contents_from_url(filepath)
-        else:
+        return self._read(filepath)[0]
+
+    def _read(self, filepath):
+        """Reads the contents of the file located in the provided filepath, using the cached
+        contents if possible
+
+        Returns:
+            a (contents, fingerprint) tuple. The fingerprint can be None
+        """
+        contents, fingerprint = self._get_cached(filepath)
+        if contents:
+            return contents, fingerprint
+        return self._read_missing(filepath)
+
+    def _read_missing(self, filepath):
+        """Reads the contents of a file that isn't cached, and caches them
+
+        Returns:
+            a (contents, fingerprint) tuple. The fingerprint can be None
+        """
+        if _is_url(filepath):
+            entry = self._fetch_url_entry(filepath)
+            self._set_cached_url_entry(filepath, entry)
+            return entry['contents'], self._url_fingerprint(filepath, entry)
+        if self._stats_local_files(filepath):
+            # local files are kept in memory, and read again when they change
+            signature = self._stat(filepath)
             contents = self._get_file_contents_from_local_file(filepath)
+            _local_files.set((filepath, signature), contents)
+            return contents, self._local_fingerprint(filepath, signature)
+        contents = self._get_file_contents_from_local_file(filepath)
+        self._set_cached_contents(filepath, contents)
+        return contents, None
+
+    def _stats_local_files(self, filepath):
+        return self.DJANGO_INLINIFY_CSSLOADER_STAT_LOCAL_FILES and not _is_url(filepath)
 
+    def _stat(self, filepath):
+        """Returns the signature of a local file: its modification time, size and inode. The
+        file is checked at most once every DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL seconds
+
+        Returns:
+            the signature, or None if the file can't be read
+        """
+        interval = self.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL
+        if interval > 0:
+            signature = _local_file_signatures.get(filepath)
+            if signature is not None:
+                return signature
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        signature = (stat.st_mtime, stat.st_size, stat.st_ino)
+        if interval > 0:
+            _local_file_signatures.set(filepath, signature, interval)
+        return signature
+
+    def _set_cached_contents(self, filepath, contents):
         self.cache.set(self._get_cache_key(filepath),
                        contents,
                        self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL)
 
-        return contents
+    def _set_cached_url_entry(self, filepath, entry):
+        # stale entries are kept around so they can be served while they are revalidated
+        self.cache.set(self._get_cache_key(filepath),
+                       entry,
+                       self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL +
+                       self.DJANGO_INLINIFY_CSSLOADER_STALE_TTL)
+
+    def _revalidate(self, filepath, entry):
+        """Revalidates a stale remote file in a background thread, unless another thread or
+        process is already doing it
+
+        Returns:
+            the thread, or None if the file is already being revalidated
+        """
+        lock_key = self._get_lock_key(filepath)
+        if not self.cache.add(lock_key, 1, self.DJANGO_INLINIFY_CSSLOADER_LOCK_TTL):
+            return None
+        thread = threading.Thread(target=self._refresh, args=(filepath, entry, lock_key))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _refresh(self, filepath, entry, lock_key):
+        """Makes a conditional request for a stale remote file and updates its cache entry
+        """
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self._request(filepath, headers)
+            if response.status_code == 304:
+                entry = dict(entry)
+                entry['expires'] = time.time() + self.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL
+            elif response.status_code == 200:
+                entry = self._make_url_entry(response)
+            else:
+                log.warning('Could not revalidate the CSS file %s. Response (%s - %s)',
+                            filepath, response.status_code, response.reason)
+                return
+            self._set_cached_url_entry(filepath, entry)
+        except Exception:
+            log.exception('Could not revalidate the CSS file %s', filepath)
+        finally:
+            self.cache.delete(lock_key)
+
+    def _fetch_urls(self, urls):
+        """Fetches the provided remote files concurrently and caches them
+
+        Returns:
+            a list with the (contents, fingerprint) tuples of the files, in the same order
+        """
+        pool = ThreadPool(min(len(urls), self.DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS))
+        try:
+            entries = pool.map(self._fetch_url_entry, urls)
+        finally:
+            pool.terminate()
+        for url, entry in zip(urls, entries):
+            self._set_cached_url_entry(url, entry)
+        return [
+            (entry['contents'], self._url_fingerprint(url, entry))
+            for url, entry in zip(urls, entries)
+        ]
+
+    def load_with_fingerprints(self):
+        """Reads all the files. Along with the contents of every file, returns a fingerprint
+        that changes when the file changes, so the contents don't need to be hashed: the URL and
+        ETag (or Last-Modified) for remote files, and the path and stat signature for local files.
+        The fingerprint is None when there isn't a cheap one
+
+        Returns:
+            a list with the (contents, fingerprint) tuples of the files, in the same order as the
+            files
+        """
+        sources = [self._get_cached(f) for f in self.files]
+        missing_urls = [
+            f for f, (contents, __) in zip(self.files, sources) if not contents and _is_url(f)
+        ]
+        fetched = {}
+        if len(missing_urls) > 1 and self.DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS > 1:
+            fetched = dict(zip(missing_urls, self._fetch_urls(missing_urls)))
+        for index, f in enumerate(self.files):
+            if f in fetched:
+                sources[index] = fetched[f]
+            elif not sources[index][0]:
+                sources[index] = self._read_missing(f)
+        return sources
+
+    def load(self):
+        """Reads all the files
+
+        Returns:
+            a list with the contents of the files, in the same order as the files
+        """
+        return [contents for contents, __ in self.load_with_fingerprints()]
 
     def __iter__(self):
-        for f in self.files:
-            yield self._read_file(f)
+        return iter(self.load())
 
 
 class CSSParser(object):
@@ -140,28 +601,67 @@ class CSSParser(object):
         defaults.DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING
     )
 
+    DJANGO_INLINIFY_CSSPARSER_BACKEND = DJANGO_INLINIFY_CSSPARSER_BACKEND
+
     def __init__(self, cache_backend=None, **kwargs):
         self.cache = load_cache(cache_backend)
         self.include_star_selectors = kwargs.get('include_star_selectors', False)
 
-    def _get_cache_key(self, css_body, index):
-        h = md5(str(css_body)).hexdigest()
-        return '%s_contents_%s_%s' % (self.DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_PREFIX, h, index)
+    def _get_cache_key(self, css_body, index, fingerprint=None):
+        if fingerprint is None:
+            h = css_fingerprint(css_body)
+        else:
+            # fingerprints given by the loader contain paths and URLs, keep the key short
+            h = md5(fingerprint.encode('utf-8')).hexdigest()
+        # the parsed rules depend on the options, and on the format of the Rule records
+        star = 'star_' if self.include_star_selectors else ''
+        return '%s_contents_v%s_%s%s_%s' % (self.DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_PREFIX,
+                                            RULE_FORMAT_VERSION, star, h, index)
 
-    def _get_cached_css(self, css_body, index):
-        return self.cache.get(self._get_cache_key(css_body, index))
+    def _get_cached_css(self, css_body, index, fingerprint=None):
+        return self.cache.get(self._get_cache_key(css_body, index, fingerprint))
 
-    def parse(self, css_body, ruleset_index):
+    def parse(self, css_body, ruleset_index, fingerprint=None):
         """Extracts the rules from a CSS string. If they are cached, return those. Otherwise,
         extract them and cache them
+
+        Arguments:
+            - str css_body: the CSS
+            - int ruleset_index: the position of the CSS among the stylesheets being applied
+            - str fingerprint: a string that identifies the contents of the CSS, like the one
+              returned by CSSLoader.load_with_fingerprints. If not provided, the CSS is hashed
+
+        Returns:
+            a tuple with the list of rules and the CSS that can't be in-lined
         """
-        cached = self._get_cached_css(css_body, ruleset_index)
+        parsed = self.parse_indexed(css_body, ruleset_index, fingerprint)
+        return parsed.rules, parsed.leftover
+
+    def parse_indexed(self, css_body, ruleset_index, fingerprint=None):
+        """Like `parse`, but also returns the tokens required by every rule, and an inverted
+        index from the tokens to the rules, to find the rules that can match a document without
+        going through all of them. They are cached with the rules
+
+        Returns:
+            a ParsedCSS record
+        """
+        return self._parse_indexed(css_body, ruleset_index, fingerprint)[0]
+
+    def _parse_indexed(self, css_body, ruleset_index, fingerprint=None):
+        """Like `parse_indexed`
+
+        Returns:
+            a tuple with the ParsedCSS record, and whether it was cached
+        """
+        key = self._get_cache_key(css_body, ruleset_index, fingerprint)
+        cached = self.cache.get(key)
         if cached:
-            return cached
-        parsed = self._parse_style_rules(css_body, ruleset_index)
-        self.cache.set(self._get_cache_key(css_body, ruleset_index), parsed,
-                       self.DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_TTL)
-        return parsed
+            return cached, True
+        rules, leftover = self._parse_style_rules(css_body, ruleset_index)
+        tokens = tuple(get_selector_tokens(rule.selector) for rule in rules)
+        parsed = ParsedCSS(rules, leftover, tokens, build_token_index(tokens))
+        self.cache.set(key, parsed, self.DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_TTL)
+        return parsed, False
 
     def _parse_style_rules(self, css_body, ruleset_index):
         """Given a CSS string, extracts all its rules from it
@@ -174,27 +674,14 @@ class CSSParser(object):
         if not css_body:
             return rules, leftover
 
-        sheet = cssutils.parseString(css_body, validate=False)
-        for rule in sheet:
-            # handle media and font rules
-            if rule.type in (rule.MEDIA_RULE, rule.FONT_FACE_RULE):
+        for rule in self._get_style_rules(css_body):
+            # media and font rules
+            if not isinstance(rule, StyleRule):
                 leftover.append(rule)
                 continue
 
-            # only proceed for things we recognize
-            if rule.type != rule.STYLE_RULE:
-                continue
-
-            bulk = ';'.join(
-                u'{0}:{1}'.format(key, rule.style[key])
-                for key in rule.style.keys()
-            )
-            selectors = (
-                x.strip()
-                for x in rule.selectorText.split(',')
-                if x.strip() and not x.strip().startswith('@')
-            )
-            for selector in selectors:
+            bulk = ';'.join(u'{0}:{1}'.format(key, value) for key, value in rule.declarations)
+            for selector in rule.selectors:
                 pseudos = [x.group(0) for x in PSEUDO_SELECTOR_REGEX.finditer(selector)]
                 if any(pseudo not in FILTER_PSEUDO_SELECTORS for pseudo in pseudos):
                     leftover.append((selector, bulk))
@@ -202,14 +689,9 @@ class CSSParser(object):
                 elif '*' in selector and not self.include_star_selectors:
                     continue
 
-                # Crudely calculate specificity
-                id_count = selector.count('#')
-                class_count = selector.count('.')
-                element_count = len(ELEMENT_SELECTOR_REGEX.findall(selector))
-
-                specificity = (id_count, class_count, element_count, ruleset_index, rule_index)
-
-                rules.append((specificity, selector, bulk))
+                ids, classes, elements = selector_specificity(selector)
+                specificity = pack_specificity(ids, classes, elements, ruleset_index, rule_index)
+                rules.append(Rule(specificity, selector, bulk))
                 rule_index += 1
 
         # we want to return a string, not those crazy CSSRule objects.
@@ -218,6 +700,57 @@ class CSSParser(object):
 
         return rules, leftover
 
+    def _get_style_rules(self, css_body):
+        """Splits a CSS string into its rules, using the configured backend. The `fast` backend
+        tokenizes the CSS itself, and only uses cssutils for the media and font rules, and for the
+        rules it can't parse. If the CSS isn't well formed, cssutils parses all of it
+
+        Returns:
+            a list of StyleRule objects and cssutils media and font rules, in the same order as in
+            the CSS
+        """
+        if self.DJANGO_INLINIFY_CSSPARSER_BACKEND == 'fast':
+            try:
+                raw_rules = list(parse_stylesheet(css_body))
+            except TokenizerError as e:
+                log.debug('Parsing CSS with cssutils: %s', e)
+            else:
+                rules = []
+                for rule in raw_rules:
+                    if isinstance(rule, StyleRule):
+                        rules.append(rule)
+                    elif rule.name in (None, 'media', 'font-face'):
+                        rules.extend(self._get_cssutils_rules(rule.text))
+                return rules
+        return self._get_cssutils_rules(css_body)
+
+    def _get_cssutils_rules(self, css_body):
+        """Splits a CSS string into its rules with cssutils
+
+        Returns:
+            a list of StyleRule objects and cssutils media and font rules, in the same order as in
+            the CSS
+        """
+        # cssutils is slow to import, only import it when needed
+        import cssutils
+
+        rules = []
+        for rule in cssutils.parseString(css_body, validate=False):
+            # handle media and font rules
+            if rule.type in (rule.MEDIA_RULE, rule.FONT_FACE_RULE):
+                rules.append(rule)
+
+            # only proceed for things we recognize
+            elif rule.type == rule.STYLE_RULE:
+                selectors = [
+                    x.strip()
+                    for x in rule.selectorText.split(',')
+                    if x.strip() and not x.strip().startswith('@')
+                ]
+                declarations = [(key, rule.style[key]) for key in rule.style.keys()]
+                rules.append(StyleRule(selectors, declarations))
+        return rules
+
     def _make_important(self, bulk):
         """
         Marks every property in a string as `!important`
@@ -244,6 +777,7 @@ class CSSParser(object):
             elif item.type == item.FONT_FACE_RULE:
                 lines.append(item.cssText)
             elif item.type == item.MEDIA_RULE:
+                import cssutils
                 for rule in item.cssRules:
                     if isinstance(rule, cssutils.css.csscomment.CSSComment):
                         continue
@@ -266,7 +800,19 @@ class CSSParser(object):
         old_style_dict = self._css_string_to_dict(old_style)
         style_dict = self._css_string_to_dict(new_style)
         old_style_dict.update(style_dict)
-        return '; '.join(['%s:%s' % (k, v) for k, v in sorted(old_style_dict.iteritems())])
+        return self._dict_to_css_string(old_style_dict)
+
+    def _dict_to_css_string(self, css_dict):
+        """Given a dictionary of CSS properties and their values, creates a CSS string out of it,
+        sorted by property name
+
+        Arguments:
+            - dict css_dict: the CSS properties
+
+        Returns:
+            the CSS style string
+        """
+        return '; '.join(['%s:%s' % (k, v) for k, v in sorted(css_dict.items())])
 
     def _unbalanced(self, text):
         """
@@ -332,12 +878,25 @@ class CSSParser(object):
         if style_content.count('}') and style_content.count('{') == style_content.count('}'):
             style_content = style_content.split('}')[0][1:]
 
-        mappings = self.DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING
-
-        for key, value in [
+        self.css_declarations_to_basic_html_attributes(element, [
             x.split(':')
             for x in style_content.split(';') if len(x.split(':')) == 2
-        ]:
+        ])
+
+    def css_declarations_to_basic_html_attributes(self, element, declarations):
+        """Given an element and CSS declarations like [('background-color', 'red')] turn some of
+        them into HTML attributes
+
+        Arguments:
+            - lxml.etree.Element element: the element to update
+            - list declarations: (property, value) pairs
+        """
+        mappings = self.DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING
+
+        for key, value in declarations:
+            if ':' in value:
+                # values such as `url(http://...)` are never turned into attributes
+                continue
             try:
                 new_key, new_value = mappings.get(key.strip())
             except TypeError:
@@ -1,10 +1,24 @@
 # The default cache backend to use
 DJANGO_INLINIFY_DEFAULT_CACHE_BACKEND_NAME = 'default'
 
+# In-process (L1) cache in front of the cache backend (L2) for loaded and parsed CSS
+DJANGO_INLINIFY_L1_CACHE_ENABLED = True
+DJANGO_INLINIFY_L1_CACHE_SIZE = 500
+DJANGO_INLINIFY_L1_CACHE_TTL = 60 * 5
+DJANGO_INLINIFY_L2_CACHE_ENABLED = True
+
 # CSS Parser default settings
 DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_PREFIX = 'django_inlinify_parsed_css_'
 DJANGO_INLINIFY_CSSPARSER_CACHE_KEY_TTL = 60 * 60 * 24
 
+# Backend used to split CSS into rules: `fast`, a tokenizer that falls back to cssutils for the
+# CSS it can't handle, or `cssutils`. Both return the same rules
+DJANGO_INLINIFY_CSSPARSER_BACKEND = 'fast'
+
+# Hash used to fingerprint CSS bodies for the parser cache keys: `md5`, or `fast` for a
+# non-cryptographic crc32/adler32 based one
+DJANGO_INLINIFY_CSSPARSER_FINGERPRINT = 'md5'
+
 DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING = {
     'text-align': ('align', lambda value: value.strip()),
     'vertical-align': ('valign', lambda value: value.strip()),
@@ -18,3 +32,46 @@ DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING = {
 # CSS Loader default settings
 DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_PREFIX = 'django_inlinify_css_contents_'
 DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL = 60 * 60 * 24
+
+# Maximum number of compiled CSS selectors kept in memory
+DJANGO_INLINIFY_SELECTOR_CACHE_SIZE = 1000
+
+# Maximum number of sets of stylesheets whose sorted and indexed rules each Inlinify instance
+# keeps in memory for `transform`
+DJANGO_INLINIFY_PLAN_CACHE_SIZE = 16
+
+# Output cache default settings. The output cache is only used by Inlinify instances created
+# with `cache_output=True`. The in-process cache is disabled if its size is 0, and the backend
+# cache is disabled if its name is None
+DJANGO_INLINIFY_OUTPUT_CACHE_SIZE = 1000
+DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME = None
+DJANGO_INLINIFY_OUTPUT_CACHE_KEY_PREFIX = 'django_inlinify_output_'
+DJANGO_INLINIFY_OUTPUT_CACHE_KEY_TTL = 60 * 60 * 24
+
+# Remote CSS files are fetched with a shared connection pool of this size, with these timeouts
+# (in seconds) and number of retries
+DJANGO_INLINIFY_CSSLOADER_CONNECT_TIMEOUT = 5
+DJANGO_INLINIFY_CSSLOADER_READ_TIMEOUT = 10
+DJANGO_INLINIFY_CSSLOADER_RETRIES = 2
+DJANGO_INLINIFY_CSSLOADER_POOL_SIZE = 10
+
+# Maximum number of remote CSS files fetched at the same time
+DJANGO_INLINIFY_CSSLOADER_MAX_WORKERS = 4
+
+# Once DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL expires, remote CSS files are revalidated in the
+# background, using their ETag and Last-Modified headers. Meanwhile, the stale copy is served for
+# up to this many seconds
+DJANGO_INLINIFY_CSSLOADER_STALE_TTL = 60 * 60 * 24 * 7
+
+# Maximum time a process can hold the lock to revalidate a remote CSS file
+DJANGO_INLINIFY_CSSLOADER_LOCK_TTL = 30
+
+# Local CSS files are kept in memory and read again as soon as their modification time, size or
+# inode change. Files are checked at most once every DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL
+# seconds. When disabled, local files are cached like remote ones
+DJANGO_INLINIFY_CSSLOADER_STAT_LOCAL_FILES = True
+DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = 1
+
+# Maximum number of documents transformed at the same time by `Inlinify.atransform`, in a thread
+# pool shared by the whole process
+DJANGO_INLINIFY_ASYNC_MAX_WORKERS = 4
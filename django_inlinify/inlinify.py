@@ -1,7 +1,16 @@
 from __future__ import absolute_import, unicode_literals
+import multiprocessing
 import operator
+import pickle
 import re
 import sys
+import threading
+import traceback
+from collections import deque, namedtuple
+from hashlib import md5
+from io import BytesIO
+from itertools import islice
+from timeit import default_timer
 if sys.version_info >= (3, ):  # pragma: no cover
     # As in, Python 3
     from urllib.parse import urljoin
@@ -10,16 +19,382 @@ else:  # Python 2
     from urlparse import urljoin
     STR_TYPE = basestring
 
+from django.conf import settings
 from lxml import etree
-from lxml.cssselect import CSSSelector
-from django_inlinify.css_tools import CSSLoader, CSSParser
+from django_inlinify import defaults
+from django_inlinify.caching import LRUCache, TieredCache
+from django_inlinify.css_tools import CSSLoader, CSSParser, css_fingerprint, load_cache_backend
+from django_inlinify.instrumentation import NULL_RECORDER, Recorder
+from django_inlinify.matching import (LINK_ATTRIBUTES, DocumentIndex, build_token_index,
+                                      get_matcher, get_selector, get_selector_tokens,
+                                      matcher_cache, selector_cache)
+from django_inlinify.signals import transform_finished
 
-__all__ = ['Inlinify']
+__all__ = ['Inlinify', 'InlinePlan', 'TransformError', 'get_matcher', 'get_selector',
+           'matcher_cache', 'output_cache', 'selector_cache']
 
+DJANGO_INLINIFY_PLAN_CACHE_SIZE = getattr(
+    settings,
+    'DJANGO_INLINIFY_PLAN_CACHE_SIZE',
+    defaults.DJANGO_INLINIFY_PLAN_CACHE_SIZE
+)
+
+DJANGO_INLINIFY_OUTPUT_CACHE_SIZE = getattr(
+    settings,
+    'DJANGO_INLINIFY_OUTPUT_CACHE_SIZE',
+    defaults.DJANGO_INLINIFY_OUTPUT_CACHE_SIZE
+)
+
+DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME = getattr(
+    settings,
+    'DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME',
+    defaults.DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME
+)
+
+DJANGO_INLINIFY_OUTPUT_CACHE_KEY_PREFIX = getattr(
+    settings,
+    'DJANGO_INLINIFY_OUTPUT_CACHE_KEY_PREFIX',
+    defaults.DJANGO_INLINIFY_OUTPUT_CACHE_KEY_PREFIX
+)
+
+DJANGO_INLINIFY_OUTPUT_CACHE_KEY_TTL = getattr(
+    settings,
+    'DJANGO_INLINIFY_OUTPUT_CACHE_KEY_TTL',
+    defaults.DJANGO_INLINIFY_OUTPUT_CACHE_KEY_TTL
+)
 
-FIRST_SELECTOR_PART_REGEX = re.compile('^(\.|#|)([\w\-]+)')
 CDATA_REGEX = re.compile(r'<!\[CDATA\[(.*?)\]\]\>', re.DOTALL)
 
+CDATA_START = b'<![CDATA['
+CDATA_END = b']]>'
+
+# Options of `transform` the incremental writer supports. Other lxml.etree.tostring options are
+# serialized with tostring
+WRITER_OPTIONS = frozenset(['method', 'pretty_print', 'encoding'])
+
+# Approximate size of the chunks returned by `iter_chunks`
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# lxml parsers can be reused, but not shared between threads
+_parsers = threading.local()
+
+# Transformed documents, shared by every Inlinify instance in the process that caches its output
+output_cache = LRUCache(DJANGO_INLINIFY_OUTPUT_CACHE_SIZE)
+
+
+def _get_callable_key(func):
+    """Returns a string identifying a callable in every process: the dotted path of module-level
+    functions, or None for the ones without a stable path, such as lambdas, closures and bound
+    methods
+    """
+    name = getattr(func, '__qualname__', None) or getattr(func, '__name__', None)
+    module = sys.modules.get(getattr(func, '__module__', None) or '')
+    if not name or module is None:
+        return None
+    target = module
+    for part in name.split('.'):
+        target = getattr(target, part, None)
+    if target is not func:
+        return None
+    return '{0}.{1}'.format(module.__name__, name)
+
+
+def _get_parser(method):
+    """Returns the lxml parser of the current thread for the provided serialization method
+    """
+    parsers = getattr(_parsers, 'parsers', None)
+    if parsers is None:
+        parsers = _parsers.parsers = {}
+    parser = parsers.get(method)
+    if parser is None:
+        if method == 'html':
+            parser = etree.HTMLParser()
+        elif method == 'xml':
+            parser = etree.XMLParser(ns_clean=False, resolve_entities=False)
+        parsers[method] = parser
+    return parser
+
+
+def _get_root(tree):
+    """Returns the root element of an lxml tree, or the element itself
+    """
+    if isinstance(tree, etree._ElementTree):
+        return tree.getroot()
+    return tree
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _fingerprint(css_sources):
+    """Returns a string identifying the contents of the provided (CSS string, fingerprint)
+    tuples. CSS strings without a fingerprint are hashed
+    """
+    h = md5()
+    for css_body, fingerprint in css_sources:
+        h.update(_to_bytes(fingerprint or css_fingerprint(css_body or '')))
+        h.update(b'\0')
+    return h.hexdigest()
+
+# A CSS rule ready to be applied:
+#   - specificity: the packed specificity used to sort the rules (see css_tools.Rule)
+#   - selector: the CSS selector
+#   - bulk: the CSS declarations, as a string
+#   - matcher: the compiled selector (see django_inlinify.matching), if already known
+#   - tokens: the ids, class names and tag names the selector requires, used to skip the rules
+#     that can't match the HTML (see django_inlinify.matching.get_selector_tokens)
+#   - declarations: the CSS declarations, as a tuple of (property, value) pairs
+PlanRule = namedtuple('PlanRule', ['specificity', 'selector', 'bulk', 'matcher', 'tokens',
+                                   'declarations'])
+
+
+class InlinePlan(object):
+    """A stylesheet compiled with `Inlinify.compile`, ready to be applied to many HTML documents.
+
+    The plan holds the sorted rules, the compiled version of every selector, the parsed
+    declarations and the CSS that can't be in-lined, so transforming an HTML document only
+    requires the DOM work. Plans are immutable and can be pickled, to share them with worker
+    processes
+    """
+
+    __slots__ = ('_options', '_rules', '_leftovers', '_fingerprint', '_url_rewriter', '_inlinify',
+                 '_token_index')
+
+    def __init__(self, options, rules, leftovers, fingerprint=None, url_rewriter=None):
+        self._options = dict(options)
+        self._rules = tuple(rules)
+        self._leftovers = tuple(leftovers)
+        self._fingerprint = fingerprint
+        self._url_rewriter = url_rewriter
+        self._inlinify = None
+        self._token_index = build_token_index(rule.tokens for rule in self._rules)
+
+    def __getstate__(self):
+        url_rewriter = self._url_rewriter
+        if url_rewriter is not None and _get_callable_key(url_rewriter) is None:
+            # fail with a helpful message instead of the one of the pickled lambda or closure
+            try:
+                pickle.dumps(url_rewriter, pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                raise pickle.PicklingError('The url_rewriter of a plan sent to other processes '
+                                           'must be a module-level function')
+        return self._options, self._rules, self._leftovers, self._fingerprint, url_rewriter
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def method(self):
+        return self._options['method']
+
+    @property
+    def rules(self):
+        return self._rules
+
+    @property
+    def leftovers(self):
+        return self._leftovers
+
+    @property
+    def fingerprint(self):
+        """String identifying the CSS the plan was compiled from
+        """
+        return self._fingerprint
+
+    @property
+    def token_index(self):
+        """Inverted index from the tokens required by the rules to their positions (see
+        django_inlinify.matching.build_token_index)
+        """
+        return self._token_index
+
+    def _get_inlinify(self):
+        """Returns the Inlinify instance applying the plan, creating it after unpickling
+        """
+        if self._inlinify is None:
+            self._inlinify = Inlinify(url_rewriter=self._url_rewriter, **self._options)
+        return self._inlinify
+
+    def transform(self, html, pretty_print=True, **kwargs):
+        """Transform the plan's CSS into inline styles and inject them in the provided html.
+        Any <style> block in the html is processed too
+        """
+        inlinify = self._get_inlinify()
+        recorder = inlinify._get_recorder()
+
+        cache_key = None
+        if inlinify.output_cache is not None:
+            cache_key = inlinify._get_output_cache_key(html, self._fingerprint, pretty_print,
+                                                       kwargs)
+            cached = inlinify.output_cache.get(cache_key)
+            if cached is not None:
+                recorder.count('output_cache_hits')
+                inlinify._emit(recorder)
+                return cached
+            recorder.count('output_cache_misses')
+
+        html = inlinify._transform(html, self, pretty_print, kwargs, recorder)
+        if cache_key:
+            inlinify.output_cache.set(cache_key, html)
+        inlinify._emit(recorder)
+        return html
+
+    def transform_tree(self, tree):
+        """Like `transform`, but works in place on an already parsed document
+
+        Returns:
+            the same tree
+        """
+        inlinify = self._get_inlinify()
+        recorder = inlinify._get_recorder()
+        inlinify._inline_tree(_get_root(tree), self, recorder)
+        inlinify._emit(recorder)
+        return tree
+
+    def transform_to(self, html, fileobj, pretty_print=True, encoding='utf-8'):
+        """Like `transform`, but writes the resulting document to a file-like object, as bytes.
+        The output cache isn't used
+        """
+        inlinify = self._get_inlinify()
+        recorder = inlinify._get_recorder()
+        root = inlinify._inline(html, self, recorder)
+        started = recorder.start()
+        inlinify._write(root, fileobj, pretty_print, encoding)
+        recorder.stop('serialize', started)
+        inlinify._emit(recorder)
+
+    def iter_chunks(self, html, chunk_size=DEFAULT_CHUNK_SIZE, pretty_print=True,
+                    encoding='utf-8'):
+        """Like `transform`, but returns the resulting document in chunks of bytes
+        """
+        chunks = _ChunkWriter(chunk_size)
+        self.transform_to(html, chunks, pretty_print, encoding)
+        return chunks.iter_chunks()
+
+
+class _CDATACommentWriter(object):
+    """File-like object that comments out the CDATA markers written to it, so the CDATA
+    sections of the <style> blocks are valid CSS too: `<![CDATA[...]]>` is written as
+    `/*<![CDATA[*/.../*]]>*/`. Markers split between two writes are handled
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.pending = b''
+        self.inside = False
+
+    def write(self, data):
+        data = self.pending + data
+        output = []
+        while True:
+            marker = CDATA_END if self.inside else CDATA_START
+            position = data.find(marker)
+            if position == -1:
+                break
+            output.append(data[:position])
+            output.append(b'/*]]>*/' if self.inside else b'/*<![CDATA[*/')
+            data = data[position + len(marker):]
+            self.inside = not self.inside
+
+        # keep the end of the data if it could be the beginning of a marker
+        keep = 0
+        for length in range(len(marker) - 1, 0, -1):
+            if data.endswith(marker[:length]):
+                keep = length
+                break
+        self.pending = data[len(data) - keep:] if keep else b''
+        output.append(data[:len(data) - keep])
+        self.fileobj.write(b''.join(output))
+
+    def close(self):
+        if self.pending:
+            self.fileobj.write(self.pending)
+            self.pending = b''
+
+
+class _ChunkWriter(object):
+    """File-like object that splits the data written to it in chunks of `chunk_size` bytes. The
+    last chunk can be smaller
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.chunks = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            data = b''.join(self.buffer)
+            end = len(data) - len(data) % self.chunk_size
+            self.chunks.extend(
+                data[start:start + self.chunk_size] for start in range(0, end, self.chunk_size)
+            )
+            self.buffer = [data[end:]]
+            self.buffered = len(data) - end
+
+    def flush(self):
+        if self.buffered:
+            self.chunks.append(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def iter_chunks(self):
+        self.flush()
+        while self.chunks:
+            yield self.chunks.popleft()
+
+
+class TransformError(Exception):
+    """Returned by `Inlinify.transform_many` in place of the documents that failed to transform
+    """
+
+    def __init__(self, index, error, details):
+        super(TransformError, self).__init__(index, error, details)
+        self.index = index
+        self.error = error
+        self.details = details
+
+    def __str__(self):
+        return 'Document {0} failed to transform: {1}'.format(self.index, self.error)
+
+
+# The plan used by the worker processes of `Inlinify.transform_many`
+_worker_plan = None
+
+
+def _init_worker(plan):
+    global _worker_plan
+    _worker_plan = plan
+
+
+def _transform_chunk(chunk, pretty_print, kwargs, plan=None):
+    """Transforms a list of (index, html) tuples, capturing the errors of every document
+    """
+    plan = plan or _worker_plan
+    results = []
+    for index, html in chunk:
+        try:
+            results.append(plan.transform(html, pretty_print, **kwargs))
+        except Exception as e:
+            results.append(TransformError(index, '{0}: {1}'.format(type(e).__name__, e),
+                                          traceback.format_exc()))
+    return results
+
+
+def _chunks(iterable, size):
+    """Splits an iterable in lists of the provided size, lazily
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 
 class Inlinify(object):
 
@@ -29,32 +404,382 @@ class Inlinify(object):
                  preserve_internal_links=False,
                  preserve_inline_attachments=True,
                  method='html',
+                 cache_output=False,
+                 instrument=None,
+                 profiler=None,
+                 url_rewriter=None,
+                 url_rewriter_key=None,
                  **kwargs):
 
-        # attributes required by the URL parser
+        # keep the options around so compiled plans can create their own instance. The URL
+        # rewriter is kept apart, as it's only pickled with the plans sent to other processes
+        self._options = dict(kwargs,
+                             base_url=base_url,
+                             preserve_internal_links=preserve_internal_links,
+                             preserve_inline_attachments=preserve_inline_attachments,
+                             method=method,
+                             cache_output=cache_output,
+                             url_rewriter_key=url_rewriter_key)
+
+        # attributes required by the URL parser. The base URL ends with a slash, so the relative
+        # URLs are joined to it instead of replacing its last segment
+        if base_url and not base_url.endswith('/'):
+            base_url += '/'
         self.base_url = base_url
         self.preserve_internal_links = preserve_internal_links
         self.preserve_inline_attachments = preserve_inline_attachments
         self.method = method
 
+        # called with every URL of the href and src attributes, after joining it with the base
+        # URL, and the element and the attribute name. Returns the URL to use, for example to
+        # track the links
+        self.url_rewriter = url_rewriter
+
+        # identifies the URL rewriter in the output cache key. Defaults to the dotted path of
+        # module-level functions
+        if url_rewriter is not None and url_rewriter_key is None:
+            url_rewriter_key = _get_callable_key(url_rewriter)
+        self.url_rewriter_key = url_rewriter_key
+
+        # the attributes with URLs, collected while indexing the document when they are rewritten
+        self._link_attributes = LINK_ATTRIBUTES if base_url or url_rewriter else ()
+
         if self.method not in ('html', 'xml'):
             raise ValueError('{} is not supported as a method'.format(method))
 
+        # called with the durations of the phases and the counters of every transformation (see
+        # django_inlinify.instrumentation)
+        self.instrument = instrument
+
+        # records the cost of every rule (see django_inlinify.profiling)
+        self.profiler = profiler
+
         # initialize parser and loader
         self.css_parser = CSSParser(**kwargs)
         self.css_source = CSSLoader(css_files)
 
+        # plans of the CSS used by `transform`, by fingerprint
+        self._plans = LRUCache(DJANGO_INLINIFY_PLAN_CACHE_SIZE)
+
+        # cache for the transformed documents
+        self.output_cache = None
+        if cache_output:
+            if url_rewriter is not None and url_rewriter_key is None:
+                raise ValueError('The output of a URL rewriter that is not a module-level '
+                                 'function can only be cached with a url_rewriter_key')
+            backend = None
+            if DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME:
+                __, backend = load_cache_backend(DJANGO_INLINIFY_OUTPUT_CACHE_BACKEND_NAME)
+            local = output_cache if DJANGO_INLINIFY_OUTPUT_CACHE_SIZE > 0 else None
+            if backend is not None or local is not None:
+                self.output_cache = TieredCache(local, backend,
+                                                DJANGO_INLINIFY_OUTPUT_CACHE_KEY_TTL)
+
     def transform(self, html, pretty_print=True, **kwargs):
-        """Transform CSS into inline styles and inject them in the provided html
+        """Transform CSS into inline styles and inject them in the provided html. If the instance
+        was created with `cache_output=True`, the result is cached
         """
-        parser = None
-        if self.method == 'html':
-            parser = etree.HTMLParser()
-        elif self.method == 'xml':
-            parser = etree.XMLParser(ns_clean=False, resolve_entities=False)
+        recorder = self._get_recorder()
+        css_sources = self._load(recorder)
+        fingerprint = _fingerprint(css_sources)
+
+        cache_key = None
+        if self.output_cache is not None:
+            cache_key = self._get_output_cache_key(html, fingerprint, pretty_print, kwargs)
+            cached = self.output_cache.get(cache_key)
+            if cached is not None:
+                recorder.count('output_cache_hits')
+                self._emit(recorder)
+                return cached
+            recorder.count('output_cache_misses')
+
+        plan = self._get_plan(css_sources, recorder, fingerprint)
+        html = self._transform(html, plan, pretty_print, kwargs, recorder)
+        if cache_key:
+            self.output_cache.set(cache_key, html)
+        self._emit(recorder)
+        return html
+
+    def atransform(self, html, pretty_print=True, **kwargs):
+        """Asynchronous version of `transform`, for Python 3.6+. The CSS files are loaded
+        without blocking the event loop, and the html is transformed in a bounded thread pool (see
+        django_inlinify.aio)
+
+        Returns:
+            a coroutine returning the transformed html
+        """
+        from django_inlinify.aio import atransform
+        return atransform(self, html, pretty_print, **kwargs)
+
+    def session(self, html, pretty_print=True, **kwargs):
+        """Starts an incremental in-lining session of the html, for documents edited one element
+        at a time (see django_inlinify.session)
+
+        Returns:
+            an InlineSession instance
+        """
+        from django_inlinify.session import InlineSession
+        return InlineSession(self, html, pretty_print, **kwargs)
+
+    def transform_tree(self, tree):
+        """Transform CSS into inline styles and inject them in an already parsed document, in
+        place. Useful when the document is parsed before, or processed after, in-lining the CSS,
+        as it saves parsing and serializing it again. The output cache isn't used
+
+        Arguments:
+            - tree: an lxml.etree._ElementTree or lxml.etree._Element, parsed with the lxml
+              parser for the `method` of the instance
 
+        Returns:
+            the same tree
+        """
+        recorder = self._get_recorder()
+        plan = self._get_plan(self._load(recorder), recorder)
+        self._inline_tree(_get_root(tree), plan, recorder)
+        self._emit(recorder)
+        return tree
+
+    def transform_to(self, html, fileobj, pretty_print=True, encoding='utf-8'):
+        """Transform CSS into inline styles and inject them in the provided html, writing the
+        resulting document to a file-like object. The document is written as bytes by lxml's
+        incremental writer, without building the whole string in memory. The output cache isn't
+        used
+
+        Arguments:
+            - str html: the HTML document
+            - file fileobj: a file-like object opened in binary mode
+            - bool pretty_print: whether to indent the output
+            - str encoding: the encoding of the output
+        """
+        recorder = self._get_recorder()
+        plan = self._get_plan(self._load(recorder), recorder)
+        root = self._inline(html, plan, recorder)
+        started = recorder.start()
+        self._write(root, fileobj, pretty_print, encoding)
+        recorder.stop('serialize', started)
+        self._emit(recorder)
+
+    def iter_chunks(self, html, chunk_size=DEFAULT_CHUNK_SIZE, pretty_print=True,
+                    encoding='utf-8'):
+        """Like `transform_to`, but returns the resulting document in chunks of bytes, to
+        stream it to a socket or an HTTP response
+
+        Returns:
+            an iterator of byte strings of about `chunk_size` bytes
+        """
+        chunks = _ChunkWriter(chunk_size)
+        self.transform_to(html, chunks, pretty_print, encoding)
+        return chunks.iter_chunks()
+
+    def _get_recorder(self):
+        """Returns the recorder for a transformation: a NullRecorder unless there is an
+        instrument or a receiver of the transform_finished signal
+        """
+        if self.instrument is not None or transform_finished.has_listeners(self.__class__):
+            return Recorder()
+        return NULL_RECORDER
+
+    def _emit(self, recorder):
+        """Passes the durations and counters of a transformation to the instrument, and to the
+        receivers of the transform_finished signal
+        """
+        if not recorder.enabled:
+            return
+        if self.instrument is not None:
+            self.instrument(recorder.durations, recorder.counts)
+        transform_finished.send(sender=self.__class__, inlinify=self,
+                                durations=recorder.durations, counts=recorder.counts)
+
+    def _load(self, recorder=NULL_RECORDER):
+        """Loads the CSS files, as (CSS string, fingerprint) tuples
+        """
+        started = recorder.start()
+        css_sources = self.css_source.load_with_fingerprints()
+        recorder.stop('load', started)
+        return css_sources
+
+    def _get_plan(self, css_sources, recorder=NULL_RECORDER, fingerprint=None):
+        """Returns a plan for the provided CSS. Its selectors are compiled lazily. Plans are kept
+        by fingerprint, so the rules aren't sorted and indexed again for every document. The
+        fingerprint is computed if not provided (see `_fingerprint`)
+        """
+        started = recorder.start()
+        if fingerprint is None:
+            fingerprint = _fingerprint(css_sources)
+        plan = self._plans.get(fingerprint)
+        if plan is None:
+            recorder.count('plan_cache_misses')
+            rules, leftovers = self._parse_css_bodies(css_sources, recorder)
+            rules.sort(key=lambda item: item[0].specificity)
+            rules = (self._make_rule(*(rule + (None, tokens))) for rule, tokens in rules)
+            plan = InlinePlan(self._options, rules, leftovers, fingerprint, self.url_rewriter)
+            self._plans.set(fingerprint, plan)
+        else:
+            recorder.count('plan_cache_hits')
+        recorder.stop('plan', started)
+        return plan
+
+    def _get_output_cache_key(self, html, fingerprint, pretty_print, kwargs):
+        """Returns the key the transformed html is cached under. It depends on the html, the CSS
+        files, the options of the instance changing the output and the serialization options
+        """
+        h = md5(_to_bytes(html))
+        h.update(_to_bytes(fingerprint or ''))
+        h.update(_to_bytes(repr((self.base_url, self.preserve_internal_links,
+                                 self.preserve_inline_attachments, self.method,
+                                 self.css_parser.include_star_selectors, self.url_rewriter_key))))
+        h.update(_to_bytes(repr((pretty_print, sorted(kwargs.items())))))
+        return '%s_%s' % (DJANGO_INLINIFY_OUTPUT_CACHE_KEY_PREFIX, h.hexdigest())
+
+    def transform_many(self, htmls, workers=None, chunksize=1, pretty_print=True, plan=None,
+                       **kwargs):
+        """Transforms many HTML documents using a pool of worker processes. The external CSS
+        files are parsed once, and the resulting plan is shared with the workers.
+
+        This is a generator, so only a few chunks of documents are in memory at any time.
+        Documents that fail to transform don't stop the batch: a TransformError is yielded in
+        their place
+
+        Arguments:
+            - iterable htmls: the HTML documents to transform
+            - int workers: the number of worker processes. Defaults to the number of CPUs. With
+              1 or less, the documents are transformed in the current process
+            - int chunksize: the number of documents sent to a worker at once
+            - InlinePlan plan: the plan to apply, if already compiled. Defaults to compiling the
+              external CSS files
+
+        Returns:
+            a generator of the transformed documents (or TransformError instances), in order
+        """
+        if plan is None:
+            plan = self.compile()
+        chunks = _chunks(enumerate(htmls), chunksize)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if workers <= 1:
+            for chunk in chunks:
+                for result in _transform_chunk(chunk, pretty_print, kwargs, plan):
+                    yield result
+            return
+
+        pool = multiprocessing.Pool(workers, _init_worker, (plan, ))
+        try:
+            # keep a couple of chunks per worker in flight, so the workers are always busy but
+            # the documents are not all loaded in memory
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(_transform_chunk, (chunk, pretty_print, kwargs)))
+                if len(pending) >= workers * 2:
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    def compile(self, css=None):
+        """Compiles the external CSS files, and the provided CSS if any, into a plan that can be
+        used to transform many HTML documents without parsing the CSS again
+
+        Arguments:
+            - str css: extra CSS to compile. It can also be a list of CSS strings
+
+        Returns:
+            an InlinePlan instance
+        """
+        css_sources = self.css_source.load_with_fingerprints()
+        if isinstance(css, STR_TYPE):
+            css_sources.append((css, None))
+        elif css:
+            css_sources.extend((css_body, None) for css_body in css)
+
+        rules, leftovers = self._parse_css_bodies(css_sources)
+        rules.sort(key=lambda item: item[0].specificity)
+        rules = (
+            self._make_rule(specificity, selector, bulk, get_matcher(selector, self.method),
+                            tokens)
+            for (specificity, selector, bulk), tokens in rules
+        )
+        plan = InlinePlan(self._options, rules, leftovers, _fingerprint(css_sources),
+                          self.url_rewriter)
+        # the plan uses this instance, and its instrument, until it's pickled
+        plan._inlinify = self
+        return plan
+
+    def _make_rule(self, specificity, selector, bulk, matcher=None, tokens=None):
+        """Builds a PlanRule out of a parsed CSS rule
+        """
+        if tokens is None:
+            tokens = get_selector_tokens(selector)
+        declarations = tuple(self.css_parser._css_string_to_dict(bulk).items())
+        return PlanRule(specificity, selector, bulk, matcher, tokens, declarations)
+
+    def _transform(self, html, plan, pretty_print, kwargs, recorder=NULL_RECORDER):
+        """Applies the plan's rules, and the ones in the html <style> blocks, to the html
+        """
+        root = self._inline(html, plan, recorder)
+        return self._serialize(root, pretty_print, kwargs, recorder)
+
+    def _serialize(self, root, pretty_print, kwargs, recorder=NULL_RECORDER):
+        """Serializes a transformed document
+
+        Arguments:
+            - lxml.etree._Element root: the root to serialize, as returned by `_parse`
+            - dict kwargs: lxml.etree.tostring options. The defaults are set in place
+
+        Returns:
+            the html
+        """
+        # set some default options
+        kwargs.setdefault('method', self.method)
+        kwargs.setdefault('pretty_print', pretty_print)
+        kwargs.setdefault('encoding', 'utf-8')
+
+        started = recorder.start()
+        if kwargs['method'] == self.method and WRITER_OPTIONS.issuperset(kwargs):
+            output = BytesIO()
+            self._write(root, output, kwargs['pretty_print'], kwargs['encoding'])
+            html = output.getvalue().decode(kwargs['encoding'])
+        else:
+            html = etree.tostring(root, **kwargs).decode(kwargs['encoding'])
+
+            # need to replace the "<![CDATA" style comments with "/*<![CDATA" comments to be
+            # valid XHTML
+            if self.method == 'xml':
+                html = CDATA_REGEX.sub(lambda m: '/*<![CDATA[*/%s/*]]>*/' % m.group(1), html)
+        recorder.stop('serialize', started)
+
+        return html
+
+    def _inline(self, html, plan, recorder=NULL_RECORDER):
+        """Parses the html and applies the plan's rules, and the ones in the html <style>
+        blocks, to it
+
+        Returns:
+            the root to serialize: the document, or its root element if the html doesn't have a
+            doctype
+        """
+        started = recorder.start()
+        root, page = self._parse(html)
+        recorder.stop('parse_html', started)
+        self._inline_tree(page, plan, recorder)
+        return root
+
+    def _parse(self, html):
+        """Parses the html with the lxml parser of the current thread
+
+        Returns:
+            a tuple with the root to serialize and the root element of the document
+        """
         stripped = html.strip()
-        tree = etree.fromstring(stripped, parser).getroottree()
+        tree = etree.fromstring(stripped, _get_parser(self.method)).getroottree()
         page = tree.getroot()
 
         # lxml inserts a doctype if none exists, so only include it in the root if it was in
@@ -63,82 +788,233 @@ class Inlinify(object):
 
         assert page is not None
 
+        return root, page
+
+    def _inline_tree(self, page, plan, recorder=NULL_RECORDER):
+        """Applies the plan's rules, and the ones in the <style> blocks, to a parsed document,
+        in place
+
+        Arguments:
+            - lxml.etree._Element page: the root element of the document
+            - InlinePlan plan: the plan to apply
+            - Recorder recorder: records the durations and counters of the transformation
+        """
+        started = recorder.start()
+        computed_styles, index = self._match(page, plan, recorder)
+        recorder.stop('match', started)
+
+        # write the styles, re-applying the original inline styles on top
+        started = recorder.start()
+        self._write_element_styles(computed_styles)
+        recorder.stop('merge', started)
+
+        # transform relative paths to absolute URLs if required, with the URLs collected while
+        # indexing the document
+        started = recorder.start()
+        self._transform_urls(page, index.links)
+        recorder.stop('urls', started)
+
+    def _match(self, page, plan, recorder=NULL_RECORDER):
+        """Finds the elements matched by the plan's rules, and the ones in the <style> blocks
+
+        Returns:
+            a tuple with a dictionary mapping every matched element to a dictionary with its CSS
+            declarations, and the DocumentIndex of the document
+        """
         # process style block
-        rules = self._process_style_block(page)
-
-        # process external style sheets
-        rules.extend(self._process_external_files(page))
-
-        # rules is a tuple of (specificity, selector, styles), where specificity is a tuple
-        # ordered such that more specific rules sort larger.
-        rules.sort(key=operator.itemgetter(0))
-
-        original_styles = {}
-        for __, selector, new_style in rules:
-
-            # Constructing a CSSSelector instance and querying the page can be quite slow we
-            # first do this simple check to exclude selectors that are not present in the HTML.
-            # For example:
-            #     If the selector was ".foo .bar" we search for "foo" in the hmtl
-            #     If the selector was ".foo.bar" we search for "foo" in the html
-            #     If the selector was "div.large" we search for "div" in the html
-            # This will obviously give false positives, but that is ok as it still gives a big
-            # speed boost in cases where there are a lot of selectors that are not present
-            # in the HTML.
-            match = FIRST_SELECTOR_PART_REGEX.match(selector)
-            if match and match.group(2) not in stripped:
+        style_blocks = self._process_style_block(page, recorder)
+
+        # add the CSS that can't be in-lined from external style sheets
+        self._append_leftover_styles(page, plan.leftovers)
+
+        # index the elements by tag, class and id, so selectors are matched against the
+        # elements that can match them instead of the whole document. The URLs to rewrite are
+        # collected in the same walk
+        index = DocumentIndex(page, self._link_attributes)
+
+        rules, style_rules = self._get_rules(index, plan, style_blocks)
+
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.add_plan(plan)
+            timings = []
+
+        # the declarations of every styled element are accumulated here, and only written to
+        # the element once all the rules have been applied
+        computed_styles = {}
+        evaluated = 0
+        for rule in rules:
+
+            # The candidate rules are then skipped if they require any other token the document
+            # doesn't have. For example ".foo .bar" is skipped unless the document has elements
+            # with both "foo" and "bar" classes, and "div.large:not(.small)" unless it has a "div"
+            # and a "large".
+            if not index.has_tokens(rule.tokens):
                 continue
 
-            sel = CSSSelector(selector)
-            for item in sel(page):
-                current_style = item.attrib.get('style', '')
-                if item not in original_styles:
-                    original_styles[item] = current_style
-                self._update_element_style(item, current_style, new_style)
+            evaluated += 1
+            if profiler is not None:
+                started = default_timer()
+            matcher = rule.matcher or get_matcher(rule.selector, self.method)
+            matched = matcher.select(index)
+            if profiler is not None:
+                timings.append((rule, default_timer() - started, len(matched)))
+            for item in matched:
+                declarations = computed_styles.get(item)
+                if declarations is None:
+                    declarations = computed_styles[item] = {}
+                declarations.update(rule.declarations)
 
-        # re-apply the original inline styles
-        self._reapply_original_inline_styles(original_styles)
+        if profiler is not None:
+            profiler.add(timings, style_rules)
 
-        # transform relative paths to absolute URLs if required
-        self._transform_urls(page)
+        if recorder.enabled:
+            considered = len(plan.rules) + sum(len(parsed.rules) for parsed in style_blocks)
+            recorder.count('rules_considered', considered)
+            recorder.count('rules_pruned', considered - evaluated)
+            recorder.count('selectors_evaluated', evaluated)
+            recorder.count('elements_styled', len(computed_styles))
 
-        # set some default options
-        kwargs.setdefault('method', self.method)
-        kwargs.setdefault('pretty_print', pretty_print)
-        kwargs.setdefault('encoding', 'utf-8')
+        return computed_styles, index
 
-        html = etree.tostring(root, **kwargs).decode(kwargs['encoding'])
+    def _get_rules(self, index, plan, style_blocks):
+        """Returns the rules of the plan and of the <style> blocks that may match elements of a
+        document
+
+        Arguments:
+            - DocumentIndex index: the index of the document
+            - InlinePlan plan: the plan
+            - list style_blocks: the ParsedCSS records of the <style> blocks
+
+        Returns:
+            a tuple with the sorted list of candidate PlanRule records, and the list of the ones
+            of the <style> blocks
+        """
+        # Compiling a selector and querying the page can be quite slow, so only the rules indexed
+        # under an id, a class name or a tag name of the document are considered, without going
+        # through the others. See django_inlinify.matching.build_token_index.
+        # rules is a list of PlanRule records, where specificity is an integer such that more
+        # specific rules sort larger. The plan's rules are already sorted, so there is no need to
+        # sort them if the html doesn't have any <style> blocks. The rules of the <style> blocks
+        # go first, so on an exact tie the external CSS wins, as it always did. The sort is
+        # stable, so the ties keep that order.
+        rules = [plan.rules[position] for position in index.find_candidates(plan.token_index)]
+        style_rules = []
+        if style_blocks:
+            for parsed in style_blocks:
+                style_rules.extend(
+                    self._make_rule(*(parsed.rules[position] + (None, parsed.tokens[position])))
+                    for position in index.find_candidates(parsed.index)
+                )
+            rules = style_rules + rules
+            rules.sort(key=operator.itemgetter(0))
+        return rules, style_rules
 
-        # need to replace the "<![CDATA" style comments with "/*<![CDATA" comments to be valid XHTML
+    def _write(self, root, fileobj, pretty_print, encoding):
+        """Serializes a document with lxml's incremental writer. The output is the same as
+        lxml.etree.tostring's
+        """
+        cdata_writer = None
         if self.method == 'xml':
-            html = CDATA_REGEX.sub(lambda m: '/*<![CDATA[*/%s/*]]>*/' % m.group(1), html)
+            # need to replace the "<![CDATA" style comments with "/*<![CDATA" comments to be
+            # valid XHTML
+            fileobj = cdata_writer = _CDATACommentWriter(fileobj)
 
-        return html
+        writer = etree.htmlfile if self.method == 'html' else etree.xmlfile
+        with writer(fileobj, encoding=encoding) as xf:
+            if isinstance(root, etree._ElementTree):
+                page = root.getroot()
+                if root.docinfo.doctype:
+                    xf.write_doctype(root.docinfo.doctype)
+                for sibling in reversed(list(page.itersiblings(preceding=True))):
+                    xf.write(sibling, pretty_print=pretty_print)
+                xf.write(page, pretty_print=pretty_print)
+                for sibling in page.itersiblings():
+                    xf.write(sibling, pretty_print=pretty_print)
+            else:
+                xf.write(root, pretty_print=pretty_print)
+
+        if cdata_writer is not None:
+            cdata_writer.close()
+
+    def warm_up(self, *css_bodies):
+        """Compiles the selectors of the external CSS files, and of any other CSS provided, so
+        they are already in the selector cache when the first HTML is transformed. Meant to be
+        called when the application starts
+
+        Arguments:
+            - str css_bodies: extra CSS strings whose selectors should be compiled too
+
+        Returns:
+            the number of selectors compiled
+        """
+        css_sources = self.css_source.load_with_fingerprints()
+        css_sources.extend((css_body, None) for css_body in css_bodies)
+        rules, __ = self._parse_css_bodies(css_sources)
+        for rule, __ in rules:
+            get_matcher(rule.selector, self.method)
+        for selector in ('head', 'style'):
+            get_selector(selector, self.method)
+        return len(rules)
+
+    def _parse_css_bodies(self, css_sources, recorder=NULL_RECORDER):
+        """Parses the provided CSS strings
+
+        Arguments:
+            - list css_sources: (CSS string, fingerprint) tuples. The fingerprint can be None
 
-    def _process_external_files(self, page):
-        """Processes the provided external CSS files, if any
+        Returns:
+            a tuple with the list of (rule, tokens) tuples, where the tokens are the ones required
+            by the selector of the rule, and the list of CSS strings that can't be in-lined
         """
         rules = []
-        head = CSSSelector('head')(page)
-        for index, css_body in enumerate(self.css_source):
-            these_rules, these_leftover = self.css_parser.parse(css_body, index)
-            rules.extend(these_rules)
-            if these_leftover:
-                style = etree.Element('style')
-                style.attrib['type'] = 'text/css'
-                if self.method == 'html':
-                    style.text = these_leftover
-                elif self.method == 'xml':
-                    style.text = etree.CDATA(these_leftover)
-                if head:
-                    head[0].append(style)
-        return rules
-
-    def _process_style_block(self, page):
+        leftovers = []
+        for index, (css_body, fingerprint) in enumerate(css_sources):
+            parsed, cached = self.css_parser._parse_indexed(css_body, index, fingerprint)
+            recorder.count('parse_cache_hits' if cached else 'parse_cache_misses')
+            rules.extend(zip(parsed.rules, parsed.tokens))
+            if parsed.leftover:
+                leftovers.append(parsed.leftover)
+        return rules, leftovers
+
+    def _append_leftover_styles(self, page, leftovers):
+        """Adds a <style> block to the <head> for every CSS string that can't be in-lined
+
+        Returns:
+            the list of the added <style> elements
+        """
+        styles = []
+        if not leftovers:
+            return styles
+        head = get_selector('head', self.method)(page)
+        for leftover in leftovers:
+            style = etree.Element('style')
+            style.attrib['type'] = 'text/css'
+            if self.method == 'html':
+                style.text = leftover
+            elif self.method == 'xml':
+                style.text = etree.CDATA(leftover)
+            if head:
+                head[0].append(style)
+                styles.append(style)
+        return styles
+
+    def _process_style_block(self, page, recorder=NULL_RECORDER, exclude=()):
         """Processes the <style> block in the HTML
+
+        Arguments:
+            - lxml.etree._Element page: the root element of the document
+            - Recorder recorder: records the counters of the transformation
+            - iterable exclude: <style> elements to skip, such as the ones added with the CSS
+              that can't be in-lined
+
+        Returns:
+            a list with the ParsedCSS record of every <style> block
         """
-        rules = []
-        for index, element in enumerate(CSSSelector('style')(page)):
+        style_blocks = []
+        elements = [element for element in get_selector('style', self.method)(page)
+                    if element not in exclude]
+        for index, element in enumerate(elements):
             # If we have a media attribute whose value is anything other than 'screen',
             # ignore the ruleset.
             media = element.attrib.get('media')
@@ -146,38 +1022,59 @@ class Inlinify(object):
                 continue
 
             css_body = element.text
-            these_rules, these_leftover = self.css_parser.parse(css_body, index)
-            rules.extend(these_rules)
+            parsed, cached = self.css_parser._parse_indexed(css_body, index)
+            recorder.count('parse_cache_hits' if cached else 'parse_cache_misses')
+            style_blocks.append(parsed)
+
+        return style_blocks
 
-        return rules
+    def _write_element_styles(self, computed_styles):
+        """Sets the style attribute, and the HTML attributes derived from it, of every element
+        styled by the CSS rules. The original inline styles win over the CSS rules
 
-    def _reapply_original_inline_styles(self, original):
-        """Re-applies all the initial inline styles
+        Arguments:
+            - dict computed_styles: maps every element to a dictionary with its CSS declarations
         """
-        for item, inline_style in original.iteritems():
-            if not inline_style:
+        for item, declarations in computed_styles.items():
+            inline_style = item.attrib.get('style')
+            if inline_style:
+                declarations.update(self.css_parser._css_string_to_dict(inline_style))
+            item.attrib['style'] = self.css_parser._dict_to_css_string(declarations)
+            self.css_parser.css_declarations_to_basic_html_attributes(item, declarations.items())
+
+    def _transform_urls(self, page, links=None):
+        """Rewrites the URLs of the href and src attributes of a tree: relative URLs are joined
+        with the base URL, and the URL rewriter is called with the result. The joined URLs are
+        memoized, as the same links are usually repeated many times in a document
+
+        Arguments:
+            - lxml.etree._Element page: the root element of the tree
+            - list links: the (element, attribute name, URL) tuples of the tree, as collected by
+              DocumentIndex. They are collected from the tree if not provided
+
+        Returns:
+            the page
+        """
+        base_url = self.base_url
+        url_rewriter = self.url_rewriter
+        if not base_url and url_rewriter is None:
+            return page
+        if links is None:
+            links = DocumentIndex(page, LINK_ATTRIBUTES).links
+
+        joined = {}
+        for element, attr, url in links:
+            if attr == 'href' and self.preserve_internal_links and url.startswith('#'):
+                continue
+            if attr == 'src' and self.preserve_inline_attachments and url.startswith('cid:'):
                 continue
-            self._update_element_style(item, item.attrib.get('style', ''), inline_style)
-
-    def _update_element_style(self, element, current, new):
-        """Given an element, its current style and a new one, merges them and updates the element
-        """
-        new_style = self.css_parser.merge_styles(current, new)
-        element.attrib['style'] = new_style
-        self.css_parser.css_style_to_basic_html_attributes(element, new_style)
-
-    def _transform_urls(self, page):
-        if self.base_url:
-            for attr in ('href', 'src'):
-                for item in page.xpath("//@%s" % attr):
-                    parent = item.getparent()
-                    if (attr == 'href' and self.preserve_internal_links
-                            and parent.attrib[attr].startswith('#')):
-                        continue
-                    if (attr == 'src' and self.preserve_inline_attachments
-                            and parent.attrib[attr].startswith('cid:')):
-                        continue
-                    if not self.base_url.endswith('/'):
-                        self.base_url += '/'
-                    parent.attrib[attr] = urljoin(self.base_url, parent.attrib[attr].lstrip('/'))
+            new_url = url
+            if base_url:
+                new_url = joined.get(url)
+                if new_url is None:
+                    new_url = joined[url] = urljoin(base_url, url.lstrip('/'))
+            if url_rewriter is not None:
+                new_url = url_rewriter(new_url, element, attr)
+            if new_url != url:
+                element.set(attr, new_url)
         return page
@@ -0,0 +1,142 @@
+"""Instrumentation of the transformations.
+
+Inlinify instances created with an `instrument` callable call it after every transformation with
+two dictionaries: the durations of the phases, in seconds, and the counters. The
+`django_inlinify.signals.transform_finished` signal is sent with the same data if it has any
+receiver. When there is neither, nothing is recorded.
+
+The phases are:
+    - load: loading the CSS files
+    - plan: getting the sorted and indexed rules of the CSS, parsing it if needed
+    - parse_html: parsing the document
+    - match: finding the elements matched by every rule
+    - merge: merging the declarations with the inline styles, and writing them to the elements
+    - urls: rewriting the relative URLs
+    - serialize: serializing the document
+
+The counters are:
+    - rules_considered: rules of the stylesheets and of the <style> blocks
+    - rules_pruned: rules skipped because the document lacks an id, class name or tag name they
+      require
+    - selectors_evaluated: rules whose selector was matched against the document
+    - elements_styled: elements with at least one matching rule
+    - output_cache_hits, output_cache_misses: lookups in the output cache
+    - plan_cache_hits, plan_cache_misses: lookups of the rules of the stylesheets
+    - parse_cache_hits, parse_cache_misses: lookups of parsed CSS, including the <style> blocks
+"""
+from __future__ import absolute_import, unicode_literals
+import logging
+import threading
+from timeit import default_timer
+
+__all__ = ['LoggingInstrument', 'TransformStats']
+
+
+class Recorder(object):
+    """Records the durations of the phases of one transformation, and its counters
+    """
+
+    enabled = True
+
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def start(self):
+        return default_timer()
+
+    def stop(self, phase, started):
+        """Adds the time elapsed since `started`, as returned by `start`, to the phase
+        """
+        self.durations[phase] = self.durations.get(phase, 0.0) + default_timer() - started
+
+    def count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+
+class NullRecorder(object):
+    """Recorder used when instrumentation is disabled
+    """
+
+    enabled = False
+
+    def start(self):
+        return None
+
+    def stop(self, phase, started):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_RECORDER = NullRecorder()
+
+
+class TransformStats(object):
+    """Aggregates the durations and counters of many transformations. Thread-safe. Instances can
+    be used as the `instrument` of Inlinify instances, or connected to the `transform_finished`
+    signal with `transform_finished.connect(stats.receiver)`
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, durations, counts):
+        with self._lock:
+            self.transforms += 1
+            for phase, duration in durations.items():
+                total, maximum, count = self.durations.get(phase, (0.0, 0.0, 0))
+                self.durations[phase] = (total + duration, max(maximum, duration), count + 1)
+            for name, value in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + value
+
+    def receiver(self, sender, durations, counts, **kwargs):
+        self(durations, counts)
+
+    def reset(self):
+        with self._lock:
+            self.transforms = 0
+            self.durations = {}
+            self.counts = {}
+
+    def as_dict(self):
+        """Returns the number of transformations, the total, maximum and mean duration of every
+        phase, and the totals of the counters
+        """
+        with self._lock:
+            return {
+                'transforms': self.transforms,
+                'durations': dict(
+                    (phase, {'total': total, 'max': maximum, 'mean': total / count})
+                    for phase, (total, maximum, count) in self.durations.items()
+                ),
+                'counts': dict(self.counts),
+            }
+
+
+class LoggingInstrument(object):
+    """Logs the durations and counters of every transformation
+
+    Arguments:
+        - logging.Logger logger: the logger to use. Defaults to the one of this module
+        - int level: the level of the messages
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger(__name__)
+        self.level = level
+
+    def __call__(self, durations, counts):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(
+                self.level, 'Transformed in %.1fms: %s; %s',
+                sum(durations.values()) * 1000,
+                ', '.join('%s=%.1fms' % (phase, duration * 1000)
+                          for phase, duration in sorted(durations.items())),
+                ', '.join('%s=%s' % item for item in sorted(counts.items())),
+            )
+
+    def receiver(self, sender, durations, counts, **kwargs):
+        self(durations, counts)
@@ -0,0 +1,69 @@
+"""Template loader in-lining the templates with `{% inlinify %}` tags when they are loaded (see
+django_inlinify.template_tools). It wraps other loaders, and should be wrapped by Django's cached
+loader, so every template is in-lined once:
+
+    TEMPLATES = [{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    ('django_inlinify.loaders.Loader', [
+                        'django.template.loaders.filesystem.Loader',
+                        'django.template.loaders.app_directories.Loader',
+                    ]),
+                ]),
+            ],
+        },
+    }]
+
+The loader uses the template engines API, added in Django 1.8.
+"""
+from __future__ import absolute_import, unicode_literals
+import logging
+
+from django.core.exceptions import ImproperlyConfigured
+from django.template.base import TemplateDoesNotExist
+from django_inlinify.template_tools import INLINIFY_TAG, flatten, inline_regions
+
+try:
+    from django.template.loaders.base import Loader as BaseLoader
+except ImportError:  # Django < 1.8
+    raise ImproperlyConfigured('django_inlinify.loaders.Loader requires Django 1.8 or later')
+
+log = logging.getLogger(__name__)
+
+
+class Loader(BaseLoader):
+    is_usable = True
+
+    def __init__(self, engine, loaders):
+        self.loaders = engine.get_template_loaders(loaders)
+        super(Loader, self).__init__(engine)
+
+    def _load_source(self, template_name, template_dirs=None):
+        for loader in self.loaders:
+            try:
+                return loader.load_template_source(template_name, template_dirs)
+            except TemplateDoesNotExist:
+                pass
+        raise TemplateDoesNotExist(template_name)
+
+    def load_template_source(self, template_name, template_dirs=None):
+        source, display_name = self._load_source(template_name, template_dirs)
+        if '{%' not in source:
+            return source, display_name
+
+        try:
+            flattened = flatten(source, lambda name: self._load_source(name, template_dirs)[0])
+        except ValueError as e:
+            # the template is rendered as is, and in-lined when rendered
+            log.warning('Could not flatten the template %s: %s', template_name, e)
+            return source, display_name
+
+        # only templates with an inlinify tag, or extending one that has it, are changed
+        if INLINIFY_TAG not in flattened:
+            return source, display_name
+        inlined = inline_regions(flattened)
+        if inlined == flattened:
+            return source, display_name
+        return inlined, display_name
@@ -0,0 +1,212 @@
+"""In-lines the CSS of a directory of HTML templates, writing the results to another directory.
+
+The CSS is parsed once, and the templates are transformed by a pool of worker processes. A
+manifest in the destination directory records the hash of every template and of the CSS, so the
+next runs only transform the templates, or the CSS, that changed, and remove the outputs of the
+templates that were deleted:
+
+    ./manage.py inlinify_templates templates/email build/email --css static/css/email.css --jobs 4
+"""
+from __future__ import absolute_import, unicode_literals
+import fnmatch
+import io
+import json
+import multiprocessing
+import os
+from collections import deque
+from hashlib import md5
+from itertools import chain
+from timeit import default_timer
+
+from django.core.management.base import BaseCommand, CommandError
+from django_inlinify.inlinify import Inlinify, TransformError, _fingerprint
+
+# Name of the manifest, in the destination directory, when none is provided
+MANIFEST_NAME = '.inlinify-manifest.json'
+
+MANIFEST_VERSION = 1
+
+
+def _hash(data):
+    return md5(data).hexdigest()
+
+
+def find_templates(src, pattern, exclude=None):
+    """Returns the paths of the files of a directory matching a pattern, relative to the
+    directory and sorted
+
+    Arguments:
+        - str src: the directory
+        - str pattern: the shell pattern the file names must match
+        - str exclude: a directory to skip, such as the destination directory when it's inside
+          the source one
+    """
+    exclude = os.path.abspath(exclude) if exclude else None
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        if exclude is not None:
+            dirnames[:] = [
+                name for name in dirnames
+                if os.path.abspath(os.path.join(dirpath, name)) != exclude
+            ]
+        for filename in fnmatch.filter(filenames, pattern):
+            paths.append(os.path.relpath(os.path.join(dirpath, filename), src))
+    return sorted(paths)
+
+
+def load_manifest(path):
+    """Returns the manifest of a previous run, or an empty one if there is none or it can't be
+    read
+    """
+    try:
+        with io.open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        manifest = None
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        manifest = {'version': MANIFEST_VERSION, 'css': None, 'files': {}}
+    return manifest
+
+
+def save_manifest(path, manifest):
+    """Writes the manifest atomically, so an interrupted run doesn't leave a corrupted one
+    """
+    tmp_path = path + '.tmp'
+    with io.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:  # Python 2. os.rename doesn't overwrite an existing file on Windows
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = ('In-lines the CSS of the HTML templates of a directory, writing them to another '
+            'directory. Only the templates that changed since the last run are transformed.')
+
+    requires_system_checks = False
+    leave_locale_alone = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('src', help='Directory of the templates to transform.')
+        parser.add_argument('dest', help='Directory to write the transformed templates to.')
+        parser.add_argument('--css', dest='css', action='append', default=[],
+            help='CSS file, or URL, to in-line. Can be used multiple times.')
+        parser.add_argument('--jobs', '-j', dest='jobs', type=int, default=None,
+            help='Number of worker processes. Defaults to the number of CPUs.')
+        parser.add_argument('--pattern', dest='pattern', default='*.html',
+            help='Shell pattern of the template file names. Defaults to "*.html".')
+        parser.add_argument('--manifest', dest='manifest', default=None,
+            help='Path of the manifest. Defaults to "%s" in the destination directory.' %
+                 MANIFEST_NAME)
+        parser.add_argument('--base-url', dest='base_url', default=None,
+            help='Base URL of the relative URLs of the templates.')
+        parser.add_argument('--method', dest='method', default='html', choices=['html', 'xml'],
+            help='Serialization method. Defaults to "html".')
+        parser.add_argument('--force', '-f', dest='force', action='store_true', default=False,
+            help='Transform every template, even the unchanged ones.')
+
+    def handle(self, *args, **options):
+        src = options['src']
+        dest = options['dest']
+        if not os.path.isdir(src):
+            raise CommandError('%s is not a directory' % src)
+        verbosity = int(options.get('verbosity', 1))
+        jobs = options.get('jobs') or multiprocessing.cpu_count()
+        manifest_path = options.get('manifest') or os.path.join(dest, MANIFEST_NAME)
+
+        started = default_timer()
+        try:
+            inlinify = Inlinify(css_files=options.get('css') or None,
+                                base_url=options.get('base_url'),
+                                method=options.get('method') or 'html')
+            css_sources = inlinify.css_source.load_with_fingerprints()
+            # the plan is identified by the contents of the CSS files, so touching them, or
+            # checking them out again, doesn't transform every template again
+            fingerprint = _fingerprint((css, None) for css, __ in css_sources)
+            plan = inlinify._get_plan(css_sources, fingerprint=fingerprint)
+        except (IOError, OSError, ValueError) as e:
+            raise CommandError('Could not load the CSS: %s' % e)
+
+        # the templates have to be transformed again when the CSS or the options change
+        css_key = _hash(json.dumps([plan.fingerprint, options.get('base_url'),
+                                    options.get('method')]).encode('utf-8'))
+        manifest = load_manifest(manifest_path)
+        paths = find_templates(src, options['pattern'], exclude=dest)
+
+        # remove the outputs of the templates that were deleted
+        existing = set(paths)
+        for path in sorted(manifest['files']):
+            if path not in existing:
+                del manifest['files'][path]
+                output_path = os.path.join(dest, path)
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+                if verbosity > 1:
+                    self.stdout.write('Removed %s' % path)
+
+        if manifest['css'] != css_key:
+            manifest = {'version': MANIFEST_VERSION, 'css': css_key, 'files': {}}
+
+        # the templates are read, and hashed, by the generator, so only the ones in flight are in
+        # memory
+        pending = deque()
+
+        def read_templates():
+            for path in paths:
+                with io.open(os.path.join(src, path), encoding='utf-8') as f:
+                    html = f.read()
+                digest = _hash(html.encode('utf-8'))
+                if (not options.get('force') and manifest['files'].get(path) == digest and
+                        os.path.exists(os.path.join(dest, path))):
+                    continue
+                pending.append((path, digest))
+                yield html
+
+        failures = []
+        written = 0
+        transform_started = default_timer()
+        # don't start the worker processes for nothing
+        templates = read_templates()
+        first = next(templates, None)
+        results = []
+        if first is not None:
+            results = inlinify.transform_many(chain([first], templates), workers=jobs, plan=plan)
+        for result in results:
+            path, digest = pending.popleft()
+            if isinstance(result, TransformError):
+                failures.append(path)
+                manifest['files'].pop(path, None)
+                self.stderr.write('Could not transform %s: %s' % (path, result.error))
+                if verbosity > 1:
+                    self.stderr.write(result.details)
+                continue
+            output_path = os.path.join(dest, path)
+            if not os.path.isdir(os.path.dirname(output_path)):
+                os.makedirs(os.path.dirname(output_path))
+            with io.open(output_path, 'w', encoding='utf-8') as f:
+                f.write(result)
+            manifest['files'][path] = digest
+            written += 1
+            if verbosity > 1:
+                self.stdout.write('Transformed %s' % path)
+        transform_time = default_timer() - transform_started
+        transformed = written + len(failures)
+
+        if not os.path.isdir(os.path.dirname(os.path.abspath(manifest_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(manifest_path)))
+        save_manifest(manifest_path, manifest)
+
+        if verbosity > 0:
+            elapsed = default_timer() - started
+            self.stdout.write(
+                '%d templates: %d transformed, %d unchanged, %d failed in %.2fs '
+                '(%.1f templates/s with %d jobs)' % (
+                    len(paths), written, len(paths) - transformed, len(failures), elapsed,
+                    transformed / transform_time if transformed and transform_time else 0.0, jobs,
+                )
+            )
+        if failures:
+            raise CommandError('%d templates could not be transformed' % len(failures))
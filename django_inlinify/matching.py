@@ -0,0 +1,470 @@
+from __future__ import absolute_import, unicode_literals
+import re
+from collections import namedtuple
+
+import cssselect
+from cssselect.parser import (Attrib, Class, CombinedSelector, Element, Function, Hash, Negation,
+                              Pseudo, parse_series)
+from django.conf import settings
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from django_inlinify import defaults
+from django_inlinify.caching import LRUCache
+
+__all__ = ['DocumentIndex', 'build_token_index', 'get_matcher', 'get_selector',
+           'get_selector_tokens', 'matcher_cache', 'selector_cache', 'tokens_cache']
+
+DJANGO_INLINIFY_SELECTOR_CACHE_SIZE = getattr(
+    settings,
+    'DJANGO_INLINIFY_SELECTOR_CACHE_SIZE',
+    defaults.DJANGO_INLINIFY_SELECTOR_CACHE_SIZE
+)
+
+# Whitespace characters separating the tokens of the class attribute, as XPath's normalize-space
+CLASS_SEPARATOR_REGEX = re.compile('[ \t\r\n]+')
+
+# Pseudo classes without arguments the matcher knows how to evaluate
+SIMPLE_PSEUDOS = frozenset([
+    'first-child', 'last-child', 'only-child', 'first-of-type', 'last-of-type', 'only-of-type',
+    'root',
+])
+
+# Pseudo classes with an `an+b` argument the matcher knows how to evaluate
+NTH_PSEUDOS = frozenset(['nth-child', 'nth-last-child', 'nth-of-type', 'nth-last-of-type'])
+
+# Compiled selectors, shared by every Inlinify instance in the process. Translating a selector
+# to XPath is expensive, and the same stylesheets are used over and over again.
+selector_cache = LRUCache(DJANGO_INLINIFY_SELECTOR_CACHE_SIZE)
+matcher_cache = LRUCache(DJANGO_INLINIFY_SELECTOR_CACHE_SIZE)
+tokens_cache = LRUCache(DJANGO_INLINIFY_SELECTOR_CACHE_SIZE)
+
+# Kinds of the tokens required by a selector, from the most selective to the least
+TOKEN_KINDS = ('id', 'class', 'tag')
+
+# Attributes holding the URLs rewritten by Inlinify
+LINK_ATTRIBUTES = ('href', 'src')
+
+# A compound selector, like `p.intro[title]:first-child`:
+#   - tag: the element name, or None for any element
+#   - ids: the ids the element must have
+#   - classes: the class names the element must have
+#   - attribs: (name, operator, value) tuples the element attributes must satisfy
+#   - pseudos: (name, a, b) tuples for the structural pseudo classes. `a` and `b` are the
+#     arguments of the `an+b` series, or None
+#   - negations: compound selectors the element must not match
+Compound = namedtuple('Compound', ['tag', 'ids', 'classes', 'attribs', 'pseudos', 'negations'])
+
+
+class UnsupportedSelector(Exception):
+    """Raised when a selector can't be evaluated by the SelectorMatcher
+    """
+
+
+def get_selector(selector, method='html'):
+    """Returns a compiled CSSSelector for the provided selector, reusing a cached one if possible
+
+    Arguments:
+        - str selector: the CSS selector
+        - str method: the serialization method (`html` or `xml`). Selectors are cached by
+          method, but are translated with the default cssselect translator in both cases, so tag
+          and attribute names are matched case sensitively
+
+    Returns:
+        a lxml.cssselect.CSSSelector instance
+    """
+    key = (selector, method)
+    sel = selector_cache.get(key)
+    if sel is None:
+        sel = CSSSelector(selector)
+        selector_cache.set(key, sel)
+    return sel
+
+
+def get_matcher(selector, method='html'):
+    """Returns a matcher for the provided selector, reusing a cached one if possible. Selectors
+    the SelectorMatcher can't evaluate are matched with XPath instead
+
+    Arguments:
+        - str selector: the CSS selector
+        - str method: the serialization method (`html` or `xml`)
+
+    Returns:
+        a SelectorMatcher or XPathMatcher instance
+    """
+    key = (selector, method)
+    matcher = matcher_cache.get(key)
+    if matcher is None:
+        try:
+            matcher = SelectorMatcher(selector, compile_selector(selector, method))
+        except (UnsupportedSelector, cssselect.SelectorError, ValueError):
+            matcher = XPathMatcher(selector, method)
+        matcher_cache.set(key, matcher)
+    return matcher
+
+
+def get_selector_tokens(selector):
+    """Returns the ids, class names and tag names an element, or its ancestors and siblings,
+    must have for the selector to match. They are taken from all the compound selectors, except
+    the negations. Tag names are in lower case
+
+    Returns:
+        a tuple of (kind, name) tuples, where kind is `id`, `class` or `tag`, sorted by
+        TOKEN_KINDS. It's empty if the selector doesn't require any token, or can't be parsed
+    """
+    tokens = tokens_cache.get(selector)
+    if tokens is None:
+        tokens = set()
+        try:
+            parsed = cssselect.parse(selector)
+        except cssselect.SelectorError:
+            parsed = []
+        if len(parsed) == 1:
+            _collect_tokens(parsed[0].parsed_tree, tokens)
+        tokens = tuple(sorted(tokens, key=lambda token: (TOKEN_KINDS.index(token[0]), token[1])))
+        tokens_cache.set(selector, tokens)
+    return tokens
+
+
+def build_token_index(rule_tokens):
+    """Builds an inverted index of rules from the tokens they require. A rule can only match if
+    the document has all its tokens, so it's only indexed under the first, most selective, one
+
+    Arguments:
+        - iterable rule_tokens: the tokens of every rule, as returned by get_selector_tokens
+
+    Returns:
+        a dictionary mapping tokens to tuples with the positions of the rules. The rules that
+        don't require any token are under None
+    """
+    index = {}
+    for position, tokens in enumerate(rule_tokens):
+        index.setdefault(tokens[0] if tokens else None, []).append(position)
+    return dict((token, tuple(positions)) for token, positions in index.items())
+
+
+def _collect_tokens(tree, tokens):
+    """Adds the tokens required by a parsed selector to the provided set
+    """
+    while tree is not None:
+        if isinstance(tree, CombinedSelector):
+            _collect_tokens(tree.subselector, tokens)
+        elif isinstance(tree, Class):
+            tokens.add(('class', tree.class_name))
+        elif isinstance(tree, Hash):
+            tokens.add(('id', tree.id))
+        elif isinstance(tree, Element):
+            if tree.element and not tree.namespace:
+                tokens.add(('tag', tree.element.lower()))
+            return
+        # negations only follow the selector they apply to, not the negated one
+        tree = getattr(tree, 'selector', None)
+
+
+def compile_selector(selector, method='html'):
+    """Turns a CSS selector into a list of (compound, combinator) steps, ordered right to left.
+    The combinator is the one joining the compound with the next step
+
+    Raises:
+        UnsupportedSelector if the selector uses features the matcher doesn't know about
+    """
+    parsed = cssselect.parse(selector)
+    if len(parsed) != 1 or parsed[0].pseudo_element is not None:
+        raise UnsupportedSelector(selector)
+
+    tree = parsed[0].parsed_tree
+    steps = []
+    while isinstance(tree, CombinedSelector):
+        steps.append((_compile_compound(tree.subselector, method), tree.combinator))
+        tree = tree.selector
+    steps.append((_compile_compound(tree, method), None))
+    return tuple(steps)
+
+
+def _compile_compound(tree, method):
+    """Turns a parsed compound selector into a Compound
+    """
+    tag = None
+    ids = []
+    classes = []
+    attribs = []
+    pseudos = []
+    negations = []
+    while not isinstance(tree, Element):
+        if isinstance(tree, Class):
+            classes.append(tree.class_name)
+        elif isinstance(tree, Hash):
+            ids.append(tree.id)
+        elif isinstance(tree, Attrib):
+            if tree.namespace:
+                raise UnsupportedSelector(repr(tree))
+            name = tree.attrib
+            value = getattr(tree.value, 'value', tree.value)
+            attribs.append((name, tree.operator, value))
+        elif isinstance(tree, Pseudo) and tree.ident in SIMPLE_PSEUDOS:
+            pseudos.append((tree.ident, None, None))
+        elif isinstance(tree, Function) and tree.name in NTH_PSEUDOS:
+            a, b = parse_series(tree.arguments)
+            pseudos.append((tree.name, a, b))
+        elif isinstance(tree, Negation):
+            negations.append(_compile_compound(tree.subselector, method))
+        else:
+            raise UnsupportedSelector(repr(tree))
+        tree = tree.selector
+
+    if tree.namespace:
+        raise UnsupportedSelector(repr(tree))
+    if tree.element:
+        tag = tree.element
+    elif any(name.endswith('of-type') for name, __, __ in pseudos):
+        # `*:first-of-type` and friends aren't supported by cssselect either
+        raise UnsupportedSelector(repr(tree))
+
+    return Compound(tag, tuple(ids), tuple(classes), tuple(attribs), tuple(pseudos),
+                    tuple(negations))
+
+
+class DocumentIndex(object):
+    """Index of the elements of a document by tag name, class name and id, built in a single
+    walk of the tree. Elements in every bucket are in document order
+
+    Arguments:
+        - lxml.etree._Element root: the root element of the document
+        - tuple link_attributes: names of the attributes to collect in `links` as
+          (element, attribute name, value) tuples, in document order
+    """
+
+    def __init__(self, root, link_attributes=()):
+        self.root = root
+        self.elements = []
+        self.tags = {}
+        self.classes = {}
+        self.ids = {}
+        self.links = []
+        for element in root.iter(etree.Element):
+            for name in link_attributes:
+                value = element.get(name)
+                if value is not None:
+                    self.links.append((element, name, value))
+            self.elements.append(element)
+            self.tags.setdefault(element.tag, []).append(element)
+            element_id = element.get('id')
+            if element_id is not None:
+                self.ids.setdefault(element_id, []).append(element)
+            class_names = element.get('class')
+            if class_names:
+                for class_name in set(CLASS_SEPARATOR_REGEX.split(class_names)):
+                    if class_name:
+                        self.classes.setdefault(class_name, []).append(element)
+
+        # the tokens of the document, as returned by get_selector_tokens
+        self.tokens = {
+            'id': self.ids,
+            'class': self.classes,
+            'tag': set(tag.lower() for tag in self.tags),
+        }
+
+    def find_candidates(self, token_index):
+        """Returns the positions of the rules of an inverted index, as built by
+        build_token_index, that are indexed under a token of the document. It takes time
+        proportional to the smallest of the document and the index
+
+        Returns:
+            a sorted list of positions
+        """
+        positions = list(token_index.get(None, ()))
+        if len(token_index) < sum(len(names) for names in self.tokens.values()):
+            for token, these_positions in token_index.items():
+                if token is not None and token[1] in self.tokens[token[0]]:
+                    positions.extend(these_positions)
+        else:
+            for kind, names in self.tokens.items():
+                for name in names:
+                    positions.extend(token_index.get((kind, name), ()))
+        positions.sort()
+        return positions
+
+    def has_tokens(self, tokens):
+        """Checks if the document has all the provided tokens. If it doesn't, a selector
+        requiring them can't match any element
+        """
+        for kind, name in tokens:
+            if name not in self.tokens[kind]:
+                return False
+        return True
+
+    def candidates(self, compound):
+        """Returns the smallest list of elements that may match the compound selector
+        """
+        if compound.ids:
+            return self.ids.get(compound.ids[0], ())
+        buckets = [self.classes.get(class_name, ()) for class_name in compound.classes]
+        if compound.tag:
+            buckets.append(self.tags.get(compound.tag, ()))
+        if not buckets:
+            return self.elements
+        return min(buckets, key=len)
+
+
+class SelectorMatcher(object):
+    """Matches a selector right to left, starting from the elements of the index that match its
+    rightmost compound selector, the same way browsers do
+    """
+
+    __slots__ = ('selector', 'steps')
+
+    def __init__(self, selector, steps):
+        self.selector = selector
+        self.steps = steps
+
+    def __getstate__(self):
+        return self.selector, self.steps
+
+    def __setstate__(self, state):
+        self.selector, self.steps = state
+
+    def select(self, index):
+        """Returns the elements in the index matching the selector, in document order
+        """
+        return [
+            element for element in index.candidates(self.steps[0][0])
+            if _matches(element, self.steps, 0)
+        ]
+
+    def matches(self, element):
+        return _matches(element, self.steps, 0)
+
+
+class XPathMatcher(object):
+    """Matches a selector by evaluating its XPath translation over the whole document. Used for
+    the selectors the SelectorMatcher doesn't support
+    """
+
+    __slots__ = ('selector', 'method')
+
+    def __init__(self, selector, method):
+        self.selector = selector
+        self.method = method
+        # fail early if the selector isn't valid
+        get_selector(selector, method)
+
+    def __getstate__(self):
+        return self.selector, self.method
+
+    def __setstate__(self, state):
+        self.selector, self.method = state
+
+    def select(self, index):
+        return get_selector(self.selector, self.method)(index.root)
+
+    def matches(self, element):
+        return element in get_selector(self.selector, self.method)(element.getroottree())
+
+
+def _matches(element, steps, position):
+    """Checks if the element matches the steps, starting at the provided position
+    """
+    compound, combinator = steps[position]
+    if not _matches_compound(element, compound):
+        return False
+    if combinator is None:
+        return True
+
+    position += 1
+    if combinator == '>':
+        parent = element.getparent()
+        return parent is not None and _matches(parent, steps, position)
+    elif combinator == ' ':
+        return any(_matches(ancestor, steps, position) for ancestor in element.iterancestors())
+    elif combinator == '+':
+        for sibling in element.itersiblings(etree.Element, preceding=True):
+            return _matches(sibling, steps, position)
+        return False
+    elif combinator == '~':
+        return any(
+            _matches(sibling, steps, position)
+            for sibling in element.itersiblings(etree.Element, preceding=True)
+        )
+    raise UnsupportedSelector(combinator)
+
+
+def _matches_compound(element, compound):
+    """Checks if the element matches a compound selector
+    """
+    if compound.tag is not None and element.tag != compound.tag:
+        return False
+    for element_id in compound.ids:
+        if element.get('id') != element_id:
+            return False
+    if compound.classes:
+        class_names = CLASS_SEPARATOR_REGEX.split(element.get('class', ''))
+        for class_name in compound.classes:
+            if class_name not in class_names:
+                return False
+    for name, operator, value in compound.attribs:
+        if not _matches_attrib(element.get(name), operator, value):
+            return False
+    for name, a, b in compound.pseudos:
+        if not _matches_pseudo(element, name, a, b):
+            return False
+    for negation in compound.negations:
+        if _matches_compound(element, negation):
+            return False
+    return True
+
+
+def _matches_attrib(actual, operator, value):
+    """Checks an attribute value against an attribute selector, like cssselect's translation
+    """
+    if operator == 'exists':
+        return actual is not None
+    if operator == '!=':
+        if value:
+            return actual is None or actual != value
+        return actual is not None and actual != value
+    if actual is None:
+        return False
+    if operator == '=':
+        return actual == value
+    if operator == '~=':
+        return (bool(value) and CLASS_SEPARATOR_REGEX.search(value) is None and
+                value in CLASS_SEPARATOR_REGEX.split(actual))
+    if operator == '|=':
+        return actual == value or actual.startswith(value + '-')
+    if operator == '^=':
+        return bool(value) and actual.startswith(value)
+    if operator == '$=':
+        return bool(value) and actual.endswith(value)
+    if operator == '*=':
+        return bool(value) and value in actual
+    raise UnsupportedSelector(operator)
+
+
+def _count_siblings(element, preceding, of_type):
+    """Counts the element siblings before or after the element
+    """
+    tag = element.tag if of_type else etree.Element
+    return sum(1 for __ in element.itersiblings(tag, preceding=preceding))
+
+
+def _matches_pseudo(element, name, a, b):
+    """Checks if the element matches a structural pseudo class
+    """
+    if name == 'root':
+        return element.getparent() is None
+
+    of_type = name.endswith('of-type')
+    if name in ('first-child', 'first-of-type'):
+        return _count_siblings(element, True, of_type) == 0
+    if name in ('last-child', 'last-of-type'):
+        return _count_siblings(element, False, of_type) == 0
+    if name in ('only-child', 'only-of-type'):
+        return (_count_siblings(element, True, of_type) == 0 and
+                _count_siblings(element, False, of_type) == 0)
+
+    # :nth-child(an+b) and friends match when there are an+b-1 siblings before (or after)
+    # the element, for some n >= 0
+    count = _count_siblings(element, not name.startswith('nth-last'), of_type)
+    difference = count - (b - 1)
+    if a == 0:
+        return difference == 0
+    return difference % a == 0 and difference // a >= 0
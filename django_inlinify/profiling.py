@@ -0,0 +1,166 @@
+"""Profiling of the CSS rules.
+
+An Inlinify instance created with a SelectorProfiler records, for every rule of its stylesheets
+and of the <style> blocks, how long matching its selector took and how many elements it matched,
+across all the transformations:
+
+    profiler = SelectorProfiler()
+    p = Inlinify(css_files=['/path/to/email.css'], profiler=profiler)
+    for html in emails:
+        p.transform(html)
+
+    print(profiler.format_report())
+    unused = profiler.never_matched()
+    open('/path/to/trimmed.css', 'w').write(profiler.trimmed_css())
+"""
+from __future__ import absolute_import, unicode_literals
+import threading
+from collections import OrderedDict, namedtuple
+
+from django_inlinify.css_tools import SPECIFICITY_BITS
+
+__all__ = ['SelectorProfiler', 'SelectorStats']
+
+# Bits of the packed specificity holding the index of the ruleset and the index of the rule
+ORDER_MASK = (1 << (SPECIFICITY_BITS[-2] + SPECIFICITY_BITS[-1])) - 1
+
+# The profile of a rule:
+#   - selector: the CSS selector
+#   - bulk: the CSS declarations, as a string
+#   - evaluations: the number of documents the selector was matched against. Rules skipped because
+#     the document lacks an id, class name or tag name they require aren't evaluated
+#   - matches: the total number of elements matched
+#   - documents: the number of documents with at least one matching element
+#   - total_time: the time spent matching the selector, in seconds
+#   - max_time: the longest time spent matching the selector in a document, in seconds
+#   - style_block: whether the rule comes from a <style> block instead of a stylesheet
+SelectorStats = namedtuple('SelectorStats', ['selector', 'bulk', 'evaluations', 'matches',
+                                             'documents', 'total_time', 'max_time',
+                                             'style_block'])
+
+
+class SelectorProfiler(object):
+    """Records the time spent matching every rule, and the number of elements it matched. Thread
+    safe, and can be shared by many Inlinify instances
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (selector, bulk) -> [evaluations, matches, documents, total_time, max_time, order,
+            # style_block]
+            self._stats = {}
+            # fingerprint -> plan, for the plans used since the last reset
+            self._plans = OrderedDict()
+
+    def add_plan(self, plan):
+        """Registers the rules of a plan, so the ones that are never evaluated are reported too
+        """
+        key = plan.fingerprint or id(plan)
+        if key in self._plans:
+            return
+        with self._lock:
+            if key in self._plans:
+                return
+            self._plans[key] = plan
+            for rule in plan.rules:
+                stats = self._stats.setdefault((rule.selector, rule.bulk),
+                                               [0, 0, 0, 0.0, 0.0, None, False])
+                if stats[5] is None:
+                    stats[5] = rule.specificity & ORDER_MASK
+
+    def add(self, timings, style_rules=()):
+        """Adds the timings of a transformation
+
+        Arguments:
+            - list timings: (PlanRule, seconds, number of matched elements) tuples
+            - iterable style_rules: the PlanRule records of the <style> blocks of the document
+        """
+        style_rules = set((rule.selector, rule.bulk) for rule in style_rules)
+        with self._lock:
+            for rule, elapsed, matches in timings:
+                key = (rule.selector, rule.bulk)
+                stats = self._stats.get(key)
+                if stats is None:
+                    stats = self._stats[key] = [0, 0, 0, 0.0, 0.0, None, key in style_rules]
+                stats[0] += 1
+                stats[1] += matches
+                stats[2] += 1 if matches else 0
+                stats[3] += elapsed
+                stats[4] = max(stats[4], elapsed)
+
+    def _records(self):
+        with self._lock:
+            return [
+                SelectorStats(selector, bulk, evaluations, matches, documents, total_time,
+                              max_time, style_block)
+                for (selector, bulk), (evaluations, matches, documents, total_time, max_time,
+                                       __, style_block) in self._stats.items()
+            ]
+
+    def report(self, limit=None):
+        """Returns the profiles of the rules, the costliest first
+
+        Arguments:
+            - int limit: the maximum number of rules to return
+
+        Returns:
+            a list of SelectorStats records
+        """
+        records = sorted(self._records(), key=lambda stats: (-stats.total_time, stats.selector))
+        return records[:limit] if limit is not None else records
+
+    def never_matched(self):
+        """Returns the profiles of the rules of the stylesheets that didn't match any element,
+        in the order of the stylesheets
+        """
+        with self._lock:
+            orders = dict((key, stats[5]) for key, stats in self._stats.items())
+        records = [
+            stats for stats in self._records() if not stats.matches and not stats.style_block
+        ]
+        return sorted(records, key=lambda stats: orders[(stats.selector, stats.bulk)] or 0)
+
+    def trimmed_css(self, plan=None):
+        """Returns the CSS of a plan without the rules that never matched any element. In-lining
+        it gives the same result as the original CSS for the profiled documents
+
+        Arguments:
+            - InlinePlan plan: the plan. Defaults to the last one used
+
+        Returns:
+            a CSS string
+        """
+        with self._lock:
+            if plan is None:
+                if not self._plans:
+                    return ''
+                plan = next(reversed(self._plans.values()))
+            matched = set(key for key, stats in self._stats.items() if stats[1])
+
+        rules = sorted(
+            (rule for rule in plan.rules if (rule.selector, rule.bulk) in matched),
+            key=lambda rule: rule.specificity & ORDER_MASK
+        )
+        parts = ['%s {%s}' % (rule.selector, rule.bulk) for rule in rules]
+        parts.extend(plan.leftovers)
+        return '\n'.join(parts)
+
+    def format_report(self, limit=20):
+        """Returns a human readable report of the costliest rules, and of the rules that never
+        matched any element
+        """
+        lines = ['%10s %8s %8s %8s  %s' % ('total (ms)', 'evals', 'matches', 'docs', 'selector')]
+        for stats in self.report(limit):
+            lines.append('%10.2f %8d %8d %8d  %s' % (stats.total_time * 1000, stats.evaluations,
+                                                     stats.matches, stats.documents,
+                                                     stats.selector))
+        never_matched = self.never_matched()
+        if never_matched:
+            lines.append('')
+            lines.append('%d rules never matched:' % len(never_matched))
+            lines.extend('    %s' % stats.selector for stats in never_matched)
+        return '\n'.join(lines)
@@ -0,0 +1,185 @@
+"""Incremental in-lining of a document being edited.
+
+An InlineSession keeps the parsed document, the candidate rules and the declarations computed for
+every element, so replacing an element only matches the rules against the new element, its
+descendants and the siblings whose structural pseudo classes or sibling combinators may match
+differently:
+
+    session = Inlinify(css_files=['/path/to/email.css']).session(html)
+    session.html
+    session.update('#intro', '<p id="intro" class="lead">Hello again</p>')
+"""
+from __future__ import absolute_import, unicode_literals
+
+from lxml import etree
+from django_inlinify.inlinify import _get_parser
+from django_inlinify.matching import DocumentIndex, SelectorMatcher, get_matcher, get_selector
+
+__all__ = ['InlineSession']
+
+
+class InlineSession(object):
+    """A document in-lined once, and re-styled incrementally when its elements are replaced
+
+    Arguments:
+        - Inlinify inlinify: the instance in-lining the document
+        - str html: the HTML document
+        - bool pretty_print: whether to pretty print the output
+        - kwargs: lxml.etree.tostring options, as for `Inlinify.transform`
+    """
+
+    def __init__(self, inlinify, html, pretty_print=True, **kwargs):
+        self.inlinify = inlinify
+        self.pretty_print = pretty_print
+        self.kwargs = kwargs
+        self.plan = inlinify._get_plan(inlinify._load())
+        self._root, self.page = inlinify._parse(html)
+
+        # the declarations of the CSS rules of every styled element, without its inline style
+        self._computed = {}
+        # the attributes of the styled elements before they were styled
+        self._originals = {}
+        self._mapped_attributes = frozenset(
+            ['style'] + [name for name, __ in
+                         inlinify.css_parser.DJANGO_INLINIFY_CSS_HTML_ATTRIBUTE_MAPPING.values()]
+        )
+
+        self._style_blocks = inlinify._process_style_block(self.page)
+        # the <style> blocks added with the CSS that can't be in-lined aren't parsed again when
+        # the ones of the document change
+        self._leftover_styles = inlinify._append_leftover_styles(self.page, self.plan.leftovers)
+        self._restyle([self.page])
+        inlinify._transform_urls(self.page)
+        self._html = None
+
+    @property
+    def html(self):
+        """The in-lined document
+        """
+        if self._html is None:
+            self._html = self.inlinify._serialize(self._root, self.pretty_print,
+                                                  dict(self.kwargs))
+        return self._html
+
+    def declarations(self, element):
+        """Returns the declarations of the CSS rules matching an element of the document, without
+        its inline style
+        """
+        return dict(self._computed.get(element, {}))
+
+    def update(self, selector, html):
+        """Replaces an element of the document, and re-styles the elements that may be affected
+
+        Arguments:
+            - str selector: CSS selector of the element to replace. The first matching element is
+              replaced
+            - str html: the HTML of the new element, without in-lined styles
+
+        Returns:
+            the updated in-lined document
+
+        Raises:
+            ValueError if no element matches the selector, or if the html isn't a single element
+        """
+        matched = get_selector(selector, self.inlinify.method)(self.page)
+        if not matched:
+            raise ValueError('No element matches {0}'.format(selector))
+        old = matched[0]
+        parent = old.getparent()
+        if parent is None:
+            raise ValueError('The root element can\'t be replaced')
+        new = self._parse_element(html)
+        new.tail = old.tail
+
+        for element in old.iter():
+            self._computed.pop(element, None)
+            self._originals.pop(element, None)
+        parent.replace(old, new)
+
+        if self._has_style_block(old) or self._has_style_block(new):
+            # the rules changed, so every element may be affected
+            self._style_blocks = self.inlinify._process_style_block(
+                self.page, exclude=self._leftover_styles)
+            self._restyle([self.page])
+        else:
+            # The following siblings may match rules with the `+` and `~` combinators or the
+            # `of-type` pseudo classes differently. Replacing an element with one of another type
+            # changes the `of-type` positions of the preceding ones too. As the number of
+            # elements doesn't change, the `nth-child`, `first-child` and `last-child` positions
+            # stay the same
+            siblings = list(new.itersiblings(etree.Element))
+            if new.tag != old.tag:
+                siblings.extend(new.itersiblings(etree.Element, preceding=True))
+            self._restyle([new] + siblings)
+
+        self.inlinify._transform_urls(new)
+        self._html = None
+        return self.html
+
+    def _parse_element(self, html):
+        parser = _get_parser(self.inlinify.method)
+        if self.inlinify.method == 'html':
+            body = etree.fromstring('<html><body>{0}</body></html>'.format(html.strip()),
+                                    parser).find('body')
+            elements = list(body) if body is not None else []
+            if len(elements) != 1 or (body.text or '').strip() or (elements[0].tail or '').strip():
+                raise ValueError('The html must be a single element')
+            element = elements[0]
+        else:
+            element = etree.fromstring(html.strip(), parser)
+        element.tail = None
+        return element
+
+    def _has_style_block(self, element):
+        return any(True for __ in element.iter('style'))
+
+    def _restyle(self, roots):
+        """Matches the rules against the elements of the provided subtrees, and writes the styles
+        of the ones whose declarations changed
+        """
+        inlinify = self.inlinify
+        index = DocumentIndex(self.page)
+        rules, __ = inlinify._get_rules(index, self.plan, self._style_blocks)
+        elements = [element for root in roots for element in root.iter(etree.Element)]
+
+        computed_styles = {}
+        selected = None
+        for rule in rules:
+            if not index.has_tokens(rule.tokens):
+                continue
+            matcher = rule.matcher or get_matcher(rule.selector, inlinify.method)
+            if isinstance(matcher, SelectorMatcher):
+                matched = [element for element in elements if matcher.matches(element)]
+            else:
+                # XPath selectors are evaluated over the whole document
+                if selected is None:
+                    selected = set(elements)
+                matched = [element for element in matcher.select(index) if element in selected]
+            for element in matched:
+                declarations = computed_styles.get(element)
+                if declarations is None:
+                    declarations = computed_styles[element] = {}
+                declarations.update(rule.declarations)
+
+        changed = {}
+        for element in elements:
+            declarations = computed_styles.get(element)
+            if declarations == self._computed.get(element):
+                continue
+            original = self._originals.get(element)
+            if original is None:
+                original = self._originals[element] = dict(
+                    (name, element.get(name)) for name in self._mapped_attributes
+                )
+            else:
+                for name, value in original.items():
+                    if value is None:
+                        element.attrib.pop(name, None)
+                    else:
+                        element.set(name, value)
+            if declarations:
+                self._computed[element] = declarations
+                changed[element] = dict(declarations)
+            else:
+                self._computed.pop(element, None)
+        inlinify._write_element_styles(changed)
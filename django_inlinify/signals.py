@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent after every transformation of an Inlinify instance, if the signal has any receiver. The
+# arguments are:
+#   - inlinify: the Inlinify instance
+#   - durations: dictionary mapping the phases of the transformation to their duration, in seconds
+#   - counts: dictionary with the counters of the transformation
+# See django_inlinify.instrumentation for the phases and the counters
+transform_finished = Signal()
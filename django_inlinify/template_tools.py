@@ -0,0 +1,441 @@
+"""In-lining of Django templates.
+
+The parts of a template enclosed in `{% inlinify %}` ... `{% endinlinify %}` are in-lined once,
+when the template is loaded, instead of every time it's rendered: the template tags, variables
+and comments are replaced with placeholders that survive the lxml round trip, the resulting HTML
+is in-lined, and the placeholders are replaced with the original tags. Rendering the template
+then only substitutes the variables.
+
+Templates that `{% extends %}` another one are flattened first, by replacing the blocks of the
+parent templates with the ones of the child, so the markup of the blocks is in-lined with the
+markup around it.
+"""
+from __future__ import absolute_import, unicode_literals
+import logging
+import re
+import threading
+
+from django.template.base import (BLOCK_TAG_START, COMMENT_TAG_START, VARIABLE_TAG_START,
+                                  tag_re)
+from django.utils.text import smart_split
+from django_inlinify.inlinify import Inlinify
+
+__all__ = ['flatten', 'get_inlinify', 'inline_regions', 'inline_template', 'parse_css_files']
+
+log = logging.getLogger(__name__)
+
+INLINIFY_TAG = 'inlinify'
+END_INLINIFY_TAG = 'endinlinify'
+
+# Placeholders of the template tags: a comment between elements, and a word inside an element's
+# start tag, as attribute names and values
+PLACEHOLDER_COMMENT = '<!--djinlph%d-->'
+PLACEHOLDER_WORD = 'djinlph%dx'
+PLACEHOLDER_REGEX = re.compile(r'<!--djinlph(\d+)-->|djinlph(\d+)x(="")?')
+
+# Tags repeating or choosing markup. The skeleton of the template has a single copy of it, so
+# structural pseudo classes and sibling combinators would match differently once rendered
+CONDITIONAL_TAGS = frozenset(['for', 'if', 'ifchanged', 'ifequal', 'ifnotequal', 'cycle'])
+STRUCTURAL_SELECTOR_REGEX = re.compile(r':(first|last|only|nth)-|[+~]')
+
+# Attributes whose value decides the rules matching an element, or is rewritten when in-lining
+MATCHED_ATTRIBUTES = frozenset(['class', 'id', 'style'])
+
+# The name of the attribute whose value a start tag ends in, such as `href` for `<a href="/`
+ATTRIBUTE_VALUE_REGEX = re.compile(r'([^\s"\'<>/=]+)\s*=\s*(?:"[^"]*|\'[^\']*|[^\s"\'>]*)$')
+
+# The start and end tags of an HTML, and its comments. lxml adds the tags of the document when
+# they're missing, as it does when in-lining the rendered template
+TAG_REGEX = re.compile(r'<(/?)([a-zA-Z][^\s/>]*)')
+COMMENT_REGEX = re.compile(r'<!--.*?-->', re.DOTALL)
+DOCUMENT_TAGS = frozenset(['html', 'head', 'body'])
+
+STYLE_BLOCK_REGEX = re.compile(r'<style[^>]*>(.*?)</style>', re.DOTALL | re.IGNORECASE)
+DECLARATIONS_REGEX = re.compile(r'\{[^{}]*\}')
+
+# The Inlinify instances used to in-line the templates, by CSS files
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def get_inlinify(css_files):
+    """Returns the Inlinify instance used to in-line templates with the provided CSS files,
+    creating it if needed. Instances are shared, so the CSS is parsed once
+
+    Arguments:
+        - tuple css_files: the paths or URLs of the CSS files
+    """
+    css_files = tuple(css_files)
+    inlinify = _instances.get(css_files)
+    if inlinify is None:
+        with _instances_lock:
+            inlinify = _instances.get(css_files)
+            if inlinify is None:
+                inlinify = _instances[css_files] = Inlinify(css_files=list(css_files) or None)
+    return inlinify
+
+
+def _is_tag(bit):
+    return bit.startswith((BLOCK_TAG_START, VARIABLE_TAG_START, COMMENT_TAG_START))
+
+
+def _tag_contents(bit):
+    """Returns the contents of a template tag, without the delimiters
+    """
+    return bit[2:-2].strip()
+
+
+def _tag_name(bit):
+    """Returns the name of a block tag, such as `block` for `{% block content %}`, or None for
+    text, variables and comments
+    """
+    if not bit.startswith(BLOCK_TAG_START):
+        return None
+    contents = _tag_contents(bit)
+    return contents.split(None, 1)[0] if contents else None
+
+
+def parse_css_files(contents):
+    """Returns the CSS files of an `inlinify` tag
+
+    Arguments:
+        - str contents: the contents of the tag, such as `inlinify "css/email.css"`
+
+    Returns:
+        a tuple with the paths or URLs of the CSS files
+
+    Raises:
+        ValueError if an argument isn't a string literal
+    """
+    css_files = []
+    for bit in list(smart_split(contents))[1:]:
+        if len(bit) < 2 or bit[0] not in '"\'' or bit[-1] != bit[0]:
+            raise ValueError('The arguments of the inlinify tag must be string literals, '
+                             'got %s' % bit)
+        css_files.append(bit[1:-1])
+    return tuple(css_files)
+
+
+def _protect(bits):
+    """Replaces the template tags of a list of template bits with placeholders
+
+    Returns:
+        a tuple with the HTML and the list of the replaced tags
+    """
+    parts = []
+    tags = []
+    in_element = False
+    for bit in bits:
+        if _is_tag(bit):
+            placeholder = PLACEHOLDER_WORD if in_element else PLACEHOLDER_COMMENT
+            parts.append(placeholder % len(tags))
+            tags.append(bit)
+        else:
+            parts.append(bit)
+            # whether the text ends inside an element's start tag, such as `<a href="`
+            start, end = bit.rfind('<'), bit.rfind('>')
+            if start != end:
+                in_element = start > end
+    return ''.join(parts), tags
+
+
+def _tag_sequence(html):
+    """Returns the start and end tags of an HTML, as (slash, name) tuples, without the ones in
+    comments
+    """
+    html = COMMENT_REGEX.sub('', html)
+    return [(slash, name.lower()) for slash, name in TAG_REGEX.findall(html)]
+
+
+def _restore(html, tags, protected):
+    """Replaces the placeholders of an in-lined HTML with the original template tags
+
+    Arguments:
+        - str html: the in-lined HTML
+        - list tags: the replaced template tags (see `_protect`)
+        - str protected: the HTML before it was in-lined
+
+    Returns:
+        the template source, or None if some placeholders were lost or duplicated, or if the
+        round trip changed the elements, such as when closing an element opened in both branches
+        of an `{% if %}` tag
+    """
+    expected = _tag_sequence(protected)
+    names = set(name for _, name in expected)
+    # the document tags added by lxml are ignored
+    sequence = [(slash, name) for slash, name in _tag_sequence(html)
+                if name in names or name not in DOCUMENT_TAGS]
+    if sequence != expected:
+        return None
+
+    found = [0] * len(tags)
+
+    def replace(match):
+        index = int(match.group(1) or match.group(2))
+        if index >= len(tags):
+            return match.group(0)
+        found[index] += 1
+        return tags[index]
+
+    source = PLACEHOLDER_REGEX.sub(replace, html)
+    if any(count != 1 for count in found):
+        return None
+    return source
+
+
+def _get_selectors(inlinify, source):
+    """Returns the selectors of the rules of the CSS files, and the text of the <style> blocks of
+    the template without their declarations
+    """
+    selectors = [rule.selector for rule in inlinify._get_plan(inlinify._load()).rules]
+    selectors.extend(DECLARATIONS_REGEX.sub(' ', css) for css in STYLE_BLOCK_REGEX.findall(source))
+    return selectors
+
+
+def _render_time_reason(bits, selectors):
+    """Tells why a template would be styled differently when in-lined before it's rendered
+
+    Arguments:
+        - list bits: the template bits
+        - list selectors: the selectors of the rules (see `_get_selectors`)
+
+    Returns:
+        the reason, or None if the template can be in-lined before it's rendered
+    """
+    start_tag = None
+    conditional = False
+    for bit in bits:
+        if not _is_tag(bit):
+            start, end = bit.rfind('<'), bit.rfind('>')
+            if start > end:
+                start_tag = bit[start:]
+            elif end > start:
+                start_tag = None
+            elif start_tag is not None:
+                start_tag += bit
+            continue
+        if _tag_name(bit) in CONDITIONAL_TAGS:
+            conditional = True
+        if start_tag is None or bit.startswith(COMMENT_TAG_START):
+            continue
+        if bit.startswith(BLOCK_TAG_START):
+            return 'the tag %s is inside a start tag' % bit
+        match = ATTRIBUTE_VALUE_REGEX.search(start_tag)
+        if match is None:
+            return 'the variable %s is an attribute' % bit
+        name = match.group(1).lower()
+        if name in MATCHED_ATTRIBUTES or any(
+                re.search(r'\[\s*%s\b' % re.escape(name), selector) for selector in selectors):
+            return 'the variable %s is in the %s attribute' % (bit, name)
+        start_tag += PLACEHOLDER_WORD % 0
+
+    if conditional and any(STRUCTURAL_SELECTOR_REGEX.search(selector) for selector in selectors):
+        return ('the template has loops or conditions, and the CSS has structural pseudo classes '
+                'or sibling combinators')
+    return None
+
+
+def inline_template(source, inlinify):
+    """In-lines the CSS in an HTML template, keeping its template tags
+
+    Arguments:
+        - str source: the template source
+        - Inlinify inlinify: the instance to use
+
+    Returns:
+        the in-lined template source, or None if it would be styled differently than when
+        in-lining the rendered template, or if the template tags or elements couldn't be kept,
+        such as when the tags are in a <style> block or outside of the root element
+    """
+    bits = tag_re.split(source)
+    reason = _render_time_reason(bits, _get_selectors(inlinify, source))
+    if reason is not None:
+        log.info('The template will be in-lined when rendered: %s', reason)
+        return None
+    html, tags = _protect(bits)
+    return _restore(inlinify.transform(html, pretty_print=False), tags, html)
+
+
+def inline_regions(source):
+    """In-lines the parts of a template enclosed in `{% inlinify %}` tags, and removes the tags.
+    Parts that can't be in-lined are left unchanged, so they are in-lined when rendered
+
+    Returns:
+        the template source
+    """
+    bits = tag_re.split(source)
+    output = []
+    start = None
+    for index, bit in enumerate(bits):
+        name = _tag_name(bit)
+        if name == INLINIFY_TAG and start is None:
+            start = index
+        elif name == END_INLINIFY_TAG and start is not None:
+            region = None
+            try:
+                inlinify = get_inlinify(parse_css_files(_tag_contents(bits[start])))
+                region = inline_template(''.join(bits[start + 1:index]), inlinify)
+            except Exception:
+                log.exception('Could not in-line the template')
+            if region is None:
+                log.warning('Could not in-line the template when loading it, it will be '
+                            'in-lined when rendered')
+                output.extend(bits[start:index + 1])
+            else:
+                output.append(region)
+            start = None
+        elif start is None:
+            output.append(bit)
+    if start is not None:
+        output.extend(bits[start:])
+    return ''.join(output)
+
+
+class _Block(object):
+    """A `{% block %}` of a template, with the bits between its start and end tags
+    """
+
+    def __init__(self, name, start, end=None, children=None):
+        self.name = name
+        self.start = start
+        self.end = end
+        self.children = children if children is not None else []
+
+    def copy(self, children):
+        return _Block(self.name, self.start, self.end, children)
+
+
+def _parse_blocks(bits):
+    """Builds the tree of the blocks of a template
+
+    Returns:
+        a list of text bits, template tags and _Block instances
+    """
+    root = []
+    stack = [root]
+    blocks = []
+    for bit in bits:
+        name = _tag_name(bit)
+        if name == 'block':
+            block = _Block(_tag_contents(bit).split()[1], bit)
+            stack[-1].append(block)
+            blocks.append(block)
+            stack.append(block.children)
+        elif name == 'endblock' and blocks:
+            blocks.pop().end = bit
+            stack.pop()
+        else:
+            stack[-1].append(bit)
+    if blocks:
+        raise ValueError('Unclosed block tag')
+    return root
+
+
+def _find_blocks(items, blocks=None):
+    """Returns the blocks of a tree, including the nested ones, by name
+    """
+    if blocks is None:
+        blocks = {}
+    for item in items:
+        if isinstance(item, _Block):
+            blocks.setdefault(item.name, item)
+            _find_blocks(item.children, blocks)
+    return blocks
+
+
+def _is_block_super(bit):
+    if not bit.startswith(VARIABLE_TAG_START):
+        return False
+    contents = _tag_contents(bit)
+    if contents.startswith('block.super'):
+        if contents != 'block.super':
+            raise ValueError('block.super with filters is not supported')
+        return True
+    return False
+
+
+def _with_super(items, name, parents):
+    """Replaces the `{{ block.super }}` variables of the children of a block with the contents of
+    the block in the parent template
+    """
+    result = []
+    for item in items:
+        if isinstance(item, _Block):
+            result.append(item.copy(_with_super(item.children, item.name, parents)))
+        elif _is_block_super(item):
+            parent = parents.get(name)
+            if parent is not None:
+                result.extend(parent.children)
+        else:
+            result.append(item)
+    return result
+
+
+def _override(items, overrides, parents):
+    """Replaces the blocks of a parent template with the ones of a child template
+    """
+    result = []
+    for item in items:
+        if not isinstance(item, _Block):
+            result.append(item)
+        elif item.name in overrides:
+            block = overrides[item.name]
+            result.append(item.copy(_with_super(block.children, block.name, parents)))
+        else:
+            result.append(item.copy(_override(item.children, overrides, parents)))
+    return result
+
+
+def _render_tree(items, output):
+    for item in items:
+        if isinstance(item, _Block):
+            output.append(item.start)
+            _render_tree(item.children, output)
+            output.append(item.end)
+        else:
+            output.append(item)
+    return output
+
+
+def _flatten(source, get_source, seen):
+    bits = tag_re.split(source)
+    extends = None
+    for bit in bits:
+        if _tag_name(bit) == 'extends':
+            extends = bit
+            break
+    if extends is None:
+        return _parse_blocks(bits)
+
+    parent_name = _tag_contents(extends).split(None, 1)[1].strip()
+    if len(parent_name) < 2 or parent_name[0] not in '"\'' or parent_name[-1] != parent_name[0]:
+        raise ValueError('Only templates extending a string literal can be flattened')
+    parent_name = parent_name[1:-1]
+    if parent_name in seen:
+        raise ValueError('%s extends itself' % parent_name)
+    parent = _flatten(get_source(parent_name), get_source, seen + (parent_name, ))
+
+    # the tag libraries loaded by the child template are needed by its blocks
+    children = _parse_blocks(bits)
+    loads = [bit for bit in children if not isinstance(bit, _Block) and _tag_name(bit) == 'load']
+    tree = _override(parent, _find_blocks(children), _find_blocks(parent))
+    return loads + tree
+
+
+def flatten(source, get_source):
+    """Flattens a template extending another one: the blocks of the parent templates are
+    replaced with the ones of the child, and `{{ block.super }}` with the contents of the parent
+    blocks
+
+    Arguments:
+        - str source: the source of the template
+        - callable get_source: returns the source of a template from its name
+
+    Returns:
+        the source of the flattened template
+
+    Raises:
+        ValueError if the template can't be flattened, such as when the name of the parent
+        template is a variable
+    """
+    return ''.join(_render_tree(_flatten(source, get_source, ()), []))
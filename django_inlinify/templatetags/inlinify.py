@@ -0,0 +1,37 @@
+from __future__ import absolute_import, unicode_literals
+
+from django import template
+from django.utils.safestring import mark_safe
+from django_inlinify.template_tools import END_INLINIFY_TAG, get_inlinify, parse_css_files
+
+register = template.Library()
+
+
+class InlinifyNode(template.Node):
+
+    def __init__(self, nodelist, css_files):
+        self.nodelist = nodelist
+        self.css_files = css_files
+
+    def render(self, context):
+        html = self.nodelist.render(context)
+        return mark_safe(get_inlinify(self.css_files).transform(html, pretty_print=False))
+
+
+@register.tag
+def inlinify(parser, token):
+    """In-lines the CSS of the enclosed HTML, with the provided CSS files and the <style> blocks
+    of the HTML:
+
+        {% inlinify "/path/to/email.css" %}<html>...</html>{% endinlinify %}
+
+    With django_inlinify.loaders.Loader, the enclosed template is in-lined once, when loaded.
+    Otherwise, the HTML is in-lined every time the template is rendered
+    """
+    try:
+        css_files = parse_css_files(token.contents)
+    except ValueError as e:
+        raise template.TemplateSyntaxError(str(e))
+    nodelist = parser.parse((END_INLINIFY_TAG, ))
+    parser.delete_first_token()
+    return InlinifyNode(nodelist, css_files)
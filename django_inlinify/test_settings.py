@@ -7,3 +7,6 @@ CACHES = {
 
 # django will complain if we don't include this
 SECRET_KEY = 'dummysecret'
+
+# for the template tags
+INSTALLED_APPS = ['django_inlinify']
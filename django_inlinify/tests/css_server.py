@@ -0,0 +1,74 @@
+"""HTTP server serving CSS files to the tests, from a thread
+"""
+from __future__ import absolute_import, unicode_literals
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class CSSRequestHandler(BaseHTTPRequestHandler):
+    """Serves the files in the server's `files` dictionary, waiting `delay` seconds before
+    answering requests for paths containing 'slow'
+    """
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        if 'slow' in self.path:
+            time.sleep(self.server.delay)
+        body = self.server.files.get(self.path.split('?')[0])
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"%s"' % len(body)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/css')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CSSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files, delay=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), CSSRequestHandler)
+        self.files = files
+        self.delay = delay
+        self.requests = []
+
+    def url(self, path):
+        return 'http://127.0.0.1:%s%s' % (self.server_address[1], path)
+
+
+@contextmanager
+def serve(files):
+    """Serves CSS files from a thread, and gives a function returning their URLs
+
+    Arguments:
+        - dict files: maps the names of the files to their contents
+    """
+    server = CSSServer(dict(('/' + name, css.encode('utf-8')) for name, css in files.items()))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield lambda name: server.url('/' + name)
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,67 @@
+from __future__ import absolute_import, unicode_literals
+import os
+import sys
+import tempfile
+import unittest
+
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, ok_
+
+if sys.version_info < (3, 6):
+    raise SkipTest('asyncio support requires Python 3.6+')
+
+import asyncio  # noqa: E402
+
+from django_inlinify import aio  # noqa: E402
+from django_inlinify.inlinify import Inlinify  # noqa: E402
+
+from css_server import serve  # noqa: E402
+
+CSS = 'p { color: red } .intro { margin: 0 } a:hover { color: blue }'
+
+HTML = ('<html><head></head><body><p class="intro">Intro <a href="/a">link</a></p><p>Text</p>'
+        '</body></html>')
+
+
+class AsyncTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(aio.aclose())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_local_files(self):
+        """
+        atransform should give the same result as transform.
+        """
+        fd, path = tempfile.mkstemp(suffix='.css')
+        with os.fdopen(fd, 'w') as f:
+            f.write(CSS)
+        try:
+            inlinify = Inlinify(css_files=[path], base_url='http://example.com')
+            eq_(self.loop.run_until_complete(inlinify.atransform(HTML)), inlinify.transform(HTML))
+        finally:
+            os.remove(path)
+
+    def test_remote_files(self):
+        """
+        Remote CSS files should be fetched with the async client, concurrently.
+        """
+        files = {'a.css': CSS, 'b.css': 'a { text-decoration: none }'}
+        with serve(files) as url:
+            inlinify = Inlinify(css_files=[url('a.css'), url('b.css')])
+            loop = self.loop
+            results = loop.run_until_complete(
+                asyncio.gather(*[inlinify.atransform(HTML) for __ in range(10)])
+            )
+            eq_(len(set(results)), 1)
+            ok_('style="color:red; margin:0"' in results[0])
+            ok_('text-decoration:none' in results[0])
+            eq_(results[0], inlinify.transform(HTML))
+
+            inlinify = Inlinify(css_files=[url('missing.css')])
+            self.assertRaises(ValueError, loop.run_until_complete, inlinify.atransform(HTML))
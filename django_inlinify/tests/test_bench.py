@@ -0,0 +1,44 @@
+from __future__ import absolute_import, unicode_literals
+import json
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify import bench
+
+from css_server import serve
+
+
+class BenchTests(unittest.TestCase):
+
+    def test_run(self):
+        """
+        The benchmark should report the timings of every phase for every corpus.
+        """
+        report = bench.run(['transactional', 'remote', 'style_blocks'], iterations=1, scale=0.05,
+                           serve=serve)
+        eq_(sorted(report['corpora']), ['remote', 'style_blocks', 'transactional'])
+        for results in report['corpora'].values():
+            eq_(sorted(results['phases']), sorted(bench.PHASES))
+            ok_(results['transform']['median'] > 0)
+            ok_(results['throughput']['documents_per_second'] > 0)
+
+        # the report can be diffed between versions
+        eq_(json.loads(json.dumps(report)), report)
+        eq_(bench.compare(report, report), [])
+
+        # remote corpora need a server
+        with self.assertRaises(ValueError):
+            bench.run(['remote'], iterations=1, scale=0.05)
+
+    def test_compare(self):
+        """
+        Timings slower than the baseline by more than the threshold should be regressions.
+        """
+        def report(median):
+            timing = {'min': median, 'median': median, 'mean': median}
+            return {'corpora': {'small': {'transform': timing, 'phases': {'match': timing}}}}
+
+        eq_(bench.compare(report(1.05), report(1.0), threshold=0.1), [])
+        eq_(bench.compare(report(1.5), report(1.0), threshold=0.1),
+            [('small', 'transform', 1.0, 1.5), ('small', 'match', 1.0, 1.5)])
@@ -0,0 +1,130 @@
+from __future__ import absolute_import, unicode_literals
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django.core.management.base import CommandError
+from django.utils.six import StringIO
+from django_inlinify.css_tools import _local_file_signatures
+from django_inlinify.management.commands.inlinify_templates import MANIFEST_NAME, Command
+
+
+class InlinifyTemplatesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, 'src')
+        self.dest = os.path.join(self.directory, 'dest')
+        self.css = self.write('email.css', 'p { color: red }')
+        self.write('src/welcome.html', '<html><body><p>Welcome</p></body></html>')
+        self.write('src/receipts/order.html', '<html><body><p>Order</p></body></html>')
+        self.write('src/notes.txt', '<p>Not a template</p>')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, path, contents):
+        path = os.path.join(self.directory, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(contents)
+        return path
+
+    def read(self, path):
+        with io.open(os.path.join(self.dest, path), encoding='utf-8') as f:
+            return f.read()
+
+    def run_command(self, *args):
+        """Runs the command with the provided command line arguments, and returns its output
+        """
+        stdout = StringIO()
+        command = Command(stdout=stdout, stderr=StringIO())
+        parser = command.create_parser('manage.py', 'inlinify_templates')
+        if '--css' not in args:
+            args += ('--css', self.css)
+        if '--jobs' not in args:
+            args += ('--jobs', '1')
+        options = parser.parse_args([self.src, self.dest] + list(args))
+        command.execute(**vars(options))
+        return stdout.getvalue()
+
+    def test_transform(self):
+        """
+        Templates matching the pattern should be in-lined into the destination directory, with the
+        same layout.
+        """
+        output = self.run_command()
+        ok_('2 templates: 2 transformed, 0 unchanged, 0 failed' in output)
+        ok_('<p style="color:red">Welcome</p>' in self.read('welcome.html'))
+        ok_('<p style="color:red">Order</p>' in self.read('receipts/order.html'))
+        ok_(not os.path.exists(os.path.join(self.dest, 'notes.txt')))
+
+        manifest = json.loads(self.read(MANIFEST_NAME))
+        eq_(sorted(manifest['files']), ['receipts/order.html', 'welcome.html'])
+
+    def test_unchanged_templates_are_skipped(self):
+        """
+        Only the templates that changed since the last run should be transformed, unless the CSS
+        changed or the run is forced.
+        """
+        self.run_command()
+        ok_('0 transformed, 2 unchanged' in self.run_command())
+
+        self.write('src/welcome.html', '<html><body><p>Welcome back</p></body></html>')
+        ok_('1 transformed, 1 unchanged' in self.run_command())
+        ok_('<p style="color:red">Welcome back</p>' in self.read('welcome.html'))
+
+        # missing outputs are written again
+        os.remove(os.path.join(self.dest, 'receipts', 'order.html'))
+        ok_('1 transformed, 1 unchanged' in self.run_command())
+
+        other_css = self.write('other.css', 'p { color: blue }')
+        ok_('2 transformed, 0 unchanged' in self.run_command('--css', other_css))
+        ok_('<p style="color:blue">Order</p>' in self.read('receipts/order.html'))
+
+        ok_('2 transformed, 0 unchanged' in self.run_command('--css', other_css, '--force'))
+
+        # the CSS is identified by its contents, not by its modification time
+        os.utime(other_css, (0, 0))
+        _local_file_signatures.clear()
+        ok_('0 transformed, 2 unchanged' in self.run_command('--css', other_css))
+
+    def test_removed_templates(self):
+        """
+        The outputs of the templates that were removed should be removed too, even when the CSS
+        changed.
+        """
+        self.run_command()
+        os.remove(os.path.join(self.src, 'welcome.html'))
+        other_css = self.write('other.css', 'p { color: blue }')
+        output = self.run_command('--css', other_css)
+        ok_('1 templates: 1 transformed, 0 unchanged' in output)
+        ok_(not os.path.exists(os.path.join(self.dest, 'welcome.html')))
+        ok_(os.path.exists(os.path.join(self.dest, 'receipts', 'order.html')))
+        manifest = json.loads(self.read(MANIFEST_NAME))
+        eq_(sorted(manifest['files']), ['receipts/order.html'])
+
+    def test_workers(self):
+        """
+        The templates should be transformed the same way by a pool of worker processes.
+        """
+        ok_('2 transformed' in self.run_command('--jobs', '2'))
+        ok_('<p style="color:red">Order</p>' in self.read('receipts/order.html'))
+
+    def test_failures(self):
+        """
+        Templates that can't be transformed should be reported, without stopping the other ones,
+        and transformed again on the next run.
+        """
+        self.write('src/broken.html', '')
+        with self.assertRaises(CommandError):
+            self.run_command()
+        ok_('<p style="color:red">Welcome</p>' in self.read('welcome.html'))
+        manifest = json.loads(self.read(MANIFEST_NAME))
+        eq_(sorted(manifest['files']), ['receipts/order.html', 'welcome.html'])
@@ -0,0 +1,157 @@
+from __future__ import absolute_import, unicode_literals
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify.css_tools import CSSLoader
+
+from css_server import CSSServer
+
+
+class CSSLoaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.server = CSSServer({
+            '/slow.css': b'h1 { color: red }',
+            '/one.css': b'h2 { color: blue }',
+            '/two.css': b'h3 { color: green }',
+        }, delay=0.3)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_remote_files_are_fetched_concurrently(self):
+        """
+        Remote files should be fetched at the same time and returned in order.
+        """
+        urls = [self.server.url(path) for path in ('/slow.css', '/one.css', '/two.css')]
+        # make sure they are not cached from previous runs
+        urls = ['%s?%s' % (url, time.time()) for url in urls]
+        loader = CSSLoader(urls)
+        start = time.time()
+        contents = list(loader)
+        eq_(contents, [b'h1 { color: red }', b'h2 { color: blue }', b'h3 { color: green }'])
+        ok_(time.time() - start < 0.6)
+
+        # the second time they come from the cache
+        eq_(list(CSSLoader(urls)), contents)
+        eq_(len(self.server.requests), 3)
+
+    def test_missing_remote_file(self):
+        """
+        A missing remote file should raise a ValueError.
+        """
+        loader = CSSLoader([self.server.url('/missing.css')])
+        self.assertRaises(ValueError, list, loader)
+
+    def test_stale_files_are_revalidated(self):
+        """
+        Stale remote files should be served while they are revalidated in the background.
+        """
+        url = '%s?%s' % (self.server.url('/one.css'), time.time())
+        loader = CSSLoader([url])
+        loader.DJANGO_INLINIFY_CSSLOADER_CACHE_KEY_TTL = -1
+        eq_(list(loader), [b'h2 { color: blue }'])
+        eq_(self.server.requests[-1][1], None)
+
+        # the file is stale, so it is revalidated while the cached copy is served
+        eq_(list(loader), [b'h2 { color: blue }'])
+        for __ in range(100):
+            if len(self.server.requests) > 1:
+                break
+            time.sleep(0.02)
+        eq_(self.server.requests[1][1], '"18"')
+
+        # only one revalidation can run at a time
+        other_url = self.server.url('/two.css')
+        lock_key = loader._get_lock_key(other_url)
+        ok_(loader.cache.add(lock_key, 1))
+        eq_(loader._revalidate(other_url, {}), None)
+        loader.cache.delete(lock_key)
+
+    def test_remote_files_fingerprint(self):
+        """
+        Remote files should be fingerprinted by URL and ETag.
+        """
+        url = '%s?%s' % (self.server.url('/two.css'), time.time())
+        eq_(CSSLoader([url]).load_with_fingerprints(),
+            [(b'h3 { color: green }', 'url:%s:"19"' % url)])
+
+
+class LocalCSSLoaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.css')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def test_local_files_are_read_again_when_they_change(self):
+        """
+        Changes to local files should be picked up without waiting for the cache to expire.
+        """
+        self.write('h1 { color: red }')
+        loader = CSSLoader([self.path])
+        loader.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = 0
+        eq_(list(loader), ['h1 { color: red }'])
+        self.write('h1 { color: blue }')
+        eq_(list(loader), ['h1 { color: blue }'])
+
+    def test_local_files_stat_is_rate_limited(self):
+        """
+        Local files shouldn't be checked more than once per interval.
+        """
+        self.write('h1 { color: red }')
+        loader = CSSLoader([self.path])
+        loader.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = 60
+        eq_(list(loader), ['h1 { color: red }'])
+        self.write('h1 { color: blue }')
+        eq_(list(loader), ['h1 { color: red }'])
+
+    def test_local_files_fingerprint(self):
+        """
+        Local files should be fingerprinted by path and stat signature, without hashing them.
+        """
+        self.write('h1 { color: red }')
+        loader = CSSLoader([self.path])
+        loader.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = 0
+        [(contents, fingerprint)] = loader.load_with_fingerprints()
+        eq_(contents, 'h1 { color: red }')
+        ok_(fingerprint.startswith('file:%s:' % self.path))
+        self.write('h1 { color: blue, sans-serif }')
+        [(contents, other_fingerprint)] = loader.load_with_fingerprints()
+        eq_(contents, 'h1 { color: blue, sans-serif }')
+        ok_(other_fingerprint != fingerprint)
+
+    def test_missing_files_are_looked_up_once(self):
+        """
+        Files missing from the cache shouldn't be looked up in it again before being read.
+        """
+        self.write('h1 { color: red }')
+        loader = CSSLoader([self.path])
+        loader.DJANGO_INLINIFY_CSSLOADER_STAT_INTERVAL = 0
+        lookups = []
+        get_cached = loader._get_cached
+
+        def counting_get_cached(filepath):
+            lookups.append(filepath)
+            return get_cached(filepath)
+
+        loader._get_cached = counting_get_cached
+        self.write('h1 { color: blue }')
+        eq_(loader.load(), ['h1 { color: blue }'])
+        eq_(lookups, [self.path])
@@ -1,14 +1,24 @@
 from __future__ import absolute_import, unicode_literals
+import io
 import os
+import pickle
 from os.path import dirname, abspath
 from os.path import join as joinpath
 import re
+import threading
+import time
 import unittest
 
 from nose.tools import eq_, ok_
 
-from django_inlinify.inlinify import Inlinify
-from django_inlinify.css_tools import CSSParser
+from django.core.cache.backends.locmem import LocMemCache
+from lxml import etree
+from django_inlinify.caching import LRUCache, TieredCache
+from django_inlinify.inlinify import (Inlinify, TransformError, _CDATACommentWriter, _get_parser,
+                                      get_selector, matcher_cache, output_cache, selector_cache)
+from django_inlinify import inlinify as inlinify_module
+from django_inlinify.css_tools import (CSSParser, Rule, cache_stats, css_fingerprint, load_cache,
+                                      pack_specificity)
 
 whitespace_between_tags = re.compile('>\s*<')
 
@@ -40,6 +50,10 @@ def read_html_file(filename):
     return open(html_path(filename)).read()
 
 
+def add_utm(url, element, attr):
+    return url + '?utm=email' if attr == 'href' else url
+
+
 def read_css_file(filename):
     return open(css_path(filename)).read()
 
@@ -213,6 +227,32 @@ class Tests(unittest.TestCase):
         p = Inlinify(base_url='http://kungfupeople.com')
         compare_html(html, p.transform(html))
 
+    def test_url_rewriter(self):
+        """
+        The URL rewriter should be called with every URL, after joining it with the base URL.
+        """
+        html = ('<html><body><a href="/a">A</a><a href="#top">Top</a><a href="/a">A</a>'
+                '<img src="cid:logo"><img src="b.png"></body></html>')
+        calls = []
+
+        def track(url, element, attr):
+            calls.append((url, element.tag, attr))
+            return url + '?utm=email' if attr == 'href' else url
+
+        p = Inlinify(base_url='http://example.com', preserve_internal_links=True,
+                     url_rewriter=track)
+        eq_(p.base_url, 'http://example.com/')
+        result_html = p.transform(html, pretty_print=False)
+        ok_('<a href="http://example.com/a?utm=email">A</a><a href="#top">Top</a>'
+            '<a href="http://example.com/a?utm=email">A</a>' in result_html)
+        ok_('<img src="cid:logo"><img src="http://example.com/b.png">' in result_html)
+        eq_(calls, [('http://example.com/a', 'a', 'href'), ('http://example.com/a', 'a', 'href'),
+                    ('http://example.com/b.png', 'img', 'src')])
+
+        # without a base URL, the rewriter gets the URLs as they are
+        p = Inlinify(url_rewriter=track)
+        ok_('<a href="#top?utm=email">' in p.transform(html, pretty_print=False))
+
     def test_last_child(self):
         """
         :last-child selector should work correctly.
@@ -296,3 +336,397 @@ class Tests(unittest.TestCase):
         expected_output = read_html_file('test_external_css_expected.html')
         css_style_path = css_path('test_external_css.css')
         compare_html(expected_output, Inlinify(css_files=[css_style_path]).transform(html))
+
+    def test_lru_cache_eviction(self):
+        """
+        The LRU cache should evict the least recently used entry and count hits and misses.
+        """
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        eq_(cache.get('a'), 1)
+        cache.set('c', 3)
+        ok_('a' in cache)
+        ok_('b' not in cache)
+        eq_(cache.get('b'), None)
+        eq_(cache.stats(), {'hits': 1, 'misses': 1, 'size': 2, 'maxsize': 2})
+
+    def test_selector_cache(self):
+        """
+        Compiled selectors should be reused, and keyed by the method too.
+        """
+        selector_cache.clear()
+        sel = get_selector('p.foo', 'html')
+        ok_(get_selector('p.foo', 'html') is sel)
+        ok_(get_selector('p.foo', 'xml') is not sel)
+        eq_(selector_cache.hits, 1)
+        eq_(selector_cache.misses, 2)
+
+    def test_warm_up(self):
+        """
+        Warming up should compile the selectors of the external CSS files.
+        """
+        matcher_cache.clear()
+        p = Inlinify(css_files=[css_path('test_parse_style_rules.css')])
+        eq_(p.warm_up('.extra { color: red }'), 5)
+        ok_(('ul li', 'html') in matcher_cache)
+        ok_(('.extra', 'html') in matcher_cache)
+
+    def test_compiled_plan(self):
+        """
+        A compiled plan should give the same results as a regular transform.
+        """
+        html = read_html_file('test_external_css_input.html')
+        expected_output = read_html_file('test_external_css_expected.html')
+        plan = Inlinify().compile(read_css_file('test_external_css.css'))
+        compare_html(expected_output, plan.transform(html))
+        compare_html(expected_output, plan.transform(html))
+
+        # <style> blocks in the html are still processed
+        html = read_html_file('test_basic_html_input.html')
+        expected_output = read_html_file('test_basic_html_expected.html')
+        compare_html(expected_output, plan.transform(html))
+
+    def test_compiled_plan_pickle(self):
+        """
+        A compiled plan should survive being pickled, keeping its options.
+        """
+        html = read_html_file('test_xml.html')
+        expected_output = read_html_file('test_xml_expected.html')
+        plan = Inlinify(method='xml', css_files=[css_path('test_xml.css')]).compile()
+        plan = pickle.loads(pickle.dumps(plan, pickle.HIGHEST_PROTOCOL))
+        eq_(plan.method, 'xml')
+        compare_html(expected_output, plan.transform(html))
+        self.assertRaises(AttributeError, setattr, plan, 'rules', ())
+
+    def test_styles_are_accumulated(self):
+        """
+        Declarations from every matching rule should be merged, with the inline style winning.
+        """
+        html = """<html><head><style type="text/css">
+        td { width: 20px; background-color: red }
+        .cell { text-align: left; background-color: blue }
+        </style></head><body><table><tr>
+        <td class="cell" style="width: 10px">A</td>
+        </tr></table></body></html>"""
+        result = Inlinify().transform(html)
+        ok_('style="background-color:blue; text-align:left; width:10px"' in result)
+        ok_('width="10"' in result)
+        ok_('bgcolor="blue"' in result)
+        ok_('align="left"' in result)
+
+    def test_values_with_colons_are_not_mapped(self):
+        """
+        Declarations whose value contains a colon shouldn't be turned into HTML attributes.
+        """
+        html = """<html><head><style type="text/css">
+        td { background-color: url(http://example.com/a.png); width: 10px }
+        </style></head><body><table><tr><td>A</td></tr></table></body></html>"""
+        result = Inlinify().transform(html)
+        ok_('background-color:url(http://example.com/a.png)' in result)
+        ok_('width="10"' in result)
+        ok_('bgcolor' not in result)
+
+    def test_transform_many(self):
+        """
+        Many documents should be transformed in order, and a bad one shouldn't stop the batch.
+        """
+        html = read_html_file('test_external_css_input.html')
+        expected_output = read_html_file('test_external_css_expected.html')
+        p = Inlinify(css_files=[css_path('test_external_css.css')])
+        for workers in (1, 2):
+            results = list(p.transform_many([html, '', html, html], workers=workers, chunksize=2))
+            eq_(len(results), 4)
+            ok_(isinstance(results[1], TransformError))
+            eq_(results[1].index, 1)
+            for i in (0, 2, 3):
+                compare_html(expected_output, results[i])
+
+        # a compiled plan is used as is
+        plan = Inlinify(css_files=[css_path('test_external_css.css')]).compile()
+        results = list(Inlinify().transform_many([html], workers=1, plan=plan))
+        compare_html(expected_output, results[0])
+
+    def test_transform_many_url_rewriter(self):
+        """
+        Worker processes should rewrite the URLs with a module-level rewriter, and plans with
+        other rewriters should fail to be pickled with a helpful message.
+        """
+        html = '<html><body><a href="/a">A</a></body></html>'
+        p = Inlinify(base_url='http://example.com', url_rewriter=add_utm)
+        for workers in (1, 2):
+            results = list(p.transform_many([html, html], workers=workers, pretty_print=False))
+            eq_(results, ['<html><body><a href="http://example.com/a?utm=email">A</a></body>'
+                          '</html>'] * 2)
+        plan = pickle.loads(pickle.dumps(p.compile(), pickle.HIGHEST_PROTOCOL))
+        ok_('?utm=email' in plan.transform(html))
+
+        plan = Inlinify(url_rewriter=lambda url, element, attr: url).compile()
+        with self.assertRaises(pickle.PicklingError):
+            pickle.dumps(plan, pickle.HIGHEST_PROTOCOL)
+
+    def test_output_cache(self):
+        """
+        Transformed documents should be cached when using the cache_output option.
+        """
+        html = read_html_file('test_basic_html_input.html')
+        expected_output = read_html_file('test_basic_html_expected.html')
+        output_cache.clear()
+        p = Inlinify(cache_output=True)
+        compare_html(expected_output, p.transform(html))
+        compare_html(expected_output, p.transform(html))
+        eq_(output_cache.hits, 1)
+
+        # different options mean a different output
+        p.transform(html, pretty_print=False)
+        Inlinify(cache_output=True, base_url='http://example.com').transform(html)
+        eq_(output_cache.hits, 1)
+        eq_(len(output_cache), 3)
+
+        # not cached by default
+        Inlinify().transform(html)
+        eq_(output_cache.hits, 1)
+
+    def test_output_cache_key(self):
+        """
+        The output cache key should only depend on stable option values, and identify URL
+        rewriters by their dotted path or url_rewriter_key.
+        """
+        html = '<html><body><a href="/a">A</a></body></html>'
+        p = Inlinify(cache_output=True, url_rewriter=add_utm)
+        eq_(p.url_rewriter_key, '{0}.add_utm'.format(__name__))
+        eq_(p._get_output_cache_key(html, None, True, {}),
+            Inlinify(cache_output=True, url_rewriter=add_utm)._get_output_cache_key(
+                html, None, True, {}))
+        ok_(p._get_output_cache_key(html, None, True, {}) !=
+            Inlinify(cache_output=True)._get_output_cache_key(html, None, True, {}))
+
+        # lambdas and closures have no stable name
+        with self.assertRaises(ValueError):
+            Inlinify(cache_output=True, url_rewriter=lambda url, element, attr: url)
+        p = Inlinify(cache_output=True, url_rewriter=lambda url, element, attr: url + '#',
+                     url_rewriter_key='anchor')
+        ok_('href="/a#"' in p.transform(html))
+
+        # the CSS is fingerprinted once for the cache key and the plan
+        calls = []
+        fingerprint = inlinify_module._fingerprint
+
+        def counting_fingerprint(css_sources):
+            calls.append(css_sources)
+            return fingerprint(css_sources)
+
+        inlinify_module._fingerprint = counting_fingerprint
+        try:
+            Inlinify(cache_output=True).transform(html, pretty_print=False)
+        finally:
+            inlinify_module._fingerprint = fingerprint
+        eq_(len(calls), 1)
+
+    def test_lru_cache_ttl(self):
+        """
+        Entries in the LRU cache should expire after the TTL.
+        """
+        cache = LRUCache(2, ttl=0.01)
+        cache.set('a', 1)
+        ok_('a' in cache)
+        eq_(cache.get('a'), 1)
+        time.sleep(0.02)
+        ok_('a' not in cache)
+        eq_(cache.get('a'), None)
+
+    def test_tiered_cache(self):
+        """
+        The tiered cache should copy values found in the backend to the in-process cache.
+        """
+        backend = LocMemCache('test_tiered_cache', {})
+        backend.set('a', 1)
+        cache = TieredCache(LRUCache(10), backend)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b', 2), 2)
+        eq_(cache.counters.as_dict(),
+            {'l1_hits': 1, 'l1_misses': 2, 'l2_hits': 1, 'l2_misses': 1})
+
+        # either tier can be disabled
+        eq_(TieredCache(None, backend).get('a'), 1)
+        cache = TieredCache(LRUCache(10), None)
+        cache.set('c', 3)
+        eq_(cache.get('c'), 3)
+
+        # the in-process cache doesn't keep values longer than the timeout
+        cache.set('d', 4, 0.01)
+        time.sleep(0.02)
+        eq_(cache.get('d'), None)
+
+    def test_load_cache(self):
+        """
+        Caches loaded with the same name should share the in-process cache and the counters.
+        """
+        one = load_cache('default')
+        two = load_cache('missing')
+        ok_(one.local is two.local)
+        one.set('test_load_cache', 1)
+        eq_(two.get('test_load_cache'), 1)
+        ok_(cache_stats()['default']['l1_hits'] >= 1)
+
+    def test_css_fingerprint(self):
+        """
+        CSS strings should have the same fingerprint only if they have the same contents.
+        """
+        css = 'h1 { color: red; }\n' * 1000
+        fingerprint = css_fingerprint(css)
+        eq_(css_fingerprint(css), fingerprint)
+        eq_(css_fingerprint(css[:-1] + '\t'), css_fingerprint(css[:-1] + '\t'))
+        ok_(css_fingerprint(css[:-1] + '\t') != fingerprint)
+        ok_(css_fingerprint(css, 'fast') != fingerprint)
+        eq_(css_fingerprint('h1 { content: "\u2603"; }', 'fast'),
+            css_fingerprint('h1 { content: "\u2603"; }', 'fast'))
+
+        # new strings that only differ in the middle, possibly reusing the id of a collected one
+        fingerprints = set()
+        for color in range(100):
+            fingerprints.add(css_fingerprint(css[:5000] + 'color: #%03d;' % color + css[5000:]))
+        eq_(len(fingerprints), 100)
+
+        # so <style> blocks that only differ in the middle get their own rules
+        padding = '.x%d { margin: 0 }\n'
+        for color in ('#123456', '#223456', '#323456'):
+            css = ''.join(padding % i for i in range(300)) + 'p { color: %s }' % color
+            css += ''.join(padding % i for i in range(300))
+            html = '<html><head><style>%s</style></head><body><p>x</p></body></html>' % css
+            ok_('color:%s' % color in Inlinify().transform(html, pretty_print=False))
+
+    def test_parse_with_fingerprint(self):
+        """
+        The parser should use the fingerprint provided instead of hashing the CSS.
+        """
+        parser = CSSParser()
+        rules, __ = parser.parse('h1 { color: red; }', 0, 'file:a.css:1')
+        eq_(parser.parse('h2 { color: blue; }', 0, 'file:a.css:1')[0], rules)
+        ok_(parser.parse('h2 { color: blue; }', 0, 'file:a.css:2')[0] != rules)
+
+    def test_specificity(self):
+        """
+        The specificity should follow the CSS specification, and be packed into an integer.
+        """
+        rules, __ = CSSParser().parse(
+            'a[href] { color: red } ul li a { color: blue } li:first-child { color: green }'
+            'li.item { color: black } #main a { color: white }', 2)
+        ok_(all(isinstance(rule, Rule) for rule in rules))
+        specificity = dict((selector, specificity) for specificity, selector, __ in rules)
+
+        # attribute selectors and pseudo classes count as classes
+        ok_(specificity['ul li a'] < specificity['a[href]'])
+        ok_(specificity['li:first-child'] < specificity['li.item'])
+        ok_(specificity['li.item'] < specificity['#main a'])
+        eq_(specificity['a[href]'], pack_specificity(0, 1, 1, 2, 0))
+
+        # the packed integers compare like the tuples
+        ok_(pack_specificity(0, 1, 0, 0, 0) > pack_specificity(0, 0, 1000, 5, 5))
+        ok_(pack_specificity(0, 0, 1, 1, 0) > pack_specificity(0, 0, 1, 0, 10 ** 6))
+
+    def test_parse_indexed(self):
+        """
+        The parser should index the rules by the most selective token they require.
+        """
+        parsed = CSSParser().parse_indexed(
+            'p { color: red } .a p { color: blue } #b .a { color: green } :first-child { x: 0 }', 0)
+        eq_([rule.selector for rule in parsed.rules],
+            ['p', '.a p', '#b .a', ':first-child'])
+        eq_(parsed.tokens[1], (('class', 'a'), ('tag', 'p')))
+        eq_(parsed.index, {
+            ('tag', 'p'): (0, ),
+            ('class', 'a'): (1, ),
+            ('id', 'b'): (2, ),
+            None: (3, ),
+        })
+
+    def test_cascade_order(self):
+        """
+        More specific rules should win, whatever their order in the stylesheets.
+        """
+        html = '<html><body><p id="a" class="b">x</p></body></html>'
+        inlinify = Inlinify()
+        for css in (['#a { color: red }', 'p { color: blue }'],
+                    ['p.b { color: blue } p { color: green }', '#a { color: red }']):
+            plan = inlinify.compile(css)
+            ok_('style="color:red"' in plan.transform(html))
+            ok_('style="color:red"' in inlinify._transform(
+                html, inlinify._get_plan([(body, None) for body in css]), True, {}))
+
+    def test_external_css_cascade_order(self):
+        """
+        Rules of the external CSS files should be applied by specificity, then by their order in
+        the files, when the html doesn't have any <style> block.
+        """
+        html = '<html><body><p id="a">x</p><p>y</p></body></html>'
+        inlinify = Inlinify(css_files=[css_path('test_external_cascade_order.css')])
+        result_html = inlinify.transform(html, pretty_print=False)
+        ok_('<p id="a" style="color:red">x</p><p style="color:blue">y</p>' in result_html)
+
+        # on an exact tie with a rule of a <style> block, the external rule wins
+        html = ('<html><head><style>#b { color: black } p { color: green }</style></head>'
+                '<body><p>y</p></body></html>')
+        ok_('<p style="color:blue">y</p>' in inlinify.transform(html, pretty_print=False))
+
+    def test_transform_to(self):
+        """
+        The document written to a file, or returned in chunks, should be the transformed one.
+        """
+        html = read_html_file('test_xml.html')
+        inlinify = Inlinify(method='xml', css_files=[css_path('test_xml.css')])
+        expected = inlinify.transform(html).encode('utf-8')
+        ok_(b'/*<![CDATA[*/' in expected)
+
+        output = io.BytesIO()
+        inlinify.transform_to(html, output)
+        eq_(output.getvalue(), expected)
+        chunks = list(inlinify.iter_chunks(html, chunk_size=100))
+        ok_(len(chunks) > 1)
+        eq_(b''.join(chunks), expected)
+
+        html = read_html_file('test_basic_html_input.html')
+        plan = Inlinify().compile()
+        output = io.BytesIO()
+        plan.transform_to(html, output, pretty_print=False)
+        eq_(output.getvalue(), plan.transform(html, pretty_print=False).encode('utf-8'))
+
+    def test_cdata_comment_writer(self):
+        """
+        The CDATA markers should be commented out even if they are split between writes.
+        """
+        output = io.BytesIO()
+        writer = _CDATACommentWriter(output)
+        for byte in bytearray(b'<style><![CDATA[a > b {}]]></style><![CDATA'):
+            writer.write(bytes(bytearray([byte])))
+        writer.close()
+        eq_(output.getvalue(), b'<style>/*<![CDATA[*/a > b {}/*]]>*/</style><![CDATA')
+
+    def test_transform_tree(self):
+        """
+        Parsed documents should be transformed in place.
+        """
+        html = read_html_file('test_basic_html_input.html')
+        expected_output = read_html_file('test_basic_html_expected.html')
+        tree = etree.fromstring(html, etree.HTMLParser()).getroottree()
+        eq_(Inlinify().transform_tree(tree), tree)
+        compare_html(expected_output,
+                     etree.tostring(tree.getroot(), method='html').decode('utf-8'))
+
+        page = etree.fromstring(html, etree.HTMLParser())
+        eq_(Inlinify().compile().transform_tree(page), page)
+        compare_html(expected_output, etree.tostring(page, method='html').decode('utf-8'))
+
+    def test_parsers_are_reused(self):
+        """
+        Every thread should reuse its own parsers.
+        """
+        parser = _get_parser('html')
+        ok_(_get_parser('html') is parser)
+        ok_(_get_parser('xml') is not parser)
+        parsers = []
+        thread = threading.Thread(target=lambda: parsers.append(_get_parser('html')))
+        thread.start()
+        thread.join()
+        ok_(parsers[0] is not parser)
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, unicode_literals
+import logging
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify.inlinify import Inlinify
+from django_inlinify.instrumentation import NULL_RECORDER, LoggingInstrument, TransformStats
+from django_inlinify.signals import transform_finished
+
+HTML = """<html>
+<head><style>.intro { color: red } .missing p { color: blue } p { margin: 0 }</style></head>
+<body><p class="intro">Intro <a href="/a">link</a></p><p>Text</p></body>
+</html>"""
+
+PHASES = ['match', 'merge', 'parse_html', 'plan', 'load', 'serialize', 'urls']
+
+
+class InstrumentationTests(unittest.TestCase):
+
+    def test_instrument(self):
+        """
+        The instrument should be called with the duration of every phase and the counters.
+        """
+        calls = []
+        inlinify = Inlinify(base_url='http://example.com',
+                            instrument=lambda durations, counts: calls.append((durations, counts)))
+        inlinify.transform(HTML)
+        eq_(len(calls), 1)
+        durations, counts = calls[0]
+        eq_(sorted(durations), sorted(PHASES))
+        ok_(all(duration >= 0 for duration in durations.values()))
+        eq_(counts['rules_considered'], 3)
+        eq_(counts['rules_pruned'], 1)
+        eq_(counts['selectors_evaluated'], 2)
+        eq_(counts['elements_styled'], 2)
+        eq_(counts['plan_cache_misses'], 1)
+
+        # the plan of the stylesheets is reused
+        inlinify.transform(HTML)
+        eq_(calls[1][1]['plan_cache_hits'], 1)
+
+    def test_disabled(self):
+        """
+        Nothing should be recorded without an instrument or a receiver of the signal.
+        """
+        ok_(Inlinify()._get_recorder() is NULL_RECORDER)
+
+    def test_signal(self):
+        """
+        The signal should be sent after every transformation, and can be aggregated.
+        """
+        stats = TransformStats()
+        transform_finished.connect(stats.receiver)
+        try:
+            inlinify = Inlinify()
+            inlinify.transform(HTML)
+            inlinify.transform_tree(inlinify._parse(HTML)[0])
+            inlinify.compile().transform(HTML)
+        finally:
+            transform_finished.disconnect(stats.receiver)
+
+        result = stats.as_dict()
+        eq_(result['transforms'], 3)
+        eq_(result['counts']['elements_styled'], 6)
+        eq_(result['durations']['match']['total'] >= result['durations']['match']['max'], True)
+        ok_('serialize' in result['durations'])
+
+        stats.reset()
+        eq_(stats.as_dict(), {'transforms': 0, 'durations': {}, 'counts': {}})
+
+    def test_logging_instrument(self):
+        """
+        The logging adapter should log a line per transformation.
+        """
+        records = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record.getMessage())
+
+        logger = logging.getLogger('django_inlinify.tests.instrumentation')
+        logger.addHandler(Handler())
+        logger.setLevel(logging.INFO)
+        Inlinify(instrument=LoggingInstrument(logger, logging.INFO)).transform(HTML)
+        eq_(len(records), 1)
+        ok_('match=' in records[0] and 'elements_styled=2' in records[0])
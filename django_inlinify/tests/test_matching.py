@@ -0,0 +1,139 @@
+from __future__ import absolute_import, unicode_literals
+import pickle
+import unittest
+
+from lxml import etree
+from nose.tools import eq_, ok_
+
+from django_inlinify.matching import (DocumentIndex, SelectorMatcher, XPathMatcher,
+                                      build_token_index, get_matcher, get_selector,
+                                      get_selector_tokens)
+
+HTML = """
+<html>
+<head><title>Title</title></head>
+<body>
+<div id="main" class="wrapper  wide">
+    <h1 class="title">Title</h1>
+    <!-- a comment -->
+    <p class="intro first">Intro <a href="http://example.com/a" title="a link">link</a></p>
+    <p lang="en-GB">Second</p>
+    <ul>
+        <li>One</li><li class="odd">Two</li><li>Three</li><li data-x="foo bar">Four</li>
+    </ul>
+    <table><tr><td align="center">A</td><td>B</td></tr></table>
+</div>
+<div class="footer"><p>Footer <span>small</span></p></div>
+</body>
+</html>
+"""
+
+SELECTORS = [
+    'p', 'P', 'div p', 'div > p', '#main', 'div#main', '.wrapper', '.wide.wrapper', '.intro',
+    'p.intro.first', 'h1 + p', 'h1 ~ p', 'h1 + ul', 'body > div > p', 'div p span', 'ul li',
+    'li:first-child', 'li:last-child', 'li:nth-child(2n+1)', 'li:nth-child(odd)',
+    'li:nth-child(even)', 'li:nth-child(-n+2)', 'li:nth-last-child(2)', 'p:first-of-type',
+    'p:last-of-type', 'li:only-child', 'span:only-child', 'html:root', 'a[href]',
+    'a[href^="http"]', 'a[href$="/a"]', 'a[href*="example"]', 'a[title~="link"]',
+    'p[lang|="en"]', 'td[align="center"]', 'td[align!="center"]', 'li[data-x~="bar"]',
+    'li:not(.odd)', 'p:not(:first-child)', '.footer p', '.missing', '#missing p', 'a:hover',
+    'p::first-line', 'li:nth-child(n)', 'p:empty',
+]
+
+
+class MatchingTests(unittest.TestCase):
+
+    def test_matches_like_xpath(self):
+        """
+        The SelectorMatcher should match the same elements as the XPath translation.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        for selector in SELECTORS:
+            try:
+                expected = get_selector(selector, 'html')(page)
+            except Exception:
+                continue
+            eq_(get_matcher(selector, 'html').select(index), expected, selector)
+
+    def test_case_sensitive(self):
+        """
+        Tag and attribute names should be matched case sensitively, as the default translator does.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        for selector in ('P', 'DIV p', 'a[TITLE]', 'LI:first-child'):
+            eq_(get_selector(selector, 'html')(page), [], selector)
+            eq_(get_matcher(selector, 'html').select(index), [], selector)
+        ok_(get_matcher('a[title]', 'html').select(index))
+
+    def test_unsupported_selectors_use_xpath(self):
+        """
+        Selectors the matcher doesn't know about should fall back to XPath.
+        """
+        ok_(isinstance(get_matcher('li:nth-child(2)', 'html'), SelectorMatcher))
+        ok_(isinstance(get_matcher('p:empty', 'html'), XPathMatcher))
+        ok_(isinstance(get_matcher('input:checked', 'html'), XPathMatcher))
+
+    def test_index(self):
+        """
+        The index should group elements by tag, class and id in document order.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        eq_([e.text for e in index.tags['li']], ['One', 'Two', 'Three', 'Four'])
+        eq_(len(index.classes['wrapper']), 1)
+        eq_(len(index.classes['wide']), 1)
+        eq_(index.ids['main'][0].tag, 'div')
+
+    def test_selector_tokens(self):
+        """
+        The tokens of a selector should come from all its compound parts, except the negations.
+        """
+        eq_(get_selector_tokens('DIV.foo > p#bar.baz:not(.qux) ~ a[href]'),
+            (('id', 'bar'), ('class', 'baz'), ('class', 'foo'), ('tag', 'a'), ('tag', 'div'),
+             ('tag', 'p')))
+        eq_(get_selector_tokens('*:first-child'), ())
+        eq_(get_selector_tokens('a, b'), ())
+        eq_(get_selector_tokens('a[href'), ())
+
+    def test_pruning(self):
+        """
+        The index should only reject the selectors that can't match the document.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        for selector in SELECTORS:
+            try:
+                matched = get_matcher(selector, 'html').select(index)
+            except Exception:
+                continue
+            if matched:
+                ok_(index.has_tokens(get_selector_tokens(selector)), selector)
+        ok_(not index.has_tokens(get_selector_tokens('.footer .missing')))
+        ok_(not index.has_tokens(get_selector_tokens('form .wrapper')))
+        ok_(index.has_tokens(get_selector_tokens('DIV.wide:not(.missing)')))
+
+    def test_find_candidates(self):
+        """
+        The index should only return the rules whose most selective token is in the document.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        selectors = ['.missing p', 'li', '#main .intro', 'form', ':first-child', '#missing .odd']
+        token_index = build_token_index(get_selector_tokens(selector) for selector in selectors)
+        eq_(index.find_candidates(token_index), [1, 2, 4])
+
+        # with more tokens in the index than in the document
+        token_index.update((('class', 'extra%d' % i), (i + 10, )) for i in range(200))
+        eq_(index.find_candidates(token_index), [1, 2, 4])
+
+    def test_matcher_pickle(self):
+        """
+        Matchers should survive being pickled.
+        """
+        page = etree.fromstring(HTML, etree.HTMLParser())
+        index = DocumentIndex(page)
+        for selector in ('div > p', 'p:empty'):
+            matcher = pickle.loads(pickle.dumps(get_matcher(selector, 'html'), 2))
+            eq_(matcher.select(index), get_selector(selector, 'html')(page))
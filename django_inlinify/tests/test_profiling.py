@@ -0,0 +1,74 @@
+from __future__ import absolute_import, unicode_literals
+import os
+import tempfile
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify.inlinify import Inlinify
+from django_inlinify.profiling import SelectorProfiler
+
+CSS = """
+p { margin: 0 }
+.intro { color: red }
+.missing p { color: blue }
+form input { border: 0 }
+div p:first-child { font-weight: bold }
+a:hover { color: green }
+@media print { p { color: black } }
+"""
+
+HTMLS = [
+    '<html><head></head><body><div><p class="intro">Intro</p><p>Text</p></div></body></html>',
+    '<html><head><style>span { color: gray }</style></head><body><p>a <span>b</span></p>'
+    '</body></html>',
+]
+
+
+class ProfilingTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.css_path = tempfile.mkstemp(suffix='.css')
+        with os.fdopen(fd, 'w') as f:
+            f.write(CSS)
+        self.profiler = SelectorProfiler()
+        self.inlinify = Inlinify(css_files=[self.css_path], profiler=self.profiler)
+
+    def tearDown(self):
+        os.remove(self.css_path)
+
+    def test_report(self):
+        """
+        The profiler should record the evaluations and matches of every rule across documents.
+        """
+        for html in HTMLS:
+            self.inlinify.transform(html)
+        report = dict((stats.selector, stats) for stats in self.profiler.report())
+        eq_(report['p'].evaluations, 2)
+        eq_(report['p'].matches, 3)
+        eq_(report['p'].documents, 2)
+        eq_(report['.intro'].documents, 1)
+        eq_(report['form input'].evaluations, 0)
+        ok_(report['span'].style_block)
+        ok_(all(stats.total_time >= stats.max_time for stats in report.values()))
+        eq_(len(self.profiler.report(limit=2)), 2)
+
+        eq_([stats.selector for stats in self.profiler.never_matched()],
+            ['.missing p', 'form input'])
+        ok_('2 rules never matched' in self.profiler.format_report())
+
+    def test_trimmed_css(self):
+        """
+        The trimmed CSS should give the same result as the original CSS for the profiled
+        documents.
+        """
+        expected = [self.inlinify.transform(html) for html in HTMLS]
+        trimmed = self.profiler.trimmed_css()
+        ok_('.missing p' not in trimmed and 'form input' not in trimmed)
+        ok_('a:hover' in trimmed and '@media print' in trimmed)
+        plan = Inlinify().compile(trimmed)
+        eq_([plan.transform(html) for html in HTMLS], expected)
+
+        self.profiler.reset()
+        eq_(self.profiler.report(), [])
+        eq_(self.profiler.trimmed_css(), '')
@@ -0,0 +1,99 @@
+from __future__ import absolute_import, unicode_literals
+import os
+import tempfile
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify.inlinify import Inlinify
+
+CSS = '''
+p { color: red }
+.lead { font-size: 20px }
+#main .note { color: blue }
+li:first-child { font-weight: bold }
+li + li { margin: 0 }
+li:nth-of-type(2) { padding: 0 }
+a:hover { color: red }
+@media (max-width: 600px) { td { width: 5px } }
+'''
+
+DOCUMENT = '''<html>
+<head><style>td { width: 10px }</style></head>
+<body><div id="main">
+<p id="intro" style="color: green">Hi</p>
+<ul><li>a</li><li>b</li><li>c</li></ul>
+<table><tr><td><a href="/a">a</a></td></tr></table>
+</div></body>
+</html>'''
+
+
+class InlineSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.css_path = tempfile.mkstemp(suffix='.css')
+        with os.fdopen(fd, 'w') as f:
+            f.write(CSS)
+        self.inlinify = Inlinify(css_files=[self.css_path], base_url='http://example.com')
+
+    def tearDown(self):
+        os.remove(self.css_path)
+
+    def check(self, session, html):
+        """Checks the session output against in-lining the whole document
+        """
+        eq_(session.html, self.inlinify.transform(html, pretty_print=False))
+
+    def test_update(self):
+        """
+        Replacing elements should give the same result as in-lining the whole document again.
+        """
+        html = DOCUMENT
+        session = self.inlinify.session(html, pretty_print=False)
+        self.check(session, html)
+
+        updates = [
+            # the inline style is dropped, and new rules match
+            ('#intro', '<p id="intro" style="color: green">Hi</p>',
+             '<p id="intro" class="lead note">Hello</p>'),
+            # the siblings lose :first-child, + and :nth-of-type matches
+            ('li', '<li>a</li>', '<span class="note">z</span>'),
+            # the relative URLs of the new elements are rewritten
+            ('td', '<td><a href="/a">a</a></td>', '<td class="note"><a href="/b">b</a></td>'),
+            # <style> blocks change the rules of the whole document
+            ('style', '<style>td { width: 10px }</style>',
+             '<style>.lead { font-size: 30px }</style>'),
+            # the <style> blocks with the CSS that can't be in-lined aren't parsed again
+            ('style', '<style>.lead { font-size: 30px }</style>',
+             '<style>td { width: 15px } a:hover { color: blue }</style>'),
+        ]
+        for selector, old, new in updates:
+            html = html.replace(old, new, 1)
+            session.update(selector, new)
+            self.check(session, html)
+            eq_(len(session._style_blocks), 1)
+
+    def test_declarations(self):
+        """
+        The session should keep the declarations of the rules matching every element.
+        """
+        session = self.inlinify.session(DOCUMENT)
+        intro = session.page.cssselect('#intro')[0]
+        eq_(session.declarations(intro), {'color': 'red'})
+        ok_('color:green' in intro.get('style'))
+
+        session.update('#intro', '<p id="intro" class="lead">Hello</p>')
+        eq_(session.declarations(intro), {})
+        eq_(session.declarations(session.page.cssselect('#intro')[0]),
+            {'color': 'red', 'font-size': '20px'})
+
+    def test_invalid_updates(self):
+        """
+        Updates of missing elements, or with more than one element, should be refused.
+        """
+        session = self.inlinify.session(DOCUMENT)
+        with self.assertRaises(ValueError):
+            session.update('#missing', '<p>Hello</p>')
+        with self.assertRaises(ValueError):
+            session.update('#intro', '<p>Hello</p><p>again</p>')
+
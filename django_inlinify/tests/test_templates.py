@@ -0,0 +1,180 @@
+from __future__ import absolute_import, unicode_literals
+import io
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from nose.tools import eq_, ok_
+
+import django
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Context, Engine
+from django_inlinify.template_tools import flatten, get_inlinify, inline_regions, inline_template
+from django_inlinify.templatetags.inlinify import InlinifyNode
+
+LAYOUT = '''{% load inlinify %}{% inlinify CSS %}<html>
+<head><style>.button { color: white }</style></head>
+<body>
+<h1>{% block title %}Hello{% endblock %}</h1>
+<div class="content">{% block content %}{% endblock %}</div>
+<p class="footer">{% now "Y" %}</p>
+</body>
+</html>{% endinlinify %}'''
+
+RECEIPT = '''{% extends "layout.html" %}
+{% block title %}{{ block.super }} {{ name }}{% endblock %}
+{% block content %}
+<p>Your order:</p>
+<table>{% for item in items %}<tr><td class="item" title="{{ item }}">{{ item }}</td></tr>{% endfor %}</table>
+{% if new %}<a class="button" href="{{ url }}" target="_blank">Track</a>{% endif %}
+{% endblock %}'''
+
+
+def setUpModule():
+    django.setup()
+
+
+class TemplateTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.css = self.write('email.css', '.content p { font-weight: bold } '
+                                           'td.item { padding: 2px } '
+                                           'h1 { color: red } .footer { color: gray }')
+        self.write('layout.html', LAYOUT.replace('CSS', '"%s"' % self.css))
+        self.write('receipt.html', RECEIPT)
+        self.context = Context({'name': 'Ann', 'items': ['a', 'b'], 'url': '/track?a=1&b=2',
+                                'new': True})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, contents):
+        path = os.path.join(self.directory, name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(contents)
+        return path
+
+    def get_engine(self, inline_on_load):
+        loaders = ['django.template.loaders.filesystem.Loader']
+        if inline_on_load:
+            loaders = [('django_inlinify.loaders.Loader', loaders)]
+        return Engine(dirs=[self.directory], loaders=loaders)
+
+    def test_inline_template(self):
+        """
+        The template tags should be kept when in-lining a template, inside and between elements.
+        """
+        source = ('<html><body>{% if show %}<p class="footer" data-x="{{ x }}" {# y #}>'
+                  '{{ text }}</p>{% endif %}{# note #}</body></html>')
+        inlinify = get_inlinify([self.css])
+        eq_(inline_template(source, inlinify),
+            '<html><body>{% if show %}<p class="footer" data-x="{{ x }}" {# y #} '
+            'style="color:gray">{{ text }}</p>{% endif %}{# note #}</body></html>')
+
+        # placeholders that don't survive the lxml round trip are detected
+        eq_(inline_template('{{ before }}<html><body></body></html>', inlinify), None)
+
+        # so are the elements changed by the round trip, such as an element opened in both
+        # branches of a condition, which lxml closes twice
+        eq_(inline_template('<html><body>{% if x %}<div class="a">{% else %}<div class="b">'
+                            '{% endif %}<p>hi {{ name }}</p></div></body></html>', inlinify), None)
+        eq_(inline_template('{% if x %}<div class="a">{% else %}<div class="b">{% endif %}'
+                            '<p>hi {{ name }}</p></div>', inlinify), None)
+        # and the document tags added by lxml are ignored
+        eq_(inline_template('<div>{{ text }}</div>', inlinify),
+            '<html><body><div>{{ text }}</div></body></html>')
+
+    def test_render_time_templates(self):
+        """
+        Templates that would be styled differently before being rendered shouldn't be in-lined.
+        """
+        inlinify = get_inlinify([self.css])
+        # tags choosing the attributes of an element
+        eq_(inline_template('<html><body><p {% if a %}class="footer"{% else %}class="x"'
+                            '{% endif %}>A</p></body></html>', inlinify), None)
+        # variables in the attributes deciding the matching rules
+        for attribute in ('class', 'id', 'style'):
+            eq_(inline_template('<html><body><p %s="{{ a }}">A</p></body></html>' % attribute,
+                                inlinify), None)
+        eq_(inline_template('<html><head><style>a[href^="http"] { color: red }</style></head>'
+                            '<body><a href="{{ url }}">A</a></body></html>', inlinify), None)
+
+        # loops, with structural pseudo classes or sibling combinators
+        loop = ('<html><body><ul>{% for item in items %}<li>{{ item }}</li>{% endfor %}</ul>'
+                '</body></html>')
+        ok_(inline_template(loop, inlinify) is not None)
+        for css in ('li:first-child', 'li + li', 'li ~ li', 'li:nth-child(2)', 'li:last-child'):
+            style = '<head><style>%s { color: red }</style></head>' % css
+            eq_(inline_template(loop.replace('<body>', style + '<body>'), inlinify), None, css)
+
+    def test_render_time_regions_are_kept(self):
+        """
+        Regions left to be in-lined when rendered should be kept as they are, without errors.
+        """
+        records = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = records.append
+        logger = logging.getLogger('django_inlinify.template_tools')
+        logger.addHandler(handler)
+        try:
+            source = ('{%% inlinify "%s" %%}<html><body><p style="{{ s }}">A</p></body></html>'
+                      '{%% endinlinify %%}' % self.css)
+            eq_(inline_regions(source), source)
+        finally:
+            logger.removeHandler(handler)
+        eq_(records, [])
+
+    def test_flatten(self):
+        """
+        Flattening a template should replace the blocks of its parents with its own.
+        """
+        sources = {
+            'base.html': '<b>{% block a %}A{% block b %}B{% endblock %}{% endblock %}</b>',
+            'middle.html': '{% extends "base.html" %}{% block b %}[{{ block.super }}]{% endblock %}',
+        }
+        eq_(flatten('{% extends "middle.html" %}{% load humanize %}'
+                    '{% block a %}{{ block.super }}!{% endblock %}', sources.get),
+            '{% load humanize %}<b>{% block a %}A{% block b %}[B]{% endblock %}!{% endblock %}</b>')
+        with self.assertRaises(ValueError):
+            flatten('{% extends layout %}', sources.get)
+
+    def test_loader(self):
+        """
+        Templates should render the same whether they are in-lined when loaded or when rendered.
+        """
+        static = self.get_engine(True).get_template('receipt.html')
+        dynamic = self.get_engine(False).get_template('receipt.html')
+
+        # the in-lined template isn't in-lined again when rendered
+        eq_(static.nodelist.get_nodes_by_type(InlinifyNode), [])
+
+        output = static.render(self.context)
+        ok_('<h1 style="color:red">Hello Ann</h1>' in output)
+        ok_('<p style="font-weight:bold">Your order:</p>' in output)
+        ok_('<td class="item" title="b" style="padding:2px">b</td>' in output)
+        ok_('href="/track?a=1&amp;b=2"' in output)
+        ok_('target="_blank"' in output)
+        eq_(output.split(), dynamic.render(self.context).split())
+
+    def test_loader_requires_engines(self):
+        """
+        Without the template engines API of Django 1.8, importing the loader should raise
+        ImproperlyConfigured.
+        """
+        saved = dict((name, sys.modules.get(name))
+                     for name in ('django_inlinify.loaders', 'django.template.loaders.base'))
+        sys.modules.pop('django_inlinify.loaders', None)
+        sys.modules['django.template.loaders.base'] = None
+        try:
+            with self.assertRaises(ImproperlyConfigured):
+                import django_inlinify.loaders  # noqa: F401
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
@@ -0,0 +1,109 @@
+from __future__ import absolute_import, unicode_literals
+import glob
+import os
+import re
+import unittest
+
+from nose.tools import eq_, ok_
+
+from django_inlinify.css_tools import CSSParser
+from django_inlinify.tokenizer import RawRule, StyleRule, TokenizerError, parse_stylesheet
+
+ROOT = os.path.abspath(os.path.dirname(__file__))
+
+STYLE_BLOCK_REGEX = re.compile(r'<style[^>]*>(.*?)</style>', re.S)
+
+# CSS whose serialization differs between the input and cssutils' output
+SNIPPETS = [
+    'H1 , h2>P,  a[href=\'x\'] { COLOR : #FF0000 ; margin:0px  0PX 1.50em }',
+    'a { font-family: \'Arial\',sans-serif; background: url( \'a b.png\' ) no-repeat }',
+    'a { color: red !important; margin: 0; color: blue }',
+    'a { color: blue !important; margin:0; color: red; color: green !IMPORTANT; padding: 0 }',
+    'a { border: 1px solid rgba(0,0,0,.5); font: bold 12px/30px Georgia,serif }',
+    'a { width: -0px; height: +.5em; top: 1.23456789px; left: 0.0000001px; right: 100.00% }',
+    'a { background: url(data:image/png;base64,iVBOR=) }',
+    'a { background: -webkit-gradient(linear, left top, from(#FFFFFF), to(#aaBBcc)) }',
+    'a { content: \'a"b\'; quotes: "a\'b" }',
+    'a { margin: 1px/**/2px; padding: 0 /* comment */ }',
+    'a { x: ; color: red; ; }',
+    'a { width: calc(100% - 2px); height: 1px\\9; *zoom: 1; _zoom: 1 }',
+    'a { filter: progid:DXImageTransform.Microsoft.gradient(a=1); color: red }',
+    'p:nth-child(2n+1), p:not(.a), p::before, a:hover { color: red }',
+    'ul   li, #a>.b, h3 + p ~ b, a[ data-x |= "en" ] { color: red }',
+    '<!-- a { color: red } -->',
+    '@charset "utf-8"; @import url(a.css); a { color: red }',
+    '@media screen and (max-width:600px){ a {color:red} /* x */ b{ font-size : 12PX} }',
+    '@font-face { font-family: Foo; src: url(foo.woff) } a { color: red }',
+    '@page :first { margin: 0 } @keyframes x { from { top: 0 } } a { color: red }',
+    'a { color: red; }}',
+    'a { color: red',
+    '.a\\:b { color: red }',
+]
+
+
+def fixtures():
+    """Yields the CSS of the test fixtures: the CSS files and the style blocks of the HTML files
+    """
+    for path in sorted(glob.glob(os.path.join(ROOT, 'css', '*.css'))):
+        with open(path) as f:
+            yield path, f.read()
+    for path in sorted(glob.glob(os.path.join(ROOT, 'html', '*.html'))):
+        with open(path) as f:
+            for css in STYLE_BLOCK_REGEX.findall(f.read()):
+                yield path, css
+
+
+class TokenizerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fast = CSSParser()
+        self.fast.DJANGO_INLINIFY_CSSPARSER_BACKEND = 'fast'
+        self.cssutils = CSSParser()
+        self.cssutils.DJANGO_INLINIFY_CSSPARSER_BACKEND = 'cssutils'
+
+    def assert_same_rules(self, css, name):
+        for index in (0, 3):
+            eq_(self.fast._parse_style_rules(css, index),
+                self.cssutils._parse_style_rules(css, index),
+                'The backends differ for %s' % name)
+
+    def test_fixtures_parity(self):
+        """
+        Both backends should extract the same rules and leftovers from the fixtures.
+        """
+        count = 0
+        for path, css in fixtures():
+            self.assert_same_rules(css, path)
+            count += 1
+        ok_(count > 10)
+
+    def test_snippets_parity(self):
+        """
+        Both backends should extract the same rules and leftovers from CSS cssutils normalizes.
+        """
+        for css in SNIPPETS:
+            self.assert_same_rules(css, css)
+
+    def test_parse_stylesheet(self):
+        """
+        The tokenizer should split the style rules, and leave the at-rules to cssutils.
+        """
+        rules = list(parse_stylesheet(
+            '/* x */ h1, h2 > p { COLOR: #FFFFFF; margin: 0px } @media print { a { top: 0 } }'
+        ))
+        eq_(rules, [
+            StyleRule(['h1', 'h2 > p'], [('color', '#FFF'), ('margin', '0')]),
+            RawRule('media', '@media print { a { top: 0 } }'),
+        ])
+
+        # rules using syntax the tokenizer doesn't know are left to cssutils too
+        eq_(list(parse_stylesheet('a { width: calc(1px + 2px) }')),
+            [RawRule(None, 'a { width: calc(1px + 2px) }')])
+
+    def test_malformed_stylesheets(self):
+        """
+        The tokenizer should reject stylesheets that aren't well formed.
+        """
+        for css in ('a { color: red', 'a { color: red }}', 'a { content: "a }',
+                    '/* a { color: red }', '@namespace x "y"; x|a { color: red }'):
+            self.assertRaises(TokenizerError, list, parse_stylesheet(css))
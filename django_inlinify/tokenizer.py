@@ -0,0 +1,378 @@
+"""
+Streaming CSS tokenizer used by the `fast` CSSParser backend.
+
+It only extracts what the inliner needs: the selectors and the declarations of the style rules,
+and the text of the at-rules. Selectors and values are serialized the same way cssutils does, so
+both backends produce the same rules. Style rules using syntax the tokenizer doesn't know how
+cssutils would serialize are returned as RawRule objects, to be parsed by cssutils. Stylesheets
+that aren't well formed raise TokenizerError
+"""
+from __future__ import absolute_import, unicode_literals
+import re
+from collections import OrderedDict, namedtuple
+
+__all__ = ['RawRule', 'StyleRule', 'TokenizerError', 'parse_stylesheet']
+
+# A style rule:
+#   - selectors: the list of selectors, serialized like cssutils does
+#   - declarations: the list of (property name, value) tuples that apply, in the order cssutils
+#     returns them: the last `!important` declaration of a property wins over the rest, and
+#     properties are sorted by their last occurrence
+StyleRule = namedtuple('StyleRule', ['selectors', 'declarations'])
+
+# A rule the tokenizer doesn't parse:
+#   - name: the at-keyword, in lower case, or None for style rules
+#   - text: the CSS of the rule
+RawRule = namedtuple('RawRule', ['name', 'text'])
+
+# Top level tokens. Unterminated comments and strings are matched as errors
+BLOCK_TOKEN_REGEX = re.compile(r'''
+    (?P<comment>/\*.*?\*/)
+  | (?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  | (?P<error>/\*|["']|\\$)
+  | (?P<delim>[{};()])
+  | (?P<text>(?:[^/"'{};()\\]|\\.)+|/)
+''', re.S | re.X)
+
+# HTML comment delimiters, allowed between rules
+CDO_CDC_REGEX = re.compile(r'(?:\s|<!--|-->)*')
+
+AT_KEYWORD_REGEX = re.compile(r'@(-?[_a-zA-Z][_a-zA-Z0-9-]*)')
+
+# At-rules that change how cssutils reads the rest of the stylesheet
+CONTEXT_AT_RULES = frozenset(['namespace', 'variables'])
+
+IDENT = r'-?[_a-zA-Z][_a-zA-Z0-9-]*'
+
+DECLARATION_REGEX = re.compile(r'\s*(%s)\s*:(.*)$' % IDENT, re.S)
+
+IMPORTANT_REGEX = re.compile(r'!\s*important\s*$', re.I)
+
+VALUE_TOKEN_REGEX = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<string>"[^"\\\n]*"|'[^'\\\n]*')
+  | (?P<url>[uU][rR][lL]\(\s*(?P<uri>"[^"\\\n]*"|'[^'\\\n]*'|[^\s"'()\\]+)\s*\))
+  | (?P<function>%(ident)s\()
+  | (?P<number>(?P<sign>[+-]?)(?P<digits>\d*\.\d+|\d+)(?P<unit>%%|[a-zA-Z]+)?)
+  | (?P<hash>\#(?:[0-9a-fA-F]{6}|[0-9a-fA-F]{3})(?![_a-zA-Z0-9-]))
+  | (?P<ident>%(ident)s)
+  | (?P<comma>,)
+  | (?P<slash>/)
+  | (?P<close>\))
+''' % {'ident': IDENT}, re.X)
+
+SELECTOR_TOKEN_REGEX = re.compile(r'''
+    (?P<combinator>\s*[>+~]\s*)
+  | (?P<comma>\s*,\s*)
+  | (?P<space>\s+)
+  | (?P<attrib>\[\s*(?P<name>%(ident)s)\s*
+        (?:(?P<operator>[~|^$*]?=)\s*(?P<value>"[^"\\\n]*"|'[^'\\\n]*'|%(ident)s)\s*)?\])
+  | (?P<pseudo>::?-?[_a-z][_a-z0-9-]*(?:\([.\#]?[_a-zA-Z0-9+-]+\))?)
+  | (?P<simple>[.\#]?%(ident)s|\*)
+''' % {'ident': IDENT}, re.X)
+
+# Units cssutils drops from zero lengths
+ZERO_LENGTH_UNITS = frozenset(['cm', 'mm', 'in', 'px', 'pc', 'pt', 'em', 'ex'])
+
+# Characters that make cssutils quote a URL
+URI_QUOTED_REGEX = re.compile(r'''[()\s;,'"]''')
+
+# Tokens a value term can follow without a separator
+OPENING = frozenset(['start', 'function', 'comma', 'slash'])
+
+
+class TokenizerError(ValueError):
+    """Raised when a stylesheet isn't well formed
+    """
+
+
+class _Unsupported(Exception):
+    """Raised when a style rule uses syntax the tokenizer can't serialize like cssutils
+    """
+
+
+def parse_stylesheet(css):
+    """Splits a stylesheet into its top level rules, without building an object model
+
+    Arguments:
+        - str css: the stylesheet
+
+    Returns:
+        a generator of StyleRule and RawRule objects, in the same order as in the stylesheet
+
+    Raises:
+        TokenizerError if the stylesheet isn't well formed
+    """
+    if isinstance(css, bytes):
+        try:
+            css = css.decode('utf-8')
+        except UnicodeDecodeError:
+            raise TokenizerError('The stylesheet is not UTF-8')
+    css = css.lstrip('\ufeff')
+
+    start = None
+    depth = 0
+    prelude = []
+    prelude_comments = False
+    body = []
+    nested = False
+    for match in BLOCK_TOKEN_REGEX.finditer(css):
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'error':
+            raise TokenizerError('Unterminated comment or string at %s' % match.start())
+
+        if depth:
+            if value == '{':
+                depth += 1
+                nested = True
+            elif value == '}':
+                depth -= 1
+                if not depth:
+                    rule = _make_rule(''.join(prelude).strip(), prelude_comments, body, nested,
+                                      css[start:match.end()])
+                    if rule.__class__ is RawRule and rule.name in CONTEXT_AT_RULES:
+                        raise TokenizerError('Unsupported @%s rule' % rule.name)
+                    yield rule
+                    start = None
+                    prelude = []
+                    prelude_comments = False
+            elif depth == 1:
+                body.append((kind, value))
+            continue
+
+        if start is None:
+            if kind == 'comment':
+                continue
+            if kind == 'text':
+                skipped = CDO_CDC_REGEX.match(value).end()
+                if skipped == len(value):
+                    continue
+                value = value[skipped:]
+                start = match.start() + skipped
+            else:
+                start = match.start()
+
+        if value == '{':
+            depth = 1
+            body = []
+            nested = False
+        elif value == ';':
+            if not prelude or not prelude[0].startswith('@'):
+                raise TokenizerError('Unexpected ; at %s' % match.start())
+            # @import and @charset are ignored
+            if _at_keyword(prelude[0]) in CONTEXT_AT_RULES:
+                raise TokenizerError('Unsupported %s rule' % prelude[0])
+            start = None
+            prelude = []
+            prelude_comments = False
+        elif value == '}':
+            raise TokenizerError('Unexpected } at %s' % match.start())
+        elif kind == 'comment':
+            prelude_comments = True
+        else:
+            prelude.append(value)
+
+    if depth or start is not None:
+        raise TokenizerError('Unexpected end of stylesheet')
+
+
+def _make_rule(prelude, prelude_comments, body, nested, text):
+    """Builds the rule for a block
+    """
+    if prelude.startswith('@'):
+        return RawRule(_at_keyword(prelude), text)
+    if nested or prelude_comments:
+        return RawRule(None, text)
+    try:
+        return StyleRule(_parse_selectors(prelude), _parse_declarations(body))
+    except _Unsupported:
+        return RawRule(None, text)
+
+
+def _at_keyword(prelude):
+    """Returns the name of an at-rule, in lower case
+    """
+    match = AT_KEYWORD_REGEX.match(prelude)
+    return match.group(1).lower() if match else ''
+
+
+def _parse_selectors(prelude):
+    """Splits a selector group, normalizing the whitespace and the attribute values
+    """
+    selectors = []
+    parts = []
+    position = 0
+    previous = 'start'
+    while position < len(prelude):
+        match = SELECTOR_TOKEN_REGEX.match(prelude, position)
+        if match is None:
+            raise _Unsupported(prelude)
+        position = match.end()
+        kind = match.lastgroup
+        if kind in ('combinator', 'comma', 'space'):
+            if previous in ('start', 'combinator'):
+                raise _Unsupported(prelude)
+            if kind == 'comma':
+                selectors.append(''.join(parts))
+                parts = []
+                previous = 'start'
+                continue
+            parts.append(' %s ' % match.group().strip() if kind == 'combinator' else ' ')
+        elif kind == 'attrib':
+            value = match.group('value')
+            if value and value[0] == "'":
+                if '"' in value:
+                    raise _Unsupported(prelude)
+                value = '"%s"' % value[1:-1]
+            parts.append('[%s%s%s]' % (match.group('name'), match.group('operator') or '',
+                                       value or ''))
+        else:
+            parts.append(match.group())
+        previous = kind
+    if previous in ('start', 'combinator', 'space'):
+        raise _Unsupported(prelude)
+    selectors.append(''.join(parts))
+    return selectors
+
+
+def _parse_declarations(body):
+    """Parses the declarations of a style rule
+    """
+    declarations = OrderedDict()
+    for text in _split_declarations(body):
+        if not text.strip():
+            continue
+        match = DECLARATION_REGEX.match(text)
+        if match is None:
+            raise _Unsupported(text)
+        name, value = match.groups()
+        important = IMPORTANT_REGEX.search(value)
+        if important:
+            value = value[:important.start()]
+        value = _serialize_value(value)
+
+        name = name.lower()
+        previous = declarations.pop(name, None)
+        if previous is not None and previous[1] and not important:
+            declarations[name] = previous
+        else:
+            declarations[name] = (value, bool(important))
+    return [(name, value) for name, (value, __) in declarations.items()]
+
+
+def _split_declarations(body):
+    """Splits the tokens of a block on the semicolons outside parenthesis. Comments are replaced
+    by whitespace
+    """
+    parts = []
+    depth = 0
+    for kind, value in body:
+        if value == ';' and not depth:
+            yield ''.join(parts)
+            parts = []
+            continue
+        if value == '(':
+            depth += 1
+        elif value == ')':
+            depth -= 1
+        parts.append(' ' if kind == 'comment' else value)
+    yield ''.join(parts)
+
+
+def _serialize_value(value):
+    """Serializes a property value like cssutils does
+    """
+    parts = []
+    previous = 'start'
+    space = False
+    depth = 0
+    position = 0
+    while position < len(value):
+        match = VALUE_TOKEN_REGEX.match(value, position)
+        if match is None:
+            raise _Unsupported(value)
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'space':
+            space = True
+            continue
+
+        if kind in ('comma', 'slash', 'close'):
+            if previous not in ('term', 'close'):
+                raise _Unsupported(value)
+            if kind == 'close':
+                if not depth:
+                    raise _Unsupported(value)
+                depth -= 1
+            parts.append(match.group())
+        else:
+            if previous not in OPENING:
+                if not space:
+                    raise _Unsupported(value)
+                parts.append(' ')
+            elif previous == 'comma':
+                parts.append(' ')
+            if kind == 'function':
+                name = match.group()[:-1]
+                if name != name.lower() or 'calc' in name or name in ('expression', 'url', 'var'):
+                    raise _Unsupported(value)
+                depth += 1
+            parts.append(_serialize_term(kind, match))
+            kind = 'function' if kind == 'function' else 'term'
+        previous = kind
+        space = False
+
+    if depth or previous not in ('term', 'close'):
+        raise _Unsupported(value)
+    return ''.join(parts)
+
+
+def _serialize_term(kind, match):
+    """Serializes a single value, like a number or a string
+    """
+    text = match.group()
+    if kind == 'string':
+        return _serialize_string(text)
+    if kind == 'url':
+        uri = match.group('uri')
+        if uri[0] in '"\'':
+            uri = uri[1:-1]
+        if URI_QUOTED_REGEX.search(uri):
+            uri = '"%s"' % uri.replace('"', '\\"')
+        return 'url(%s)' % uri
+    if kind == 'number':
+        return _serialize_number(match.group('sign'), match.group('digits'), match.group('unit'))
+    if kind == 'hash' and len(text) == 7 and (text[1] == text[2] and text[3] == text[4] and
+                                              text[5] == text[6]):
+        return '#%s%s%s' % (text[1], text[3], text[5])
+    return text
+
+
+def _serialize_string(text):
+    """Serializes a string with double quotes
+    """
+    if text[0] == '"':
+        return text
+    return '"%s"' % text[1:-1].replace('"', '\\"')
+
+
+def _serialize_number(sign, digits, unit):
+    """Serializes a number, percentage or dimension
+    """
+    unit = (unit or '').lower()
+    value = float(sign + digits) if '.' in digits else int(sign + digits)
+    if value == 0:
+        text = '0'
+        if unit in ZERO_LENGTH_UNITS:
+            unit = ''
+    elif value == int(value):
+        text = '%d' % value
+    else:
+        # six decimal places at most, without the trailing zeros
+        text = '%f' % value
+        decimals = text.index('.') + 2
+        text = text[:decimals] + text[decimals:].rstrip('0')
+    if value != 0 and sign == '+':
+        text = '+' + text
+    return text + unit
@@ -27,5 +27,8 @@ setup(
         'cssutils',
         'django>=1.5',
         'requests',
-    ]
+    ],
+    extras_require={
+        'async': ['httpx; python_version >= "3.6"'],
+    },
 )